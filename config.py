@@ -13,6 +13,10 @@ class Settings:
     firebase_credentials_b64: str
     primary_model_name: str
     fallback_model_name: str
+    firestore_client: str
+    firestore_backend: str
+    gemini_backend: str
+    fast_boot: bool
 
 
 def _first_env(*names: str) -> str:
@@ -41,16 +45,28 @@ def load_settings() -> Settings:
     )
     primary_model_name = os.getenv("PRIMARY_MODEL_NAME", "gemini-3.1-flash-lite").strip()
     fallback_model_name = os.getenv("FALLBACK_MODEL_NAME", "gemini-2.5-flash-lite").strip()
+    firestore_client = os.getenv("FIRESTORE_CLIENT", "sync").strip().lower()
+    if firestore_client not in ("sync", "async"):
+        raise RuntimeError("FIRESTORE_CLIENT must be either 'sync' or 'async'")
+    firestore_backend = os.getenv("FIRESTORE_BACKEND", "firestore").strip().lower()
+    if firestore_backend not in ("firestore", "memory"):
+        raise RuntimeError("FIRESTORE_BACKEND must be either 'firestore' or 'memory'")
+    gemini_backend = os.getenv("GEMINI_BACKEND", "gemini").strip().lower()
+    if gemini_backend not in ("gemini", "fake"):
+        raise RuntimeError("GEMINI_BACKEND must be either 'gemini' or 'fake'")
+    fast_boot = os.getenv("FAST_BOOT", "").strip().lower() in ("1", "true", "yes")
 
     missing = [
         name
         for name, value in (
             ("BOT_TOKEN", bot_token),
-            ("GEMINI_API_KEY", gemini_api_key),
+            ("GEMINI_API_KEY", gemini_api_key or gemini_backend == "fake"),
         )
         if not value
     ]
-    if not (firebase_cred_path or firebase_credentials_json or firebase_credentials_b64):
+    if firestore_backend == "firestore" and not (
+        firebase_cred_path or firebase_credentials_json or firebase_credentials_b64
+    ):
         missing.append(
             "FIREBASE_CRED_PATH or FIREBASE_CREDENTIALS_JSON or FIREBASE_CREDENTIALS_B64"
         )
@@ -65,4 +81,8 @@ def load_settings() -> Settings:
         firebase_credentials_b64=firebase_credentials_b64,
         primary_model_name=primary_model_name,
         fallback_model_name=fallback_model_name,
+        firestore_client=firestore_client,
+        firestore_backend=firestore_backend,
+        gemini_backend=gemini_backend,
+        fast_boot=fast_boot,
     )
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""Pre-generated Card of the Day readings, kept per language in Firestore and in memory."""
+
+import asyncio
+import collections
+import logging
+import os
+import time
+from typing import Any
+
+from firebase_admin import firestore
+
+import metrics
+from firebase_db import add_daily_card, load_daily_card_pool, remove_daily_card
+from gemini_runtime import PRIORITY_BACKGROUND, generate_content
+from prompts import daily_card_prompt, heading_guide
+from utils.telegram_stream import MESSAGE_LIMIT
+
+POOL_LANGUAGES = ("uk", "en", "ru")
+_POOL_TARGET = int(os.getenv("DAILY_CARD_POOL_TARGET", "30"))
+_POOL_LOW_WATER = int(os.getenv("DAILY_CARD_POOL_LOW_WATER", "10"))
+_POOL_MAX_AGE_DAYS = int(os.getenv("DAILY_CARD_POOL_MAX_AGE_DAYS", "7"))
+# Stop a refill round after this many rejected or failed generations in a row.
+_REFILL_MAX_FAILURES = 3
+# After a background refill that added nothing, wait this long before the next one.
+_REFILL_COOLDOWN_SECONDS = float(os.getenv("DAILY_CARD_POOL_REFILL_COOLDOWN_SECONDS", "600"))
+_MIN_CARD_CHARS = 400
+
+_pools: dict[str, collections.deque[tuple[str, str]]] = {lang: collections.deque() for lang in POOL_LANGUAGES}
+_loaded: set[str] = set()
+_locks: dict[str, asyncio.Lock] = {lang: asyncio.Lock() for lang in POOL_LANGUAGES}
+_refill_tasks: dict[str, asyncio.Task] = {}
+_refill_retry_at: dict[str, float] = {}
+
+
+def _collect_pool_metrics() -> None:
+    for lang, pool in _pools.items():
+        metrics.registry.set_gauge("karma_daily_card_pool_size", len(pool), lang=lang)
+
+
+metrics.registry.add_collector(_collect_pool_metrics)
+
+
+def is_valid_daily_card(text: str, lang: str) -> bool:
+    """A pooled card must have every heading in order, balanced bold tags and fit one message."""
+    if not _MIN_CARD_CHARS <= len(text) <= MESSAGE_LIMIT:
+        return False
+    if "**" in text or text.count("<b>") != text.count("</b>"):
+        return False
+    position = 0
+    for heading in heading_guide(lang).values():
+        found = text.find(f"<b>{heading}:</b>", position)
+        if found == -1:
+            return False
+        position = found
+    return "[text]" not in text
+
+
+async def _ensure_loaded(db: firestore.Client, lang: str) -> None:
+    if lang in _loaded:
+        return
+    async with _locks[lang]:
+        if lang in _loaded:
+            return
+        cards = await load_daily_card_pool(db, lang, max_age_days=_POOL_MAX_AGE_DAYS)
+        _pools[lang].extend(cards)
+        _loaded.add(lang)
+        logging.info("DAILY_CARD_POOL_LOADED lang=%s size=%s", lang, len(cards))
+
+
+async def _refill_language(db: firestore.Client, model: Any, lang: str, target: int) -> int:
+    await _ensure_loaded(db, lang)
+    added = 0
+    failures = 0
+    async with _locks[lang]:
+        while len(_pools[lang]) < target and failures < _REFILL_MAX_FAILURES:
+            try:
+                response = await generate_content(
+                    model, daily_card_prompt(lang), priority=PRIORITY_BACKGROUND, feature="daily"
+                )
+                text = (getattr(response, "text", "") or "").strip()
+            except Exception as exc:
+                failures += 1
+                logging.warning(
+                    "DAILY_CARD_POOL_GENERATION_FAILED lang=%s error_type=%s error=%s",
+                    lang,
+                    type(exc).__name__,
+                    exc,
+                )
+                continue
+
+            if not is_valid_daily_card(text, lang):
+                failures += 1
+                metrics.registry.inc("karma_daily_card_pool_rejected_total", lang=lang)
+                continue
+
+            failures = 0
+            card_id = await add_daily_card(db, lang, text)
+            _pools[lang].append((card_id, text))
+            added += 1
+    return added
+
+
+async def refill_daily_card_pool(db: firestore.Client, model: Any, target: int = _POOL_TARGET) -> dict[str, int]:
+    """Top every language up to ``target`` cards; generation runs at background priority."""
+    added: dict[str, int] = {}
+    for lang in POOL_LANGUAGES:
+        try:
+            added[lang] = await _refill_language(db, model, lang, target)
+        except Exception as exc:
+            added[lang] = 0
+            logging.warning(
+                "DAILY_CARD_POOL_REFILL_FAILED lang=%s error_type=%s error=%s",
+                lang,
+                type(exc).__name__,
+                exc,
+            )
+    logging.info(
+        "DAILY_CARD_POOL_REFILLED added=%s sizes=%s",
+        added,
+        {lang: len(pool) for lang, pool in _pools.items()},
+    )
+    return added
+
+
+def _schedule_refill(db: firestore.Client, model: Any, lang: str) -> None:
+    if lang in _refill_tasks or time.monotonic() < _refill_retry_at.get(lang, 0.0):
+        return
+    task = asyncio.create_task(_refill_language(db, model, lang, _POOL_TARGET))
+    _refill_tasks[lang] = task
+
+    def _done(finished: asyncio.Task) -> None:
+        _refill_tasks.pop(lang, None)
+        if finished.cancelled():
+            return
+        if finished.exception() is not None:
+            logging.warning("DAILY_CARD_POOL_REFILL_FAILED lang=%s error=%s", lang, finished.exception())
+        elif finished.result() > 0:
+            return
+        _refill_retry_at[lang] = time.monotonic() + _REFILL_COOLDOWN_SECONDS
+        logging.info("DAILY_CARD_POOL_REFILL_COOLDOWN lang=%s seconds=%s", lang, _REFILL_COOLDOWN_SECONDS)
+
+    task.add_done_callback(_done)
+
+
+async def pop_daily_card(db: firestore.Client, model: Any, lang: str) -> str | None:
+    """Take the oldest pooled card for ``lang``, or None when the pool is empty.
+
+    Falling under DAILY_CARD_POOL_LOW_WATER starts a background refill.
+    """
+    if lang not in _pools:
+        return None
+    try:
+        await _ensure_loaded(db, lang)
+    except Exception as exc:
+        logging.warning("DAILY_CARD_POOL_LOAD_FAILED lang=%s error_type=%s error=%s", lang, type(exc).__name__, exc)
+        return None
+
+    card = _pools[lang].popleft() if _pools[lang] else None
+    metrics.registry.inc("karma_daily_card_pool_requests_total", lang=lang, result="hit" if card else "miss")
+    if len(_pools[lang]) < _POOL_LOW_WATER:
+        _schedule_refill(db, model, lang)
+    if card is None:
+        return None
+
+    card_id, text = card
+    try:
+        await remove_daily_card(db, lang, card_id)
+    except Exception as exc:
+        # The card is still served; at worst it is handed out once more after a restart.
+        logging.warning("DAILY_CARD_POOL_REMOVE_FAILED lang=%s card_id=%s error=%s", lang, card_id, exc)
+    return text
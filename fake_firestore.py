@@ -0,0 +1,631 @@
+"""In-process stand-in for the subset of ``firestore.Client`` that the bot uses.
+
+Selected with ``FIRESTORE_BACKEND=memory``. It behaves like the synchronous client
+(blocking calls that ``firebase_db`` runs on executor threads), so handler throughput and
+broadcast speed can be measured without a Firebase project. Per-operation latency and
+error injection are configured with ``FAKE_FIRESTORE_LATENCY_MS``,
+``FAKE_FIRESTORE_ERROR_RATE`` and ``FAKE_FIRESTORE_SEED``.
+"""
+
+from __future__ import annotations
+
+import copy
+import functools
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, NotFound, ServiceUnavailable
+from google.cloud.firestore_v1.transforms import ArrayRemove, ArrayUnion, Increment, Maximum, Minimum
+
+OPERATIONS = ("get", "set", "update", "create", "delete", "query", "commit")
+_TRANSACTION_MAX_ATTEMPTS = 5
+_TRANSACTION_BACKOFF_SECONDS = 0.01
+_MISSING = object()
+
+
+def _parse_per_operation(raw: str, *, cast: Callable[[str], float]) -> Dict[str, float]:
+    """Parse ``"12"`` (every operation) or ``"get=5,query=20"`` into a per-operation map."""
+    raw = raw.strip()
+    if not raw:
+        return {}
+    if "=" not in raw:
+        value = cast(raw)
+        return {op: value for op in OPERATIONS}
+    parsed: Dict[str, float] = {}
+    for item in raw.split(","):
+        name, _, value = item.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise RuntimeError(f"Unknown fake Firestore operation '{name}'")
+        parsed[name] = cast(value)
+    return parsed
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _split_path(field_path: str) -> list[str]:
+    return [part.strip("`") for part in field_path.split(".")]
+
+
+def _lookup(data: Dict[str, Any], field_path: str) -> Any:
+    current: Any = data
+    for part in _split_path(field_path):
+        if not isinstance(current, dict) or part not in current:
+            return _MISSING
+        current = current[part]
+    return current
+
+
+def _apply_value(container: Dict[str, Any], key: str, value: Any, now: datetime) -> None:
+    current = container.get(key, _MISSING)
+    if value is firestore.DELETE_FIELD:
+        container.pop(key, None)
+    elif value is firestore.SERVER_TIMESTAMP:
+        container[key] = now
+    elif isinstance(value, Increment):
+        base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+        container[key] = base + value.value
+    elif isinstance(value, Maximum):
+        container[key] = value.value if current is _MISSING else max(current, value.value)
+    elif isinstance(value, Minimum):
+        container[key] = value.value if current is _MISSING else min(current, value.value)
+    elif isinstance(value, ArrayUnion):
+        existing = list(current) if isinstance(current, list) else []
+        existing.extend(item for item in value.values if item not in existing)
+        container[key] = existing
+    elif isinstance(value, ArrayRemove):
+        existing = list(current) if isinstance(current, list) else []
+        container[key] = [item for item in existing if item not in value.values]
+    elif isinstance(value, dict):
+        container[key] = _resolve(value, now)
+    else:
+        container[key] = copy.deepcopy(value)
+
+
+def _resolve(data: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    resolved: Dict[str, Any] = {}
+    for key, value in data.items():
+        _apply_value(resolved, key, value, now)
+    return resolved
+
+
+def _merge_into(target: Dict[str, Any], data: Dict[str, Any], now: datetime) -> None:
+    for key, value in data.items():
+        if isinstance(value, dict) and value:
+            child = target.get(key)
+            if not isinstance(child, dict):
+                child = {}
+                target[key] = child
+            _merge_into(child, value, now)
+        else:
+            _apply_value(target, key, value, now)
+
+
+def _update_into(target: Dict[str, Any], data: Dict[str, Any], now: datetime) -> None:
+    for field_path, value in data.items():
+        parts = _split_path(field_path)
+        container = target
+        for part in parts[:-1]:
+            child = container.get(part)
+            if not isinstance(child, dict):
+                if value is firestore.DELETE_FIELD:
+                    break
+                child = {}
+                container[part] = child
+            container = child
+        else:
+            _apply_value(container, parts[-1], value, now)
+
+
+_TYPE_RANK = {type(None): 0, bool: 1, int: 2, float: 2, datetime: 3, str: 4, bytes: 5, list: 7, dict: 8}
+
+
+def _sort_key(value: Any) -> tuple[int, Any]:
+    rank = _TYPE_RANK.get(type(value), 6)
+    if rank in (7, 8):
+        return rank, repr(value)
+    return rank, value
+
+
+def _matches(value: Any, op: str, expected: Any) -> bool:
+    if op == "==":
+        return value == expected
+    if op == "!=":
+        return value is not None and value != expected
+    if op == "in":
+        return value in expected
+    if op == "not-in":
+        return value is not None and value not in expected
+    if op == "array_contains" or op == "array-contains":
+        return isinstance(value, list) and expected in value
+    if op == "array_contains_any" or op == "array-contains-any":
+        return isinstance(value, list) and any(item in value for item in expected)
+    if _sort_key(value)[0] != _sort_key(expected)[0]:
+        return False
+    if op == "<":
+        return value < expected
+    if op == "<=":
+        return value <= expected
+    if op == ">":
+        return value > expected
+    if op == ">=":
+        return value >= expected
+    raise ValueError(f"Unsupported operator {op!r}")
+
+
+class _Stored:
+    __slots__ = ("data", "version", "create_time", "update_time")
+
+    def __init__(self, data: Dict[str, Any], version: int, now: datetime) -> None:
+        self.data = data
+        self.version = version
+        self.create_time = now
+        self.update_time = now
+
+
+class FakeDocumentSnapshot:
+    def __init__(
+        self,
+        reference: "FakeDocumentReference",
+        data: Optional[Dict[str, Any]],
+        *,
+        create_time: Optional[datetime] = None,
+        update_time: Optional[datetime] = None,
+    ) -> None:
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+        self.read_time = _now()
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str) -> Any:
+        if self._data is None:
+            return None
+        value = _lookup(self._data, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class FakeDocumentReference:
+    def __init__(self, client: "FakeFirestoreClient", path: str) -> None:
+        self._client = client
+        self.path = path
+
+    @property
+    def id(self) -> str:
+        return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, collection_id: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, f"{self.path}/{collection_id}")
+
+    def get(self, field_paths: Optional[Iterable[str]] = None, transaction: Any = None, **_: Any) -> FakeDocumentSnapshot:
+        if transaction is not None:
+            return transaction._read(self, field_paths)
+        self._client._io("get")
+        return self._client._snapshot(self, field_paths)
+
+    def set(self, document_data: Dict[str, Any], merge: bool = False, **_: Any) -> None:
+        self._client._io("set")
+        self._client._apply([("set", self, document_data, merge)])
+
+    def update(self, field_updates: Dict[str, Any], **_: Any) -> None:
+        self._client._io("update")
+        self._client._apply([("update", self, field_updates, False)])
+
+    def create(self, document_data: Dict[str, Any], **_: Any) -> None:
+        self._client._io("create")
+        self._client._apply([("create", self, document_data, False)])
+
+    def delete(self, **_: Any) -> None:
+        self._client._io("delete")
+        self._client._apply([("delete", self, None, False)])
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+
+class FakeFieldFilter:
+    """Mirror of ``google.cloud.firestore_v1.base_query.FieldFilter`` for ``where(filter=...)``."""
+
+    def __init__(self, field_path: str, op_string: str, value: Any) -> None:
+        self.field_path = field_path
+        self.op_string = op_string
+        self.value = value
+
+
+class FakeQuery:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+    def __init__(
+        self,
+        client: "FakeFirestoreClient",
+        path: str,
+        *,
+        all_descendants: bool = False,
+        filters: tuple = (),
+        orders: tuple = (),
+        limit: Optional[int] = None,
+        projection: Optional[tuple] = None,
+        start_after: Any = None,
+    ) -> None:
+        self._client = client
+        self._path = path
+        self._all_descendants = all_descendants
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._projection = projection
+        self._start_after = start_after
+
+    def _copy(self, **changes: Any) -> "FakeQuery":
+        params = {
+            "all_descendants": self._all_descendants,
+            "filters": self._filters,
+            "orders": self._orders,
+            "limit": self._limit,
+            "projection": self._projection,
+            "start_after": self._start_after,
+        }
+        params.update(changes)
+        return FakeQuery(self._client, self._path, **params)
+
+    def where(self, field_path: Optional[str] = None, op_string: Optional[str] = None, value: Any = None, *, filter: Any = None) -> "FakeQuery":
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> "FakeQuery":
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit=count)
+
+    def select(self, field_paths: Iterable[str]) -> "FakeQuery":
+        return self._copy(projection=tuple(field_paths))
+
+    def start_after(self, document_fields_or_snapshot: Any) -> "FakeQuery":
+        return self._copy(start_after=document_fields_or_snapshot)
+
+    def _in_scope(self, path: str) -> bool:
+        parent, _, _ = path.rpartition("/")
+        if self._all_descendants:
+            return parent.rsplit("/", 1)[-1] == self._path
+        return parent == self._path
+
+    def _order_key(self, path: str, data: Dict[str, Any]) -> Optional[list]:
+        key = []
+        for field_path, direction in self._orders or (("__name__", self.ASCENDING),):
+            value = path if field_path == "__name__" else _lookup(data, field_path)
+            if value is _MISSING:
+                return None
+            key.append((_sort_key(value), direction == self.DESCENDING))
+        if all(field_path != "__name__" for field_path, _ in self._orders):
+            key.append(((4, path), bool(self._orders) and self._orders[-1][1] == self.DESCENDING))
+        return key
+
+    @staticmethod
+    def _compare(left: list, right: list) -> int:
+        for (lvalue, desc), (rvalue, _) in zip(left, right):
+            if lvalue != rvalue:
+                result = -1 if lvalue < rvalue else 1
+                return -result if desc else result
+        return 0
+
+    def _cursor_key(self, cursor: Any) -> Optional[list]:
+        if isinstance(cursor, dict):
+            return self._order_key("", cursor)
+        stored = self._client._docs.get(cursor.reference.path)
+        data = stored.data if stored is not None else (cursor.to_dict() or {})
+        return self._order_key(cursor.reference.path, data)
+
+    def _run(self) -> list[FakeDocumentSnapshot]:
+        with self._client._lock:
+            rows = []
+            for path, stored in self._client._docs.items():
+                if not self._in_scope(path):
+                    continue
+                if any(
+                    (value := _lookup(stored.data, field)) is _MISSING or not _matches(value, op, expected)
+                    for field, op, expected in self._filters
+                ):
+                    continue
+                key = self._order_key(path, stored.data)
+                if key is None:
+                    continue
+                rows.append((key, path, stored))
+
+            rows.sort(key=functools.cmp_to_key(lambda a, b: self._compare(a[0], b[0])))
+            if self._start_after is not None:
+                cursor = self._cursor_key(self._start_after)
+                if cursor is not None:
+                    rows = [row for row in rows if self._compare(row[0], cursor) > 0]
+            if self._limit is not None:
+                rows = rows[: self._limit]
+
+            return [
+                self._client._snapshot_from(FakeDocumentReference(self._client, path), stored, self._projection)
+                for _, path, stored in rows
+            ]
+
+    def stream(self, transaction: Any = None, **_: Any) -> Iterator[FakeDocumentSnapshot]:
+        self._client._io("query")
+        return iter(self._run())
+
+    def get(self, transaction: Any = None, **_: Any) -> list[FakeDocumentSnapshot]:
+        return list(self.stream(transaction=transaction))
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client: "FakeFirestoreClient", path: str) -> None:
+        super().__init__(client, path)
+
+    @property
+    def id(self) -> str:
+        return self._path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, document_data: Dict[str, Any], document_id: Optional[str] = None) -> tuple[datetime, FakeDocumentReference]:
+        ref = self.document(document_id)
+        ref.create(document_data)
+        return _now(), ref
+
+
+class FakeWriteBatch:
+    def __init__(self, client: "FakeFirestoreClient") -> None:
+        self._client = client
+        self._writes: list[tuple] = []
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def set(self, reference: FakeDocumentReference, document_data: Dict[str, Any], merge: bool = False) -> None:
+        self._writes.append(("set", reference, document_data, merge))
+
+    def update(self, reference: FakeDocumentReference, field_updates: Dict[str, Any]) -> None:
+        self._writes.append(("update", reference, field_updates, False))
+
+    def create(self, reference: FakeDocumentReference, document_data: Dict[str, Any]) -> None:
+        self._writes.append(("create", reference, document_data, False))
+
+    def delete(self, reference: FakeDocumentReference) -> None:
+        self._writes.append(("delete", reference, None, False))
+
+    def commit(self, **_: Any) -> list:
+        if len(self._writes) > 500:
+            raise ValueError("A write batch cannot contain more than 500 operations")
+        self._client._io("commit")
+        self._client._apply(self._writes)
+        writes, self._writes = self._writes, []
+        return writes
+
+
+class FakeTransaction(FakeWriteBatch):
+    def __init__(self, client: "FakeFirestoreClient") -> None:
+        super().__init__(client)
+        self._read_versions: Dict[str, int] = {}
+
+    def _read(self, reference: FakeDocumentReference, field_paths: Optional[Iterable[str]]) -> FakeDocumentSnapshot:
+        if self._writes:
+            raise ValueError("Transactions require all reads to happen before all writes")
+        self._client._io("get")
+        with self._client._lock:
+            stored = self._client._docs.get(reference.path)
+            self._read_versions[reference.path] = stored.version if stored is not None else 0
+            return self._client._snapshot_from(reference, stored, field_paths)
+
+
+class FakeFirestoreClient:
+    def __init__(
+        self,
+        *,
+        latency_ms: Optional[Dict[str, float]] = None,
+        error_rate: Optional[Dict[str, float]] = None,
+        seed: Optional[int] = None,
+        project: str = "fake-project",
+    ) -> None:
+        self.project = project
+        self._docs: Dict[str, _Stored] = {}
+        self._lock = threading.RLock()
+        self._version = 0
+        self._random = random.Random(seed)
+        self.latency_ms: Dict[str, float] = dict(latency_ms or {})
+        self.error_rate: Dict[str, float] = dict(error_rate or {})
+        self.op_counts: Dict[str, int] = dict.fromkeys(OPERATIONS, 0)
+        self.transaction_attempts = 0
+        self.transaction_retries = 0
+
+    @classmethod
+    def from_env(cls) -> "FakeFirestoreClient":
+        seed = os.getenv("FAKE_FIRESTORE_SEED", "").strip()
+        return cls(
+            latency_ms=_parse_per_operation(os.getenv("FAKE_FIRESTORE_LATENCY_MS", ""), cast=float),
+            error_rate=_parse_per_operation(os.getenv("FAKE_FIRESTORE_ERROR_RATE", ""), cast=float),
+            seed=int(seed) if seed else None,
+        )
+
+    def configure(
+        self,
+        *,
+        latency_ms: Optional[Dict[str, float]] = None,
+        error_rate: Optional[Dict[str, float]] = None,
+    ) -> None:
+        if latency_ms is not None:
+            self.latency_ms = dict(latency_ms)
+        if error_rate is not None:
+            self.error_rate = dict(error_rate)
+
+    def collection(self, collection_path: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, collection_path.strip("/"))
+
+    def document(self, document_path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, document_path.strip("/"))
+
+    def collection_group(self, collection_id: str) -> FakeQuery:
+        return FakeQuery(self, collection_id, all_descendants=True)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, **_: Any) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get_all(
+        self,
+        references: Iterable[FakeDocumentReference],
+        field_paths: Optional[Iterable[str]] = None,
+        transaction: Any = None,
+        **_: Any,
+    ) -> Iterator[FakeDocumentSnapshot]:
+        references = list(references)
+        if transaction is not None:
+            return iter([transaction._read(ref, field_paths) for ref in references])
+        self._io("get")
+        return iter([self._snapshot(ref, field_paths) for ref in references])
+
+    def run_transaction(self, body: Callable[[Any], Any], **read_kwargs: Any) -> Any:
+        """Run a ``firebase_db.run_transaction`` generator body with optimistic concurrency.
+
+        Like ``firestore.transactional`` the body is re-run, after a jittered backoff, when
+        a document it read has changed before commit, up to five attempts.
+        """
+        for attempt in range(_TRANSACTION_MAX_ATTEMPTS):
+            self.transaction_attempts += 1
+            if attempt:
+                self.transaction_retries += 1
+                time.sleep(self._random.uniform(0, _TRANSACTION_BACKOFF_SECONDS * 2**attempt))
+            transaction = self.transaction()
+            steps = body(transaction)
+            try:
+                ref = next(steps)
+                while True:
+                    ref = steps.send(ref.get(transaction=transaction, **read_kwargs))
+            except StopIteration as done:
+                result = done.value
+
+            self._io("commit")
+            with self._lock:
+                if all(
+                    (self._docs[path].version if path in self._docs else 0) == version
+                    for path, version in transaction._read_versions.items()
+                ):
+                    self._apply(transaction._writes)
+                    return result
+        raise ValueError(f"Failed to commit transaction in {_TRANSACTION_MAX_ATTEMPTS} attempts.")
+
+    def reset(self) -> None:
+        with self._lock:
+            self._docs.clear()
+
+    def dump(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {path: copy.deepcopy(stored.data) for path, stored in self._docs.items()}
+
+    def _io(self, op: str) -> None:
+        self.op_counts[op] = self.op_counts.get(op, 0) + 1
+        delay = self.latency_ms.get(op, 0.0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        rate = self.error_rate.get(op, 0.0)
+        if rate > 0 and self._random.random() < rate:
+            raise ServiceUnavailable(f"Injected fake Firestore failure for {op}")
+
+    def _snapshot(self, reference: FakeDocumentReference, field_paths: Optional[Iterable[str]] = None) -> FakeDocumentSnapshot:
+        with self._lock:
+            return self._snapshot_from(reference, self._docs.get(reference.path), field_paths)
+
+    @staticmethod
+    def _snapshot_from(
+        reference: FakeDocumentReference,
+        stored: Optional[_Stored],
+        field_paths: Optional[Iterable[str]],
+    ) -> FakeDocumentSnapshot:
+        if stored is None:
+            return FakeDocumentSnapshot(reference, None)
+        if field_paths is None:
+            data = copy.deepcopy(stored.data)
+        else:
+            data = {}
+            for field_path in field_paths:
+                value = _lookup(stored.data, field_path)
+                if value is not _MISSING:
+                    _update_into(data, {field_path: copy.deepcopy(value)}, _now())
+        return FakeDocumentSnapshot(reference, data, create_time=stored.create_time, update_time=stored.update_time)
+
+    def _apply(self, writes: list[tuple]) -> None:
+        """Apply a list of writes atomically: either all of them land or none do."""
+        now = _now()
+        with self._lock:
+            staged: Dict[str, Optional[Dict[str, Any]]] = {}
+
+            def _current(path: str) -> Optional[Dict[str, Any]]:
+                if path in staged:
+                    return staged[path]
+                stored = self._docs.get(path)
+                return copy.deepcopy(stored.data) if stored is not None else None
+
+            for kind, reference, data, merge in writes:
+                current = _current(reference.path)
+                if kind == "create":
+                    if current is not None:
+                        raise AlreadyExists(f"Document already exists: {reference.path}")
+                    staged[reference.path] = _resolve(data, now)
+                elif kind == "set":
+                    if merge and current is not None:
+                        _merge_into(current, data, now)
+                        staged[reference.path] = current
+                    elif merge:
+                        target: Dict[str, Any] = {}
+                        _merge_into(target, data, now)
+                        staged[reference.path] = target
+                    else:
+                        staged[reference.path] = _resolve(data, now)
+                elif kind == "update":
+                    if current is None:
+                        raise NotFound(f"No document to update: {reference.path}")
+                    _update_into(current, data, now)
+                    staged[reference.path] = current
+                else:
+                    staged[reference.path] = None
+
+            for path, data in staged.items():
+                if data is None:
+                    self._docs.pop(path, None)
+                    continue
+                self._version += 1
+                existing = self._docs.get(path)
+                if existing is None:
+                    self._docs[path] = _Stored(data, self._version, now)
+                else:
+                    existing.data = data
+                    existing.version = self._version
+                    existing.update_time = now
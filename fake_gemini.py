@@ -0,0 +1,271 @@
+"""In-process stand-in for ``genai.GenerativeModel``, for load tests without the Gemini API.
+
+Selected with ``GEMINI_BACKEND=fake``. Responses are structurally valid for each prompt
+family the bot sends: the tarot and advice section layouts (headings are read from the
+prompt), the ``DATE:``/``LANG:`` horoscope batch and the Matrix of Destiny text. Every
+setting takes one value for all models or ``model=value`` pairs, e.g.
+``FAKE_GEMINI_LATENCY_MS=gemini-3.1-flash-lite=1500/9000,gemini-2.5-flash-lite=800/3000``:
+
+- ``FAKE_GEMINI_LATENCY_MS``: ``median/p99`` of a log-normal total latency (or one number)
+- ``FAKE_GEMINI_FIRST_CHUNK_SHARE``: share of the latency spent before the first chunk
+- ``FAKE_GEMINI_SIZE_SCALE``: response length multiplier
+- ``FAKE_GEMINI_TIMEOUT_RATE``: requests that hang until the request timeout
+- ``FAKE_GEMINI_EMPTY_RATE``: responses without candidates
+- ``FAKE_GEMINI_LOCATION_ERROR_RATE``: requests failing with "User location is not supported"
+- ``FAKE_GEMINI_SEED``: makes the random choices reproducible
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from google.api_core.exceptions import DeadlineExceeded, FailedPrecondition
+
+_DEFAULT_TIMEOUT_SECONDS = 60.0
+_STREAM_CHUNKS = 8
+_P99_Z = 2.326
+
+_SENTENCES = {
+    "uk": (
+        "Карти радять не поспішати з висновками й довіритися внутрішньому голосу.",
+        "Енергія цього періоду відкриває двері, які ще вчора здавалися зачиненими.",
+        "Маленький крок сьогодні важить більше, ніж великі плани на потім.",
+        "Те, що здається затримкою, насправді дає тобі час підготуватися.",
+    ),
+    "en": (
+        "The cards advise against rushing to conclusions and ask you to trust your inner voice.",
+        "The energy of this period opens doors that seemed closed only yesterday.",
+        "A small step today matters more than grand plans for later.",
+        "What looks like a delay is really giving you time to prepare.",
+    ),
+    "ru": (
+        "Карты советуют не спешить с выводами и довериться внутреннему голосу.",
+        "Энергия этого периода открывает двери, которые ещё вчера казались закрытыми.",
+        "Маленький шаг сегодня важнее, чем большие планы на потом.",
+        "То, что кажется задержкой, на самом деле даёт тебе время подготовиться.",
+    ),
+}
+_LANGUAGE_NAMES = {"Ukrainian": "uk", "English": "en", "Russian": "ru"}
+_MATRIX_LANGUAGES = {"англійською": "en", "російською": "ru"}
+_ZODIAC_EMOJIS = ("♈", "♉", "♊", "♋", "♌", "♍", "♎", "♏", "♐", "♑", "♒", "♓")
+
+_HEADING_RE = re.compile(r"^(\S+) <b>([^<]+):</b>$", re.MULTILINE)
+_DATE_RE = re.compile(r"DATE:(\d{4}-\d{2}-\d{2})")
+_SIGN_NAMES_RE = re.compile(r"For LANG:(\w+) use: ([^.]+)\.")
+
+
+def _parse_per_model(raw: str, *, cast: Callable[[str], Any]) -> Dict[str, Any]:
+    """Parse ``"0.1"`` (every model, key ``"*"``) or ``"model-a=0.1,model-b=0.2"``."""
+    raw = raw.strip()
+    if not raw:
+        return {}
+    if "=" not in raw:
+        return {"*": cast(raw)}
+    parsed: Dict[str, Any] = {}
+    for item in raw.split(","):
+        name, _, value = item.partition("=")
+        parsed[name.strip()] = cast(value)
+    return parsed
+
+
+def _parse_latency(raw: str) -> tuple[float, float]:
+    median, _, p99 = raw.partition("/")
+    median_ms = float(median)
+    return median_ms, float(p99) if p99 else median_ms
+
+
+def _for_model(values: Dict[str, Any], model_name: str, default: Any) -> Any:
+    short_name = model_name.removeprefix("models/")
+    return values.get(short_name, values.get("*", default))
+
+
+def _prompt_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, dict):
+        return _prompt_text(content.get("text", ""))
+    if isinstance(content, (list, tuple)):
+        return "\n".join(_prompt_text(part) for part in content)
+    return ""
+
+
+def _prompt_language(prompt: str) -> str:
+    match = re.search(r"only in (\w+)", prompt)
+    if match:
+        return _LANGUAGE_NAMES.get(match.group(1), "uk")
+    for marker, lang in _MATRIX_LANGUAGES.items():
+        if marker in prompt:
+            return lang
+    return "uk"
+
+
+class _FakeResponse:
+    def __init__(self, text: str, prompt_tokens: int, output_tokens: int) -> None:
+        self._text = text
+        self.candidates = [SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))] if text else []
+        self.prompt_feedback = SimpleNamespace(block_reason=0)
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=0,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        )
+
+    @property
+    def text(self) -> str:
+        if not self.candidates:
+            # Same as the SDK's accessor on a response without candidates.
+            raise ValueError("Invalid operation: The `response.text` quick accessor requires a valid `Part`.")
+        return self._text
+
+
+class FakeGenerativeModel:
+    """Drop-in for ``genai.GenerativeModel`` that answers from templates after a sampled delay."""
+
+    def __init__(
+        self,
+        model_name: str,
+        *,
+        system_instruction: Any = None,
+        latency_ms: tuple[float, float] = (1500.0, 6000.0),
+        first_chunk_share: float = 0.3,
+        size_scale: float = 1.0,
+        timeout_rate: float = 0.0,
+        empty_rate: float = 0.0,
+        location_error_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self.system_instruction = system_instruction
+        self.latency_ms = latency_ms
+        self.first_chunk_share = first_chunk_share
+        self.size_scale = size_scale
+        self.timeout_rate = timeout_rate
+        self.empty_rate = empty_rate
+        self.location_error_rate = location_error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    @classmethod
+    def from_env(cls, model_name: str, *, system_instruction: Any = None) -> "FakeGenerativeModel":
+        def setting(name: str, cast: Callable[[str], Any], default: Any) -> Any:
+            return _for_model(_parse_per_model(os.getenv(name, ""), cast=cast), model_name, default)
+
+        seed = os.getenv("FAKE_GEMINI_SEED", "").strip()
+        return cls(
+            model_name,
+            system_instruction=system_instruction,
+            latency_ms=setting("FAKE_GEMINI_LATENCY_MS", _parse_latency, (1500.0, 6000.0)),
+            first_chunk_share=setting("FAKE_GEMINI_FIRST_CHUNK_SHARE", float, 0.3),
+            size_scale=setting("FAKE_GEMINI_SIZE_SCALE", float, 1.0),
+            timeout_rate=setting("FAKE_GEMINI_TIMEOUT_RATE", float, 0.0),
+            empty_rate=setting("FAKE_GEMINI_EMPTY_RATE", float, 0.0),
+            location_error_rate=setting("FAKE_GEMINI_LOCATION_ERROR_RATE", float, 0.0),
+            seed=int(seed) if seed else None,
+        )
+
+    def generate_content(self, contents: Any, *, request_options: Any = None, **_: Any) -> _FakeResponse:
+        delay, outcome, text = self._plan(contents, request_options)
+        time.sleep(delay)
+        return self._finish(outcome, contents, text)
+
+    async def generate_content_async(
+        self,
+        contents: Any,
+        *,
+        stream: bool = False,
+        request_options: Any = None,
+        **_: Any,
+    ) -> Any:
+        delay, outcome, text = self._plan(contents, request_options)
+        if not stream or outcome in ("timeout", "location"):
+            await asyncio.sleep(delay)
+            return self._finish(outcome, contents, text)
+
+        # Like the SDK, the stream is opened only once the first chunk has arrived.
+        first_delay = delay * self.first_chunk_share
+        await asyncio.sleep(first_delay)
+        return self._stream(contents, text, (delay - first_delay) / _STREAM_CHUNKS)
+
+    def _plan(self, contents: Any, request_options: Any) -> tuple[float, str, str]:
+        with self._lock:
+            self.calls += 1
+            roll = self._random.random()
+            median_ms, p99_ms = self.latency_ms
+            sigma = max(0.0, math.log(max(p99_ms, median_ms) / median_ms) / _P99_Z) if median_ms > 0 else 0.0
+            delay = self._random.lognormvariate(math.log(median_ms), sigma) / 1000 if median_ms > 0 else 0.0
+            text = self._render(_prompt_text(contents))
+
+        if roll < self.timeout_rate:
+            timeout = (request_options or {}).get("timeout", _DEFAULT_TIMEOUT_SECONDS)
+            return float(timeout), "timeout", ""
+        roll -= self.timeout_rate
+        if roll < self.location_error_rate:
+            return min(delay, 0.2), "location", ""
+        roll -= self.location_error_rate
+        if roll < self.empty_rate:
+            return delay, "empty", ""
+        return delay, "ok", text
+
+    def _finish(self, outcome: str, contents: Any, text: str) -> _FakeResponse:
+        if outcome == "timeout":
+            raise DeadlineExceeded("504 Deadline Exceeded")
+        if outcome == "location":
+            raise FailedPrecondition("User location is not supported for the API use.")
+        return _FakeResponse(text, self._tokens(_prompt_text(contents)), self._tokens(text))
+
+    async def _stream(self, contents: Any, text: str, chunk_delay: float) -> AsyncIterator[_FakeResponse]:
+        prompt_tokens = self._tokens(_prompt_text(contents))
+        if not text:
+            yield _FakeResponse("", prompt_tokens, 0)
+            return
+        step = max(1, math.ceil(len(text) / _STREAM_CHUNKS))
+        for index, start in enumerate(range(0, len(text), step)):
+            if index:
+                await asyncio.sleep(chunk_delay)
+            yield _FakeResponse(text[start : start + step], prompt_tokens, self._tokens(text[: start + step]))
+
+    @staticmethod
+    def _tokens(text: str) -> int:
+        return max(1, len(text) // 4)
+
+    def _paragraph(self, lang: str, sentences: int) -> str:
+        pool = _SENTENCES.get(lang, _SENTENCES["uk"])
+        count = max(1, round(sentences * self.size_scale))
+        return " ".join(self._random.choice(pool) for _ in range(count))
+
+    def _render(self, prompt: str) -> str:
+        lang = _prompt_language(prompt)
+        dates = _DATE_RE.findall(prompt)
+        if dates and "LANG:" in prompt:
+            return self._render_horoscopes(prompt, [date for date in dates if date != "YYYY-MM-DD"])
+
+        headings = _HEADING_RE.findall(prompt)
+        if headings:
+            return "\n\n".join(f"{emoji} <b>{title}:</b>\n\n{self._paragraph(lang, 3)}" for emoji, title in headings)
+
+        if "Матриц" in prompt:
+            return "\n\n".join(f"✨ {self._paragraph(lang, 4)}" for _ in range(3))
+        return self._paragraph(lang, 4)
+
+    def _render_horoscopes(self, prompt: str, dates: list[str]) -> str:
+        sign_names = {lang: [name.strip() for name in names.split(",")] for lang, names in _SIGN_NAMES_RE.findall(prompt)}
+        blocks: list[str] = []
+        for date in dict.fromkeys(dates):
+            blocks.append(f"DATE:{date}")
+            for lang, names in sign_names.items():
+                lines = [
+                    f"{emoji} {name} - {self._random.choice(_SENTENCES.get(lang, _SENTENCES['uk']))}"
+                    for emoji, name in zip(_ZODIAC_EMOJIS, names)
+                ]
+                blocks.append(f"LANG:{lang}\n" + "\n\n".join(lines))
+        return "\n\n".join(blocks)
@@ -3,38 +3,258 @@ import base64
 import json
 import logging
 import os
+import random
+import time
+import uuid
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Dict, Optional
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Generator, Optional
 
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
+from google.api_core.exceptions import Conflict, InvalidArgument
 from google.auth.transport.requests import AuthorizedSession
 from google.cloud.firestore_v1.services.firestore import client as firestore_gapic_client
 
+import metrics
+from fake_firestore import FakeFirestoreClient
+from metrics import track_firestore_operation
+
 REFERRAL_DAILY_BONUS = 1
+_USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+_USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "2048"))
+_CACHEABLE_FIELD_TYPES = (str, int, float, bool, type(None))
+_CHAT_HISTORY_QUEUE_SIZE = int(os.getenv("CHAT_HISTORY_QUEUE_SIZE", "1000"))
+_CHAT_HISTORY_FLUSH_INTERVAL_MS = int(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL_MS", "500"))
+# In daily mode one entry can take two writes (its part and the day index); a batch holds 500.
+_CHAT_HISTORY_FLUSH_BATCH = min(int(os.getenv("CHAT_HISTORY_FLUSH_BATCH", "200")), 250)
+_CHAT_HISTORY_FLUSH_RETRIES = 3
+_CHAT_HISTORY_STORAGE = os.getenv("CHAT_HISTORY_STORAGE", "documents").strip().lower()
+_CHAT_HISTORY_RETENTION_DAYS = int(os.getenv("CHAT_HISTORY_RETENTION_DAYS", "30"))
+_CHAT_HISTORY_MAX_TEXT_CHARS = 4000
+# Lines per chat_days part document before the next part is started; at 4000 chars
+# per line this keeps a document well under Firestore's 1 MiB limit.
+_CHAT_HISTORY_DAY_PART_MESSAGES = int(os.getenv("CHAT_HISTORY_DAY_PART_MESSAGES", "80"))
+_CHAT_HISTORY_SWEEP_PAGE = 300
+if _CHAT_HISTORY_STORAGE not in ("documents", "daily"):
+    raise RuntimeError("CHAT_HISTORY_STORAGE must be either 'documents' or 'daily'")
+_USER_STATS_SHARDS = max(1, int(os.getenv("USER_STATS_SHARDS", "8")))
+_AI_LOCK_STALE_SECONDS = 300
+_STARTUP_PROBE_DEADLINE_SECONDS = float(os.getenv("STARTUP_PROBE_DEADLINE_SECONDS", "10"))
+_BOOT_ID = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{os.getpid()}"
+_AI_RESERVATION_TTL_SECONDS = 24 * 60 * 60
+_USER_SCAN_PAGE_SIZE = max(1, int(os.getenv("USER_SCAN_PAGE_SIZE", "300")))
+_USER_STATS_KEYS = (
+    "total_users",
+    "users_with_balance",
+    "users_with_daily_card",
+    "users_with_zodiac",
+    "users_referred",
+    "active_referrers",
+    "total_referral_rewards",
+    "lang_uk",
+    "lang_en",
+    "lang_ru",
+)
+_USER_STATS_SOURCE_FIELDS = frozenset(
+    {
+        "balance",
+        "last_daily_card_date",
+        "zodiac_sign",
+        "referred_by",
+        "referrals_count",
+        "referral_rewards_total",
+        "language",
+    }
+)
 
 
 class InsufficientBalanceError(Exception):
     pass
 
 
+def _as_int(value: Any, default: int = 0) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
 @dataclass(frozen=True)
 class UserDoc:
     user_id: int
     username: str
     first_name: str
     balance: int
+    language: str = "uk"
+    zodiac_sign: str = "all"
+    horoscope_enabled: bool = True
+    referrals_count: int = 0
+    referral_rewards_total: int = 0
+    active_ai_lock: str = ""
+    last_daily_card_date: str = ""
+    daily_card_lock_date: str = ""
+    matrix_dob: str = ""
+    matrix_free_slots: int = 2
+    matrix_last_own_req: Any = None
+    is_new: bool = False
+
+    @classmethod
+    def from_data(cls, user_id: int, data: Dict[str, Any], *, is_new: bool = False) -> "UserDoc":
+        return cls(
+            user_id=user_id,
+            username=data.get("username") or "",
+            first_name=data.get("first_name") or "",
+            balance=_as_int(data.get("balance", 0)),
+            language=data.get("language") or "uk",
+            zodiac_sign=data.get("zodiac_sign") or "all",
+            horoscope_enabled=bool(data.get("horoscope_enabled", True)),
+            referrals_count=_as_int(data.get("referrals_count", 0)),
+            referral_rewards_total=_as_int(data.get("referral_rewards_total", 0)),
+            active_ai_lock=data.get("active_ai_lock") or "",
+            last_daily_card_date=data.get("last_daily_card_date") or "",
+            daily_card_lock_date=data.get("daily_card_lock_date") or "",
+            matrix_dob=data.get("matrix_dob") or "",
+            matrix_free_slots=_as_int(data.get("matrix_free_slots", 2), 2),
+            matrix_last_own_req=data.get("matrix_last_own_req"),
+            is_new=is_new,
+        )
 
 
-_db: Optional[firestore.Client] = None
+_db: Optional[Any] = None
 _credential_source = ""
 _credential_project_id = ""
 _credential_client_email = ""
 _credential_private_key_id = ""
+_startup_probe_run: Dict[str, Any] = {}
 
 logger = logging.getLogger(__name__)
 
 
+class _UserDocCache:
+    """LRU+TTL cache of ``users/{id}`` documents, touched only from the event loop.
+
+    Every entry carries the epoch of the write that produced it, so a read that
+    started before a concurrent write cannot put a stale document back.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[int, tuple[float, int, Any]]" = OrderedDict()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def begin_read(self, user_id: int) -> int:
+        entry = self._entries.get(user_id)
+        return entry[1] if entry else 0
+
+    def get(self, user_id: int) -> tuple[bool, Optional[Dict[str, Any]]]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[2] is self._MISSING or entry[0] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        data = entry[2]
+        return True, dict(data) if data is not None else None
+
+    def put(self, user_id: int, data: Optional[Dict[str, Any]], read_epoch: Optional[int] = None) -> None:
+        if not self.enabled:
+            return
+        entry = self._entries.get(user_id)
+        if read_epoch is not None and entry is not None and entry[1] != read_epoch:
+            return
+        self._epoch += 1
+        stored = dict(data) if data is not None else None
+        self._entries[user_id] = (time.monotonic() + self.ttl_seconds, self._epoch, stored)
+        self._entries.move_to_end(user_id)
+        self._evict()
+
+    def merge(self, user_id: int, fields: Dict[str, Any]) -> None:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[2] is self._MISSING or entry[2] is None:
+            self.invalidate(user_id)
+            return
+        data = dict(entry[2])
+        for key, value in fields.items():
+            if value is firestore.DELETE_FIELD:
+                data.pop(key, None)
+            elif "." in key or not isinstance(value, _CACHEABLE_FIELD_TYPES):
+                self.invalidate(user_id)
+                return
+            else:
+                data[key] = value
+        self._epoch += 1
+        self._entries[user_id] = (entry[0], self._epoch, data)
+
+    def invalidate(self, user_id: int) -> None:
+        if not self.enabled:
+            return
+        self.invalidations += 1
+        self._epoch += 1
+        self._entries[user_id] = (0.0, self._epoch, self._MISSING)
+        self._entries.move_to_end(user_id)
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+        }
+
+
+_user_cache = _UserDocCache(_USER_CACHE_MAX_ENTRIES, _USER_CACHE_TTL_SECONDS)
+
+
+def user_cache_stats() -> Dict[str, int]:
+    return _user_cache.stats()
+
+
+def _collect_user_cache_metrics() -> None:
+    for stat, value in _user_cache.stats().items():
+        metrics.registry.set_gauge("karma_user_cache", value, stat=stat)
+
+
+metrics.registry.add_collector(_collect_user_cache_metrics)
+
+
+def log_user_cache_stats() -> None:
+    stats = _user_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_ratio = stats["hits"] / lookups if lookups else 0.0
+    logger.info(
+        "USER_CACHE_STATS hits=%s misses=%s hit_ratio=%.3f evictions=%s invalidations=%s size=%s max_entries=%s ttl_seconds=%s",
+        stats["hits"],
+        stats["misses"],
+        hit_ratio,
+        stats["evictions"],
+        stats["invalidations"],
+        stats["size"],
+        _user_cache.max_entries,
+        _user_cache.ttl_seconds,
+    )
+
+
 def _credential_from_json(raw_json: str) -> tuple[credentials.Certificate, dict[str, Any]]:
     try:
         service_account_info = json.loads(raw_json)
@@ -72,11 +292,23 @@ def _init_firestore_sync(
     *,
     firebase_credentials_json: str = "",
     firebase_credentials_b64: str = "",
-) -> firestore.Client:
+    client_mode: str = "sync",
+    backend: str = "firestore",
+) -> Any:
     global _db, _credential_source, _credential_project_id, _credential_client_email, _credential_private_key_id
     if _db is not None:
         return _db
 
+    if backend == "memory":
+        _db = FakeFirestoreClient.from_env()
+        _credential_source = "FIRESTORE_BACKEND=memory"
+        logger.warning(
+            "Using in-memory fake Firestore; data is lost on restart latency_ms=%s error_rate=%s",
+            _db.latency_ms or "none",
+            _db.error_rate or "none",
+        )
+        return _db
+
     if not firebase_admin._apps:
         service_account_info: dict[str, Any] = {}
         if firebase_credentials_json:
@@ -113,6 +345,12 @@ def _init_firestore_sync(
         )
         firebase_admin.initialize_app(cred)
 
+    if client_mode == "async":
+        # The async GAPIC client only speaks grpc_asyncio, so FIRESTORE_TRANSPORT does not apply here.
+        _db = firestore_async.client()
+        logger.info("Using Firestore AsyncClient; database I/O no longer runs on executor threads")
+        return _db
+
     _db = firestore.client()
     _force_firestore_rest_transport(_db)
     return _db
@@ -132,89 +370,285 @@ def _force_firestore_rest_transport(db: firestore.Client) -> None:
     )
     logger.info("Forced Firestore GAPIC transport=rest")
 
+@track_firestore_operation
 async def init_firestore(
     firebase_cred_path: str = "",
     *,
     firebase_credentials_json: str = "",
     firebase_credentials_b64: str = "",
+    client_mode: str = "sync",
+    backend: str = "firestore",
 ) -> firestore.Client:
     return await asyncio.to_thread(
         _init_firestore_sync,
         firebase_cred_path,
         firebase_credentials_json=firebase_credentials_json,
         firebase_credentials_b64=firebase_credentials_b64,
+        client_mode=client_mode,
+        backend=backend,
     )
 
 
-async def check_firestore_access(db: firestore.Client) -> bool:
-    def _check_sync() -> list[tuple[str, bool, str]]:
-        diagnostics_ref = db.collection("_diagnostics").document("firestore_access_check")
-        checks: list[tuple[str, bool, str]] = []
+def _is_async_client(db: Any) -> bool:
+    return isinstance(db, firestore.AsyncClient)
+
+
+@track_firestore_operation
+async def read_document(db: firestore.Client, ref: Any, **kwargs: Any) -> Any:
+    if _is_async_client(db):
+        return await ref.get(**kwargs)
+    return await asyncio.to_thread(partial(ref.get, **kwargs))
+
+
+@track_firestore_operation
+async def write_document(db: firestore.Client, ref: Any, data: Dict[str, Any], *, merge: bool = False, **kwargs: Any) -> None:
+    if _is_async_client(db):
+        await ref.set(data, merge=merge, **kwargs)
+        return
+    await asyncio.to_thread(partial(ref.set, data, merge=merge, **kwargs))
+
+
+@track_firestore_operation
+async def update_document(db: firestore.Client, ref: Any, data: Dict[str, Any]) -> None:
+    if _is_async_client(db):
+        await ref.update(data)
+        return
+    await asyncio.to_thread(ref.update, data)
+
+
+@track_firestore_operation
+async def commit_batch(db: firestore.Client, batch: Any) -> None:
+    if _is_async_client(db):
+        await batch.commit()
+        return
+    await asyncio.to_thread(batch.commit)
+
+
+@track_firestore_operation
+async def read_documents(db: firestore.Client, refs: list[Any], **kwargs: Any) -> list[Any]:
+    """Fetch several documents in one round trip; snapshots come back in ``refs`` order."""
+    if _is_async_client(db):
+        snaps = [snap async for snap in db.get_all(refs, **kwargs)]
+    else:
+        snaps = await asyncio.to_thread(lambda: list(db.get_all(refs, **kwargs)))
+    by_path = {snap.reference.path: snap for snap in snaps}
+    return [by_path[ref.path] for ref in refs]
+
+
+@track_firestore_operation
+async def query_documents(db: firestore.Client, query: Any, **kwargs: Any) -> list[Any]:
+    if _is_async_client(db):
+        return [snap async for snap in query.stream(**kwargs)]
+    return await asyncio.to_thread(lambda: list(query.stream(**kwargs)))
+
 
-        def _raw_rest_request(method: str) -> str:
+async def iter_document_pages(
+    db: firestore.Client,
+    query: Any,
+    *,
+    page_size: int,
+    fields: Optional[list[str]] = None,
+    timeout: Optional[float] = None,
+) -> AsyncIterator[list[Any]]:
+    """Yield ``query`` results page by page, ordered by document id.
+
+    Only one page of snapshots is held at a time; ``fields`` limits each document to a
+    projection so large fields are never transferred.
+    """
+    query = query.order_by("__name__")
+    if fields is not None:
+        query = query.select(fields)
+    read_kwargs: Dict[str, Any] = {"timeout": timeout} if timeout is not None else {}
+
+    last = None
+    while True:
+        page_query = query.limit(page_size)
+        if last is not None:
+            page_query = page_query.start_after(last)
+        page = await query_documents(db, page_query, **read_kwargs)
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+
+TransactionBody = Callable[[Any], Generator[Any, Any, Any]]
+
+
+@track_firestore_operation
+async def run_transaction(db: firestore.Client, body: TransactionBody, *, read_timeout: float | None = None) -> Any:
+    """Run ``body`` in a Firestore transaction on either client flavour.
+
+    ``body(transaction)`` is a generator that yields document references to read and
+    receives their snapshots back; writes go through the (synchronous) ``transaction.set``
+    and ``transaction.update`` buffers, and the generator's return value is the result.
+    """
+    read_kwargs: Dict[str, Any] = {"timeout": read_timeout} if read_timeout is not None else {}
+
+    attempts = 0
+
+    def _counted(transaction: Any):
+        nonlocal attempts
+        attempts += 1
+        return body(transaction)
+
+    try:
+        return await _run_transaction_body(db, _counted, read_kwargs)
+    finally:
+        if attempts > 1:
+            metrics.registry.inc(
+                metrics.FIRESTORE_RETRIES,
+                attempts - 1,
+                operation=metrics.current_operation() or "run_transaction",
+            )
+
+
+async def _run_transaction_body(db: firestore.Client, body: TransactionBody, read_kwargs: Dict[str, Any]) -> Any:
+    run_fake = getattr(db, "run_transaction", None)
+    if run_fake is not None:
+        return await asyncio.to_thread(run_fake, body, **read_kwargs)
+
+    if _is_async_client(db):
+
+        @firestore.async_transactional
+        async def _run_async(transaction: Any) -> Any:
+            steps = body(transaction)
+            try:
+                ref = next(steps)
+                while True:
+                    snap = await ref.get(transaction=transaction, **read_kwargs)
+                    ref = steps.send(snap)
+            except StopIteration as done:
+                return done.value
+
+        return await _run_async(db.transaction())
+
+    def _tx_sync() -> Any:
+        @firestore.transactional
+        def _run(transaction: firestore.Transaction) -> Any:
+            steps = body(transaction)
+            try:
+                ref = next(steps)
+                while True:
+                    ref = steps.send(ref.get(transaction=transaction, **read_kwargs))
+            except StopIteration as done:
+                return done.value
+
+        return _run(db.transaction())
+
+    return await asyncio.to_thread(_tx_sync)
+
+
+def _startup_probes(db: firestore.Client) -> tuple[list[tuple[str, Callable[[], Awaitable[Any]]]], list[tuple[str, Callable[[], Awaitable[Any]]]]]:
+    """Read and write probes for :func:`check_firestore_access`, as ``(name, factory)`` pairs."""
+    diagnostics_ref = db.collection("_diagnostics").document("firestore_access_check")
+    session: Optional[AuthorizedSession] = None
+
+    def _raw_rest_request(method: str) -> str:
+        nonlocal session
+        if session is None:
             raw_credentials = db._credentials
             if getattr(raw_credentials, "requires_scopes", False):
                 raw_credentials = raw_credentials.with_scopes(["https://www.googleapis.com/auth/datastore"])
             session = AuthorizedSession(raw_credentials)
-            url = (
-                f"https://firestore.googleapis.com/v1/projects/{db.project}"
-                "/databases/(default)/documents/_diagnostics/firestore_access_check"
+        url = (
+            f"https://firestore.googleapis.com/v1/projects/{db.project}"
+            "/databases/(default)/documents/_diagnostics/firestore_access_check"
+        )
+        if method == "GET":
+            response = session.get(url, timeout=_STARTUP_PROBE_DEADLINE_SECONDS)
+        else:
+            response = session.patch(
+                url,
+                json={
+                    "fields": {
+                        "source": {"stringValue": "render_raw_rest_probe"},
+                        "checked_marker": {"stringValue": "ok"},
+                    }
+                },
+                timeout=_STARTUP_PROBE_DEADLINE_SECONDS,
             )
-            if method == "GET":
-                response = session.get(url, timeout=30)
-            else:
-                response = session.patch(
-                    url,
-                    json={
-                        "fields": {
-                            "source": {"stringValue": "render_raw_rest_probe"},
-                            "checked_marker": {"stringValue": "ok"},
-                        }
-                    },
-                    timeout=30,
-                )
-            if response.status_code not in (200, 404):
-                return f"HTTP {response.status_code}: {response.text[:300]}"
-            return f"HTTP {response.status_code}"
-
-        operations = (
-            ("document_get", lambda: diagnostics_ref.get()),
-            ("query_stream", lambda: list(db.collection("users").limit(1).stream())),
-            (
-                "document_set",
-                lambda: diagnostics_ref.set(
-                    {
-                        "checked_at": firestore.SERVER_TIMESTAMP,
-                        "source": "startup_probe",
-                    },
-                    merge=True,
-                ),
+        if response.status_code not in (200, 404):
+            return f"HTTP {response.status_code}: {response.text[:300]}"
+        return f"HTTP {response.status_code}"
+
+    reads: list[tuple[str, Callable[[], Awaitable[Any]]]] = [
+        ("document_get", lambda: read_document(db, diagnostics_ref)),
+        ("query_stream", lambda: query_documents(db, db.collection("users").limit(1))),
+    ]
+    writes: list[tuple[str, Callable[[], Awaitable[Any]]]] = [
+        (
+            "document_set",
+            lambda: write_document(
+                db,
+                diagnostics_ref,
+                {
+                    "checked_at": firestore.SERVER_TIMESTAMP,
+                    "source": "startup_probe",
+                },
+                merge=True,
             ),
-            ("raw_rest_get", lambda: _raw_rest_request("GET")),
-            ("raw_rest_patch", lambda: _raw_rest_request("PATCH")),
-        )
+        ),
+    ]
+    # No credentials or REST endpoint behind the in-memory backend.
+    if not isinstance(db, FakeFirestoreClient):
+        reads.append(("raw_rest_get", lambda: asyncio.to_thread(_raw_rest_request, "GET")))
+        writes.append(("raw_rest_patch", lambda: asyncio.to_thread(_raw_rest_request, "PATCH")))
+    return reads, writes
 
-        for name, operation in operations:
-            try:
-                result = operation()
-                if isinstance(result, str) and result.startswith("HTTP ") and not result.startswith(("HTTP 200", "HTTP 404")):
-                    checks.append((name, False, result))
-                else:
-                    checks.append((name, True, result or "ok"))
-            except Exception as exc:
-                checks.append((name, False, f"{type(exc).__name__}: {exc}"))
-        return checks
+
+async def _run_probe(name: str, operation: Callable[[], Awaitable[Any]]) -> tuple[str, bool, str, float]:
+    started = time.perf_counter()
+    try:
+        result = await operation()
+        if isinstance(result, str) and result.startswith("HTTP ") and not result.startswith(("HTTP 200", "HTTP 404")):
+            ok, detail = False, result
+        else:
+            ok, detail = True, result if isinstance(result, str) else "ok"
+    except Exception as exc:
+        ok, detail = False, f"{type(exc).__name__}: {exc}"
+    return name, ok, detail, time.perf_counter() - started
+
+
+@track_firestore_operation
+async def check_firestore_access(db: firestore.Client, *, phase: str = "full") -> bool:
+    """Probe Firestore access concurrently under STARTUP_PROBE_DEADLINE_SECONDS.
+
+    ``phase`` is ``"full"``, ``"reads"`` (fast boot, before polling) or ``"writes"``
+    (fast boot, deferred). Latencies go to metrics and, once the write phase has run,
+    to ``_diagnostics/startup_probes/runs/{boot_id}``.
+    """
+    reads, writes = _startup_probes(db)
+    operations = (reads if phase != "writes" else []) + (writes if phase != "reads" else [])
+
+    started = time.perf_counter()
+    tasks = {asyncio.create_task(_run_probe(name, operation)): name for name, operation in operations}
+    done, pending = await asyncio.wait(tasks, timeout=_STARTUP_PROBE_DEADLINE_SECONDS)
+    for task in pending:
+        task.cancel()
+    total_seconds = time.perf_counter() - started
+
+    checks = [task.result() for task in done]
+    checks.extend(
+        (tasks[task], False, f"timed out after {_STARTUP_PROBE_DEADLINE_SECONDS:g}s", total_seconds)
+        for task in pending
+    )
+    checks.sort(key=lambda check: [name for name, _ in operations].index(check[0]))
 
     client_project = getattr(db, "project", "<unknown>")
-    checks = await asyncio.to_thread(_check_sync)
     failed = [check for check in checks if not check[1]]
 
-    for operation, ok, detail in checks:
+    for operation, ok, detail, seconds in checks:
+        metrics.registry.observe("karma_startup_probe_seconds", seconds, probe=operation)
+        metrics.registry.set_gauge("karma_startup_probe_ok", 1 if ok else 0, probe=operation)
         log = logger.info if ok else logger.error
         log(
-            "FIRESTORE_ACCESS_CHECK operation=%s ok=%s credential_source=%s credential_project_id=%s client_project=%s client_email=%s private_key_id=%s detail=%s",
+            "FIRESTORE_ACCESS_CHECK operation=%s ok=%s seconds=%.3f credential_source=%s credential_project_id=%s client_project=%s client_email=%s private_key_id=%s detail=%s",
             operation,
             ok,
+            seconds,
             _credential_source or "<unknown>",
             _credential_project_id or "<unknown>",
             client_project,
@@ -222,14 +656,154 @@ async def check_firestore_access(db: firestore.Client) -> bool:
             _credential_private_key_id or "<unknown>",
             detail,
         )
+    logger.info("FIRESTORE_ACCESS_CHECK_DONE phase=%s seconds=%.3f failed=%s", phase, total_seconds, len(failed))
+
+    _startup_probe_run[phase] = {
+        "seconds": round(total_seconds, 4),
+        "probes": {
+            name: {"ok": ok, "seconds": round(seconds, 4), "detail": detail[:300]}
+            for name, ok, detail, seconds in checks
+        },
+    }
+    if phase != "reads":
+        await _record_startup_probes(db)
 
     return not failed
 
 
+async def _record_startup_probes(db: firestore.Client) -> None:
+    record = {
+        **_startup_probe_run,
+        "boot_id": _BOOT_ID,
+        "deploy": os.getenv("RENDER_GIT_COMMIT", ""),
+        "recorded_at": firestore.SERVER_TIMESTAMP,
+    }
+    probes_ref = db.collection("_diagnostics").document("startup_probes")
+    try:
+        batch = db.batch()
+        batch.set(probes_ref.collection("runs").document(_BOOT_ID), record, merge=True)
+        batch.set(probes_ref, {"latest": record}, merge=True)
+        await commit_batch(db, batch)
+    except Exception as exc:
+        logger.warning("STARTUP_PROBES_RECORD_FAILED error_type=%s error=%s", type(exc).__name__, exc)
+
+
 def _users_col(db: firestore.Client):
     return db.collection("users")
 
 
+def _user_ref(db: firestore.Client, user_id: int):
+    return _users_col(db).document(str(user_id))
+
+
+def _user_stats_shards(db: firestore.Client):
+    return db.collection("_aggregates").document("user_stats").collection("shards")
+
+
+def _user_stats_contribution(data: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    """How much a single user document adds to each admin statistics counter."""
+    stats = dict.fromkeys(_USER_STATS_KEYS, 0)
+    if data is None:
+        return stats
+
+    stats["total_users"] = 1
+    if _as_int(data.get("balance", 0)) > 0:
+        stats["users_with_balance"] = 1
+    if data.get("last_daily_card_date"):
+        stats["users_with_daily_card"] = 1
+    zodiac = data.get("zodiac_sign", "all")
+    if zodiac and zodiac != "all":
+        stats["users_with_zodiac"] = 1
+    if data.get("referred_by"):
+        stats["users_referred"] = 1
+    if _as_int(data.get("referrals_count", 0)) > 0:
+        stats["active_referrers"] = 1
+    stats["total_referral_rewards"] = _as_int(data.get("referral_rewards_total", 0))
+
+    lang = data.get("language", "uk")
+    if lang == "en":
+        stats["lang_en"] = 1
+    elif lang == "ru":
+        stats["lang_ru"] = 1
+    else:
+        stats["lang_uk"] = 1
+    return stats
+
+
+def _apply_fields(data: Optional[Dict[str, Any]], fields: Dict[str, Any]) -> Dict[str, Any]:
+    result = dict(data or {})
+    for key, value in fields.items():
+        if value is firestore.DELETE_FIELD:
+            result.pop(key, None)
+        elif "." not in key:
+            result[key] = value
+    return result
+
+
+def _stage_user_stats_delta(
+    db: firestore.Client,
+    writer: Any,
+    before: Optional[Dict[str, Any]],
+    after: Optional[Dict[str, Any]],
+) -> None:
+    """Add the counter changes caused by ``before`` -> ``after`` to a transaction or batch."""
+    old = _user_stats_contribution(before)
+    new = _user_stats_contribution(after)
+    delta = {key: firestore.Increment(new[key] - old[key]) for key in _USER_STATS_KEYS if new[key] != old[key]}
+    if delta:
+        shard_ref = _user_stats_shards(db).document(str(random.randrange(_USER_STATS_SHARDS)))
+        writer.set(shard_ref, delta, merge=True)
+
+
+async def _ensure_user_data(
+    db: firestore.Client,
+    user_id: int,
+    username: str,
+    first_name: str,
+) -> tuple[bool, Dict[str, Any]]:
+    found, cached = _user_cache.get(user_id)
+    if found and cached is not None:
+        if (not username or cached.get("username") == username) and (
+            not first_name or cached.get("first_name") == first_name
+        ):
+            return False, cached
+
+    ref = _user_ref(db, user_id)
+    read_epoch = _user_cache.begin_read(user_id)
+    snap = await read_document(db, ref)
+    if not snap.exists:
+        data: Dict[str, Any] = {
+            "username": username or "",
+            "first_name": first_name or "",
+            "balance": 0,
+        }
+        batch = db.batch()
+        batch.create(ref, {**data, "joined_at": firestore.SERVER_TIMESTAMP})
+        _stage_user_stats_delta(db, batch, None, data)
+        try:
+            await commit_batch(db, batch)
+        except Conflict:
+            # Another update for the same user created the document first.
+            read_epoch = _user_cache.begin_read(user_id)
+            snap = await read_document(db, ref)
+        else:
+            _user_cache.invalidate(user_id)
+            return True, data
+
+    updates: Dict[str, Any] = {}
+    data = snap.to_dict() or {}
+    if username and data.get("username") != username:
+        updates["username"] = username
+    if first_name and data.get("first_name") != first_name:
+        updates["first_name"] = first_name
+    if updates:
+        await update_document(db, ref, updates)
+    data.update(updates)
+    _user_cache.put(user_id, data, read_epoch)
+    return False, data
+
+
+@track_firestore_operation
 async def ensure_user(
     db: firestore.Client,
     *,
@@ -237,44 +811,36 @@ async def ensure_user(
     username: str = "",
     first_name: str = "",
 ) -> bool:
-    def _ensure_sync() -> bool:
-        ref = _users_col(db).document(str(user_id))
-        snap = ref.get()
-        if not snap.exists:
-            ref.set(
-                {
-                    "username": username or "",
-                    "first_name": first_name or "",
-                    "balance": 0,
-                    "joined_at": firestore.SERVER_TIMESTAMP,
-                }
-            )
-            return True
-        else:
-            updates: Dict[str, Any] = {}
-            data = snap.to_dict() or {}
-            if username and data.get("username") != username:
-                updates["username"] = username
-            if first_name and data.get("first_name") != first_name:
-                updates["first_name"] = first_name
-            if updates:
-                ref.update(updates)
-            return False
-
-    return await asyncio.to_thread(_ensure_sync)
+    is_new, _ = await _ensure_user_data(db, user_id, username, first_name)
+    return is_new
+
+
+@track_firestore_operation
+async def load_user_doc(db: firestore.Client, user: Any) -> UserDoc:
+    """Load ``users/{id}`` for a Telegram user, creating it on first contact."""
+    is_new, data = await _ensure_user_data(
+        db,
+        user.id,
+        getattr(user, "username", None) or "",
+        getattr(user, "first_name", None) or "",
+    )
+    return UserDoc.from_data(user.id, data, is_new=is_new)
 
 
+@track_firestore_operation
 async def get_user(db: firestore.Client, user_id: int) -> Optional[Dict[str, Any]]:
-    def _get_sync() -> Optional[Dict[str, Any]]:
-        ref = _users_col(db).document(str(user_id))
-        snap = ref.get()
-        if not snap.exists:
-            return None
-        return snap.to_dict() or {}
+    found, cached = _user_cache.get(user_id)
+    if found:
+        return cached
 
-    return await asyncio.to_thread(_get_sync)
+    read_epoch = _user_cache.begin_read(user_id)
+    snap = await read_document(db, _user_ref(db, user_id))
+    data = (snap.to_dict() or {}) if snap.exists else None
+    _user_cache.put(user_id, data, read_epoch)
+    return data
 
 
+@track_firestore_operation
 async def get_balance(db: firestore.Client, user_id: int) -> int:
     user = await get_user(db, user_id)
     if not user:
@@ -285,431 +851,1014 @@ async def get_balance(db: firestore.Client, user_id: int) -> int:
         return 0
 
 
-async def increment_balance(db: firestore.Client, user_id: int, delta: int) -> int:
-    def _tx_sync() -> int:
-        ref = _users_col(db).document(str(user_id))
+@track_firestore_operation
+async def update_user_fields(db: firestore.Client, user_id: int, fields: Dict[str, Any]) -> None:
+    ref = _user_ref(db, user_id)
+    if _USER_STATS_SOURCE_FIELDS.isdisjoint(fields):
+        await write_document(db, ref, fields, merge=True)
+        _user_cache.merge(user_id, fields)
+        return
 
-        @firestore.transactional
-        def _run(transaction: firestore.Transaction) -> int:
-            snap = ref.get(transaction=transaction)
-            if not snap.exists:
-                current = 0
-                transaction.set(
-                    ref,
-                    {
-                        "username": "",
-                        "first_name": "",
-                        "balance": 0,
-                        "joined_at": firestore.SERVER_TIMESTAMP,
-                    },
-                )
-            else:
-                data = snap.to_dict() or {}
-                try:
-                    current = int(data.get("balance", 0))
-                except (TypeError, ValueError):
-                    current = 0
+    def _body(transaction: Any):
+        snap = yield ref
+        before = (snap.to_dict() or {}) if snap.exists else None
+        transaction.set(ref, fields, merge=True)
+        _stage_user_stats_delta(db, transaction, before, _apply_fields(before, fields))
 
-            new_balance = current + delta
-            if new_balance < 0:
-                raise InsufficientBalanceError("Not enough balance")
+    await run_transaction(db, _body)
+    _user_cache.merge(user_id, fields)
 
-            transaction.update(ref, {"balance": new_balance})
-            return new_balance
 
-        transaction = db.transaction()
-        return _run(transaction)
+@track_firestore_operation
+async def increment_balance(db: firestore.Client, user_id: int, delta: int) -> int:
+    ref = _user_ref(db, user_id)
 
-    return await asyncio.to_thread(_tx_sync)
+    def _body(transaction: Any):
+        snap = yield ref
+        before: Optional[Dict[str, Any]] = None
+        if not snap.exists:
+            current = 0
+            transaction.set(
+                ref,
+                {
+                    "username": "",
+                    "first_name": "",
+                    "balance": 0,
+                    "joined_at": firestore.SERVER_TIMESTAMP,
+                },
+            )
+        else:
+            before = snap.to_dict() or {}
+            try:
+                current = int(before.get("balance", 0))
+            except (TypeError, ValueError):
+                current = 0
 
+        new_balance = current + delta
+        if new_balance < 0:
+            raise InsufficientBalanceError("Not enough balance")
 
-async def bind_referrer(db: firestore.Client, user_id: int, referrer_id: int) -> bool:
-    def _tx_sync() -> bool:
-        if user_id == referrer_id:
-            return False
+        transaction.update(ref, {"balance": new_balance})
+        _stage_user_stats_delta(db, transaction, before, _apply_fields(before, {"balance": new_balance}))
+        return new_balance
 
-        user_ref = _users_col(db).document(str(user_id))
-        referrer_ref = _users_col(db).document(str(referrer_id))
+    try:
+        new_balance = await run_transaction(db, _body)
+    except InsufficientBalanceError:
+        _user_cache.invalidate(user_id)
+        raise
+    _user_cache.merge(user_id, {"balance": new_balance})
+    return new_balance
+
+
+@track_firestore_operation
+async def add_matrix_free_slots(db: firestore.Client, user_id: int, count: int = 1) -> int:
+    """Add Matrix slots against the stored value (absent means the default 2); returns the new count."""
+    ref = _user_ref(db, user_id)
+
+    def _body(transaction: Any):
+        snap = yield ref
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        slots = _as_int(data.get("matrix_free_slots", 2), 2) + count
+        transaction.set(ref, {"matrix_free_slots": slots}, merge=True)
+        return slots
 
-        @firestore.transactional
-        def _run(transaction: firestore.Transaction) -> bool:
-            user_snap = user_ref.get(transaction=transaction)
-            referrer_snap = referrer_ref.get(transaction=transaction)
+    try:
+        slots = await run_transaction(db, _body)
+    except Exception:
+        _user_cache.invalidate(user_id)
+        raise
+    _user_cache.merge(user_id, {"matrix_free_slots": slots})
+    return slots
+
+
+@track_firestore_operation
+async def consume_matrix_free_slot(db: firestore.Client, user_id: int) -> bool:
+    """Take one Matrix slot from the stored count (absent means the default 2); False when none is left."""
+    ref = _user_ref(db, user_id)
+
+    def _body(transaction: Any):
+        snap = yield ref
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        slots = _as_int(data.get("matrix_free_slots", 2), 2)
+        if slots <= 0:
+            return None
+        transaction.set(ref, {"matrix_free_slots": slots - 1}, merge=True)
+        return slots - 1
 
-            if not user_snap.exists or not referrer_snap.exists:
-                return False
+    try:
+        slots = await run_transaction(db, _body)
+    except Exception:
+        _user_cache.invalidate(user_id)
+        raise
+    if slots is None:
+        _user_cache.invalidate(user_id)
+        return False
+    _user_cache.merge(user_id, {"matrix_free_slots": slots})
+    return True
+
+
+@track_firestore_operation
+async def bind_referrer(db: firestore.Client, user_id: int, referrer_id: int) -> bool:
+    if user_id == referrer_id:
+        return False
 
-            user_data = user_snap.to_dict() or {}
-            if user_data.get("referred_by"):
-                return False
+    user_ref = _user_ref(db, user_id)
+    referrer_ref = _user_ref(db, referrer_id)
 
-            transaction.set(
-                user_ref,
-                {
-                    "referred_by": referrer_id,
-                    "referred_at": firestore.SERVER_TIMESTAMP,
-                    "referral_bonus_granted": False,
-                },
-                merge=True,
-            )
-            return True
+    def _body(transaction: Any):
+        user_snap = yield user_ref
+        referrer_snap = yield referrer_ref
 
-        transaction = db.transaction()
-        return _run(transaction)
+        if not user_snap.exists or not referrer_snap.exists:
+            return False
 
-    return await asyncio.to_thread(_tx_sync)
+        user_data = user_snap.to_dict() or {}
+        if user_data.get("referred_by"):
+            return False
 
+        transaction.set(
+            user_ref,
+            {
+                "referred_by": referrer_id,
+                "referred_at": firestore.SERVER_TIMESTAMP,
+                "referral_bonus_granted": False,
+            },
+            merge=True,
+        )
+        _stage_user_stats_delta(db, transaction, user_data, _apply_fields(user_data, {"referred_by": referrer_id}))
+        return True
 
-async def grant_referral_bonus_for_daily_card(db: firestore.Client, user_id: int, bonus: int = REFERRAL_DAILY_BONUS) -> Optional[int]:
-    def _tx_sync() -> Optional[int]:
-        user_ref = _users_col(db).document(str(user_id))
+    bound = await run_transaction(db, _body)
+    if bound:
+        _user_cache.invalidate(user_id)
+    return bound
 
-        @firestore.transactional
-        def _run(transaction: firestore.Transaction) -> Optional[int]:
-            user_snap = user_ref.get(transaction=transaction)
-            if not user_snap.exists:
-                return None
 
-            user_data = user_snap.to_dict() or {}
-            referrer_id = user_data.get("referred_by")
-            if not referrer_id or user_data.get("referral_bonus_granted"):
-                return None
+@track_firestore_operation
+async def grant_referral_bonus_for_daily_card(db: firestore.Client, user_id: int, bonus: int = REFERRAL_DAILY_BONUS) -> Optional[int]:
+    user_ref = _user_ref(db, user_id)
 
-            try:
-                referrer_id_int = int(referrer_id)
-            except (TypeError, ValueError):
-                return None
+    def _body(transaction: Any):
+        user_snap = yield user_ref
+        if not user_snap.exists:
+            return None
 
-            if referrer_id_int == user_id:
-                return None
+        user_data = user_snap.to_dict() or {}
+        referrer_id = user_data.get("referred_by")
+        if not referrer_id or user_data.get("referral_bonus_granted"):
+            return None
 
-            referrer_ref = _users_col(db).document(str(referrer_id_int))
-            referrer_snap = referrer_ref.get(transaction=transaction)
-            if not referrer_snap.exists:
-                return None
+        try:
+            referrer_id_int = int(referrer_id)
+        except (TypeError, ValueError):
+            return None
 
-            referrer_data = referrer_snap.to_dict() or {}
-            try:
-                current_balance = int(referrer_data.get("balance", 0))
-            except (TypeError, ValueError):
-                current_balance = 0
-            try:
-                referrals_count = int(referrer_data.get("referrals_count", 0))
-            except (TypeError, ValueError):
-                referrals_count = 0
-            try:
-                referral_rewards_total = int(referrer_data.get("referral_rewards_total", 0))
-            except (TypeError, ValueError):
-                referral_rewards_total = 0
-            try:
-                matrix_free_slots = int(referrer_data.get("matrix_free_slots", 2))
-            except (TypeError, ValueError):
-                matrix_free_slots = 2
+        if referrer_id_int == user_id:
+            return None
 
-            transaction.set(
-                referrer_ref,
-                {
-                    "balance": current_balance + bonus,
-                    "referrals_count": referrals_count + 1,
-                    "referral_rewards_total": referral_rewards_total + bonus,
-                    "matrix_free_slots": matrix_free_slots + 1,
-                },
-                merge=True,
-            )
-            transaction.set(
-                user_ref,
-                {
-                    "referral_bonus_granted": True,
-                    "referral_bonus_granted_at": firestore.SERVER_TIMESTAMP,
-                },
-                merge=True,
-            )
-            return referrer_id_int
+        referrer_ref = _user_ref(db, referrer_id_int)
+        referrer_snap = yield referrer_ref
+        if not referrer_snap.exists:
+            return None
 
-        transaction = db.transaction()
-        return _run(transaction)
+        referrer_data = referrer_snap.to_dict() or {}
+        current_balance = _as_int(referrer_data.get("balance", 0))
+        referrals_count = _as_int(referrer_data.get("referrals_count", 0))
+        referral_rewards_total = _as_int(referrer_data.get("referral_rewards_total", 0))
+        matrix_free_slots = _as_int(referrer_data.get("matrix_free_slots", 2), 2)
+
+        referrer_updates = {
+            "balance": current_balance + bonus,
+            "referrals_count": referrals_count + 1,
+            "referral_rewards_total": referral_rewards_total + bonus,
+            "matrix_free_slots": matrix_free_slots + 1,
+        }
+        transaction.set(referrer_ref, referrer_updates, merge=True)
+        _stage_user_stats_delta(db, transaction, referrer_data, _apply_fields(referrer_data, referrer_updates))
+        transaction.set(
+            user_ref,
+            {
+                "referral_bonus_granted": True,
+                "referral_bonus_granted_at": firestore.SERVER_TIMESTAMP,
+            },
+            merge=True,
+        )
+        return referrer_id_int
 
-    return await asyncio.to_thread(_tx_sync)
+    referrer_id = await run_transaction(db, _body)
+    if referrer_id is not None:
+        _user_cache.invalidate(user_id)
+        _user_cache.invalidate(referrer_id)
+    return referrer_id
 
 
 
+@track_firestore_operation
 async def get_referred_users(db: firestore.Client, referrer_id: int) -> list[Dict[str, Any]]:
-    def _get_sync() -> list[Dict[str, Any]]:
-        items: list[Dict[str, Any]] = []
-        for snap in _users_col(db).where("referred_by", "==", referrer_id).stream():
-            data = snap.to_dict() or {}
-            data["user_id"] = int(snap.id)
-            items.append(data)
-        items.sort(key=lambda item: int(item.get("user_id", 0)))
-        return items
-
-    return await asyncio.to_thread(_get_sync)
+    items: list[Dict[str, Any]] = []
+    for snap in await query_documents(db, _users_col(db).where("referred_by", "==", referrer_id)):
+        data = snap.to_dict() or {}
+        data["user_id"] = int(snap.id)
+        items.append(data)
+    items.sort(key=lambda item: int(item.get("user_id", 0)))
+    return items
+@track_firestore_operation
 async def set_balance(db: firestore.Client, user_id: int, balance: int) -> int:
-    def _set_sync() -> int:
-        ref = _users_col(db).document(str(user_id))
-        snap = ref.get()
+    ref = _user_ref(db, user_id)
+
+    def _body(transaction: Any):
+        snap = yield ref
         if not snap.exists:
-            ref.set(
-                {
-                    "username": "",
-                    "first_name": "",
-                    "balance": balance,
-                    "joined_at": firestore.SERVER_TIMESTAMP,
-                }
-            )
+            created = {
+                "username": "",
+                "first_name": "",
+                "balance": balance,
+            }
+            transaction.set(ref, {**created, "joined_at": firestore.SERVER_TIMESTAMP})
+            _stage_user_stats_delta(db, transaction, None, created)
         else:
-            ref.set({"balance": balance}, merge=True)
-        return balance
+            before = snap.to_dict() or {}
+            transaction.set(ref, {"balance": balance}, merge=True)
+            _stage_user_stats_delta(db, transaction, before, _apply_fields(before, {"balance": balance}))
 
-    return await asyncio.to_thread(_set_sync)
+    await run_transaction(db, _body)
+    _user_cache.merge(user_id, {"balance": balance})
+    return balance
 
 
+@track_firestore_operation
 async def get_user_stats(db: firestore.Client) -> Dict[str, int]:
-    def _stats_sync() -> Dict[str, int]:
-        stats = {
-            "total_users": 0,
-            "users_with_balance": 0,
-            "users_with_daily_card": 0,
-            "users_with_zodiac": 0,
-            "users_referred": 0,
-            "active_referrers": 0,
-            "total_referral_rewards": 0,
-            "lang_uk": 0,
-            "lang_en": 0,
-            "lang_ru": 0,
-        }
+    shards = await query_documents(db, _user_stats_shards(db))
+    if not shards:
+        return await reconcile_user_stats(db)
+
+    stats = dict.fromkeys(_USER_STATS_KEYS, 0)
+    for snap in shards:
+        data = snap.to_dict() or {}
+        for key in _USER_STATS_KEYS:
+            stats[key] += _as_int(data.get(key, 0))
+    return stats
+
+
+@track_firestore_operation
+async def reconcile_user_stats(db: firestore.Client) -> Dict[str, int]:
+    """Recompute the admin counters from a full scan of ``users`` and overwrite the shards.
+
+    Increments that land while the scan is running can be lost; the next run fixes them.
+    """
+    stats = dict.fromkeys(_USER_STATS_KEYS, 0)
+    async for page in iter_document_pages(
+        db, _users_col(db), page_size=_USER_SCAN_PAGE_SIZE, fields=sorted(_USER_STATS_SOURCE_FIELDS)
+    ):
+        for snap in page:
+            for key, value in _user_stats_contribution(snap.to_dict() or {}).items():
+                stats[key] += value
+
+    shards_col = _user_stats_shards(db)
+    previous = dict.fromkeys(_USER_STATS_KEYS, 0)
+    batch = db.batch()
+    for snap in await query_documents(db, shards_col):
+        data = snap.to_dict() or {}
+        for key in _USER_STATS_KEYS:
+            previous[key] += _as_int(data.get(key, 0))
+        if not snap.id.isdigit() or int(snap.id) >= _USER_STATS_SHARDS:
+            batch.delete(snap.reference)
+
+    zeros = dict.fromkeys(_USER_STATS_KEYS, 0)
+    for shard in range(_USER_STATS_SHARDS):
+        batch.set(shards_col.document(str(shard)), stats if shard == 0 else zeros)
+    batch.set(
+        db.collection("_aggregates").document("user_stats"),
+        {"reconciled_at": firestore.SERVER_TIMESTAMP, "shards": _USER_STATS_SHARDS},
+        merge=True,
+    )
+    await commit_batch(db, batch)
 
-        for snap in _users_col(db).stream():
-            data = snap.to_dict() or {}
-            stats["total_users"] += 1
+    drift = {key: stats[key] - previous[key] for key in _USER_STATS_KEYS if stats[key] != previous[key]}
+    logger.info("USER_STATS_RECONCILED total_users=%s drift=%s", stats["total_users"], drift or "none")
+    return stats
 
-            try:
-                balance = int(data.get("balance", 0))
-            except (TypeError, ValueError):
-                balance = 0
-            if balance > 0:
-                stats["users_with_balance"] += 1
 
-            if data.get("last_daily_card_date"):
-                stats["users_with_daily_card"] += 1
+@track_firestore_operation
+async def update_user_zodiac(db: firestore.Client, user_id: int, zodiac_key: str) -> None:
+    await update_user_fields(db, user_id, {"zodiac_sign": zodiac_key})
 
-            zodiac = data.get("zodiac_sign", "all")
-            if zodiac and zodiac != "all":
-                stats["users_with_zodiac"] += 1
 
-            if data.get("referred_by"):
-                stats["users_referred"] += 1
+@track_firestore_operation
+async def update_user_language(db: firestore.Client, user_id: int, lang: str) -> None:
+    await update_user_fields(db, user_id, {"language": lang})
 
-            try:
-                referrals_count = int(data.get("referrals_count", 0))
-            except (TypeError, ValueError):
-                referrals_count = 0
-            if referrals_count > 0:
-                stats["active_referrers"] += 1
 
-            try:
-                referral_rewards_total = int(data.get("referral_rewards_total", 0))
-            except (TypeError, ValueError):
-                referral_rewards_total = 0
-            stats["total_referral_rewards"] += referral_rewards_total
-
-            lang = data.get("language", "uk")
-            if lang == "en":
-                stats["lang_en"] += 1
-            elif lang == "ru":
-                stats["lang_ru"] += 1
-            else:
-                stats["lang_uk"] += 1
+@track_firestore_operation
+async def get_user_language(db: firestore.Client, user_id: int) -> str:
+    user = await get_user(db, user_id)
+    if user is None:
+        return "uk"
+    return user.get("language", "uk")
 
-        return stats
+@track_firestore_operation
+async def update_horoscope_enabled(db: firestore.Client, user_id: int, enabled: bool) -> None:
+    await update_user_fields(db, user_id, {"horoscope_enabled": enabled})
 
-    return await asyncio.to_thread(_stats_sync)
+@track_firestore_operation
+async def claim_daily_card_slot(db: firestore.Client, user_id: int, date_key: str) -> str:
+    ref = _user_ref(db, user_id)
 
+    def _body(transaction: Any):
+        snap = yield ref
+        data = snap.to_dict() or {} if snap.exists else {}
 
-async def update_user_zodiac(db: firestore.Client, user_id: int, zodiac_key: str) -> None:
-    def _update_sync() -> None:
-        doc_ref = _users_col(db).document(str(user_id))
-        doc_ref.set({"zodiac_sign": zodiac_key}, merge=True)
+        if data.get("last_daily_card_date") == date_key:
+            return "opened"
+        if data.get("daily_card_lock_date") == date_key:
+            return "locked"
 
-    await asyncio.to_thread(_update_sync)
+        transaction.set(
+            ref,
+            {
+                "daily_card_lock_date": date_key,
+                "daily_card_lock_at": firestore.SERVER_TIMESTAMP,
+            },
+            merge=True,
+        )
+        return "claimed"
 
+    status = await run_transaction(db, _body)
+    if status == "claimed":
+        _user_cache.invalidate(user_id)
+    return status
 
-async def update_user_language(db: firestore.Client, user_id: int, lang: str) -> None:
-    def _update_sync() -> None:
-        doc_ref = _users_col(db).document(str(user_id))
-        doc_ref.set({"language": lang}, merge=True)
 
-    await asyncio.to_thread(_update_sync)
+@track_firestore_operation
+async def complete_daily_card_slot(db: firestore.Client, user_id: int, date_key: str) -> None:
+    await update_user_fields(
+        db,
+        user_id,
+        {
+            "last_daily_card_date": date_key,
+            "daily_card_lock_date": firestore.DELETE_FIELD,
+            "daily_card_lock_at": firestore.DELETE_FIELD,
+        },
+    )
 
 
-async def get_user_language(db: firestore.Client, user_id: int) -> str:
-    def _get_sync() -> str:
-        doc = _users_col(db).document(str(user_id)).get()
-        if doc.exists:
-            return doc.to_dict().get("language", "uk")
-        return "uk"
+@track_firestore_operation
+async def release_daily_card_slot(db: firestore.Client, user_id: int, date_key: str) -> None:
+    ref = _user_ref(db, user_id)
+    release_fields = {
+        "daily_card_lock_date": firestore.DELETE_FIELD,
+        "daily_card_lock_at": firestore.DELETE_FIELD,
+    }
+
+    def _body(transaction: Any):
+        snap = yield ref
+        data = snap.to_dict() or {} if snap.exists else {}
+        if data.get("last_daily_card_date") == date_key:
+            return
+        if data.get("daily_card_lock_date") != date_key:
+            return
+        transaction.set(ref, release_fields, merge=True)
+
+    await run_transaction(db, _body)
+    _user_cache.merge(user_id, release_fields)
+
+
+def _daily_card_pool(db: firestore.Client, lang: str):
+    return db.collection("daily_card_pool").document(lang).collection("cards")
+
+
+@track_firestore_operation
+async def load_daily_card_pool(db: firestore.Client, lang: str, *, max_age_days: int) -> list[tuple[str, str]]:
+    """Pooled daily cards as (card id, text), oldest first; expired cards are deleted on the way."""
+    snaps = await query_documents(db, _daily_card_pool(db, lang).order_by("created_at"))
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+
+    cards: list[tuple[str, str]] = []
+    expired: list[Any] = []
+    for snap in snaps:
+        data = snap.to_dict() or {}
+        created_at = data.get("created_at")
+        text = data.get("text")
+        if not text or not isinstance(created_at, datetime) or created_at < cutoff:
+            expired.append(snap.reference)
+        else:
+            cards.append((snap.id, text))
 
-    return await asyncio.to_thread(_get_sync)
+    for start in range(0, len(expired), 500):
+        batch = db.batch()
+        for ref in expired[start : start + 500]:
+            batch.delete(ref)
+        await commit_batch(db, batch)
+    return cards
 
-async def update_horoscope_enabled(db: firestore.Client, user_id: int, enabled: bool) -> None:
-    def _update_sync() -> None:
-        doc_ref = _users_col(db).document(str(user_id))
-        doc_ref.set({"horoscope_enabled": enabled}, merge=True)
 
-    await asyncio.to_thread(_update_sync)
+@track_firestore_operation
+async def add_daily_card(db: firestore.Client, lang: str, text: str) -> str:
+    ref = _daily_card_pool(db, lang).document()
+    await write_document(db, ref, {"text": text, "created_at": datetime.now(timezone.utc)})
+    return ref.id
 
-async def claim_daily_card_slot(db: firestore.Client, user_id: int, date_key: str) -> str:
-    def _tx_sync() -> str:
-        ref = _users_col(db).document(str(user_id))
 
-        @firestore.transactional
-        def _run(transaction: firestore.Transaction) -> str:
-            snap = ref.get(transaction=transaction)
-            data = snap.to_dict() or {} if snap.exists else {}
+@track_firestore_operation
+async def remove_daily_card(db: firestore.Client, lang: str, card_id: str) -> None:
+    batch = db.batch()
+    batch.delete(_daily_card_pool(db, lang).document(card_id))
+    await commit_batch(db, batch)
 
-            if data.get("last_daily_card_date") == date_key:
-                return "opened"
-            if data.get("daily_card_lock_date") == date_key:
-                return "locked"
 
-            transaction.set(
-                ref,
-                {
-                    "daily_card_lock_date": date_key,
-                    "daily_card_lock_at": firestore.SERVER_TIMESTAMP,
-                },
-                merge=True,
-            )
-            return "claimed"
+def _matrix_interpretation_ref(db: firestore.Client, key: str):
+    return db.collection("matrix_interpretations").document(key)
 
-        transaction = db.transaction()
-        return _run(transaction)
 
-    return await asyncio.to_thread(_tx_sync)
+@track_firestore_operation
+async def get_matrix_interpretations(db: firestore.Client, key: str) -> list[str]:
+    snap = await read_document(db, _matrix_interpretation_ref(db, key))
+    data = snap.to_dict() or {} if snap.exists else {}
+    return [text for text in data.get("variants") or [] if isinstance(text, str) and text]
 
 
-async def complete_daily_card_slot(db: firestore.Client, user_id: int, date_key: str) -> None:
-    def _update_sync() -> None:
-        ref = _users_col(db).document(str(user_id))
-        ref.set(
+@track_firestore_operation
+async def add_matrix_interpretation(
+    db: firestore.Client,
+    key: str,
+    text: str,
+    *,
+    max_variants: int,
+    meta: Dict[str, Any],
+) -> list[str]:
+    """Store ``text`` as another variant for ``key`` unless it already has ``max_variants``; returns all variants."""
+    ref = _matrix_interpretation_ref(db, key)
+
+    def _body(transaction: Any):
+        snap = yield ref
+        data = snap.to_dict() or {} if snap.exists else {}
+        variants = [variant for variant in data.get("variants") or [] if isinstance(variant, str) and variant]
+        if len(variants) >= max_variants or text in variants:
+            return variants
+        variants.append(text)
+        transaction.set(
+            ref,
             {
-                "last_daily_card_date": date_key,
-                "daily_card_lock_date": firestore.DELETE_FIELD,
-                "daily_card_lock_at": firestore.DELETE_FIELD,
+                **meta,
+                "variants": variants,
+                "variant_count": len(variants),
+                "updated_at": firestore.SERVER_TIMESTAMP,
             },
             merge=True,
         )
+        return variants
 
-    await asyncio.to_thread(_update_sync)
+    return await run_transaction(db, _body)
 
 
-async def release_daily_card_slot(db: firestore.Client, user_id: int, date_key: str) -> None:
-    def _tx_sync() -> None:
-        ref = _users_col(db).document(str(user_id))
+@track_firestore_operation
+async def record_matrix_interpretation_hit(db: firestore.Client, key: str) -> None:
+    await write_document(
+        db,
+        _matrix_interpretation_ref(db, key),
+        {"hits": firestore.Increment(1), "last_hit_at": firestore.SERVER_TIMESTAMP},
+        merge=True,
+    )
 
-        @firestore.transactional
-        def _run(transaction: firestore.Transaction) -> None:
-            snap = ref.get(transaction=transaction)
-            data = snap.to_dict() or {} if snap.exists else {}
-            if data.get("last_daily_card_date") == date_key:
-                return
-            if data.get("daily_card_lock_date") != date_key:
-                return
-            transaction.set(
-                ref,
+
+@track_firestore_operation
+async def add_gemini_usage(db: firestore.Client, day: str, rows: Dict[tuple[str, str, str], Dict[str, float]]) -> None:
+    """Increment ``gemini_usage/{day}`` with totals keyed by (feature, model, outcome)."""
+    features: Dict[str, Any] = {}
+    for (feature, model_name, outcome), totals in rows.items():
+        # Model names contain dots, which would read as nested field paths.
+        model_key = model_name.replace(".", "_")
+        target = features.setdefault(feature, {}).setdefault(model_key, {}).setdefault(outcome, {})
+        for field, value in totals.items():
+            target[field] = firestore.Increment(value)
+
+    await write_document(
+        db,
+        db.collection("gemini_usage").document(day),
+        {"features": features, "updated_at": firestore.SERVER_TIMESTAMP},
+        merge=True,
+    )
+
+
+def _chat_day_key(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%d")
+
+
+# user_id -> (day, part, lines already in that part) for the daily layout.
+_chat_day_parts: Dict[int, tuple[str, int, int]] = {}
+# Part ids carry a per-process token, so a restarted bot never appends to a part it
+# can no longer count.
+_CHAT_DAY_PART_TOKEN = uuid.uuid4().hex[:6]
+# Part documents fetched per round trip while collecting chat history.
+_CHAT_DAY_READ_PARTS = 2
+
+
+def _chat_day_doc_id(day: str, part: int) -> str:
+    return f"{day}_{_CHAT_DAY_PART_TOKEN}_{part:03d}"
+
+
+def _roll_chat_day(user_id: int) -> None:
+    """Start a new part for ``user_id``, e.g. after the current one was rejected as too large."""
+    day, part, _ = _chat_day_parts.get(user_id, (_chat_day_key(datetime.now(timezone.utc)), 0, 0))
+    _chat_day_parts[user_id] = (day, part + 1, 0)
+
+
+def _chat_history_writes(db: firestore.Client, entries: list[tuple[int, str, str]]) -> list[tuple[int, Any, Dict[str, Any], bool]]:
+    """Translate queued chat lines into ``(user_id, ref, data, merge)`` writes for the storage mode.
+
+    In ``daily`` mode the lines of one user and day become ArrayUnion writes to a part
+    document ``users/{id}/chat_days/{YYYY-MM-DD}_{token}_{n}``, and a new part is started
+    once one holds CHAT_HISTORY_DAY_PART_MESSAGES lines. The day's index document
+    ``chat_days/{YYYY-MM-DD}`` lists the part ids in the order they were started, so
+    readers fetch documents by id. Otherwise every line is its own document.
+    """
+    if _CHAT_HISTORY_STORAGE != "daily":
+        return [
+            (
+                user_id,
+                _user_ref(db, user_id).collection("chat_history").document(),
+                {"role": role, "text": text, "timestamp": firestore.SERVER_TIMESTAMP},
+                False,
+            )
+            for user_id, role, text in entries
+        ]
+
+    now = datetime.now(timezone.utc)
+    day = _chat_day_key(now)
+    grouped: Dict[tuple[int, int], list[Dict[str, Any]]] = {}
+    for offset, (user_id, role, text) in enumerate(entries):
+        current_day, part, count = _chat_day_parts.get(user_id, (day, 0, 0))
+        if current_day != day:
+            part, count = 0, 0
+        if count >= _CHAT_HISTORY_DAY_PART_MESSAGES:
+            part, count = part + 1, 0
+        _chat_day_parts[user_id] = (day, part, count + 1)
+        # Distinct timestamps keep ArrayUnion from collapsing identical lines.
+        grouped.setdefault((user_id, part), []).append(
+            {"role": role, "text": text[:_CHAT_HISTORY_MAX_TEXT_CHARS], "at": now + timedelta(microseconds=offset)}
+        )
+
+    writes: list[tuple[int, Any, Dict[str, Any], bool]] = []
+    for (user_id, part), messages in grouped.items():
+        days_col = _user_ref(db, user_id).collection("chat_days")
+        part_id = _chat_day_doc_id(day, part)
+        writes.append(
+            (
+                user_id,
+                days_col.document(part_id),
                 {
-                    "daily_card_lock_date": firestore.DELETE_FIELD,
-                    "daily_card_lock_at": firestore.DELETE_FIELD,
+                    "day": day,
+                    "messages": firestore.ArrayUnion(messages),
+                    "count": firestore.Increment(len(messages)),
+                    "updated_at": firestore.SERVER_TIMESTAMP,
                 },
-                merge=True,
+                True,
             )
+        )
+        writes.append(
+            (
+                user_id,
+                days_col.document(day),
+                {"day": day, "parts": firestore.ArrayUnion([part_id]), "updated_at": firestore.SERVER_TIMESTAMP},
+                True,
+            )
+        )
+    return writes
+
+
+_CHAT_WRITER_STOP = object()
+
+
+class ChatHistoryWriter:
+    """Write-behind pipeline that packs chat_history entries into Firestore batches.
+
+    Entries are flushed every ``flush_interval_ms`` or as soon as ``batch_size`` of them
+    are queued. A full queue makes producers wait instead of dropping history. ``stop``
+    queues a marker, so everything enqueued before it is flushed before the writer exits.
+    """
+
+    def __init__(
+        self,
+        db: firestore.Client,
+        *,
+        max_queue: int = _CHAT_HISTORY_QUEUE_SIZE,
+        flush_interval_ms: int = _CHAT_HISTORY_FLUSH_INTERVAL_MS,
+        batch_size: int = _CHAT_HISTORY_FLUSH_BATCH,
+    ) -> None:
+        self.db = db
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self._queue: asyncio.Queue[Any] = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task[None]] = None
+        self.flushed = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._run(), name="chat-history-writer")
+
+    async def enqueue(self, user_id: int, role: str, text: str) -> None:
+        if self._queue.full():
+            logger.warning("CHAT_HISTORY_BACKPRESSURE queued=%s", self._queue.qsize())
+        await self._queue.put((user_id, role, text))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            if not self._task.done():
+                await self._queue.put(_CHAT_WRITER_STOP)
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Entries that arrived behind the marker, or were left by a writer that crashed.
+        while not self._queue.empty():
+            entries = [self._queue.get_nowait() for _ in range(min(self.batch_size, self._queue.qsize()))]
+            entries = [entry for entry in entries if entry is not _CHAT_WRITER_STOP]
+            if entries:
+                await self._flush(entries)
+        logger.info("CHAT_HISTORY_WRITER_STOPPED flushed=%s failed=%s", self.flushed, self.failed)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            if entry is _CHAT_WRITER_STOP:
+                return
+            entries = [entry]
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(entries) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if entry is _CHAT_WRITER_STOP:
+                    stopping = True
+                    break
+                entries.append(entry)
+            await self._flush(entries)
+            if stopping:
+                return
+
+    async def _commit(self, writes: list[tuple[int, Any, Dict[str, Any], bool]]) -> None:
+        batch = self.db.batch()
+        for _, ref, data, merge in writes:
+            batch.set(ref, data, merge=merge)
+        await commit_batch(self.db, batch)
+
+    async def _flush(self, entries: list[tuple[int, str, str]]) -> None:
+        writes = _chat_history_writes(self.db, entries)
+        for attempt in range(1, _CHAT_HISTORY_FLUSH_RETRIES + 1):
+            try:
+                await self._commit(writes)
+                self.flushed += len(entries)
+                return
+            except asyncio.CancelledError:
+                raise
+            except InvalidArgument as exc:
+                # Usually one user's document over the size limit; retrying the batch cannot help.
+                logger.warning("CHAT_HISTORY_BATCH_REJECTED entries=%s error=%s", len(entries), exc)
+                await self._flush_per_user(entries, writes)
+                return
+            except Exception as exc:
+                logger.warning(
+                    "CHAT_HISTORY_FLUSH_FAILED attempt=%s entries=%s error_type=%s error=%s",
+                    attempt,
+                    len(entries),
+                    type(exc).__name__,
+                    exc,
+                )
+                if attempt < _CHAT_HISTORY_FLUSH_RETRIES:
+                    await asyncio.sleep(attempt)
+        self.failed += len(entries)
+        logger.error("CHAT_HISTORY_ENTRIES_LOST entries=%s", len(entries))
+
+    async def _flush_per_user(
+        self,
+        entries: list[tuple[int, str, str]],
+        writes: list[tuple[int, Any, Dict[str, Any], bool]],
+    ) -> None:
+        """Commit each user's writes on their own, so one rejected document loses only that user's lines."""
+        for user_id in dict.fromkeys(entry[0] for entry in entries):
+            user_entries = [entry for entry in entries if entry[0] == user_id]
+            user_writes = [write for write in writes if write[0] == user_id]
+            try:
+                await self._commit(user_writes)
+            except InvalidArgument:
+                # The day document is full (e.g. counters reset by a restart): continue in a new part.
+                _roll_chat_day(user_id)
+                try:
+                    await self._commit(_chat_history_writes(self.db, user_entries))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    self.failed += len(user_entries)
+                    logger.error("CHAT_HISTORY_ENTRIES_LOST user_id=%s entries=%s error=%s", user_id, len(user_entries), exc)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.failed += len(user_entries)
+                logger.error("CHAT_HISTORY_ENTRIES_LOST user_id=%s entries=%s error=%s", user_id, len(user_entries), exc)
+                continue
+            self.flushed += len(user_entries)
+
+
+_chat_writer: Optional[ChatHistoryWriter] = None
+
+
+def start_chat_history_writer(db: firestore.Client) -> ChatHistoryWriter:
+    global _chat_writer
+    if _chat_writer is None:
+        _chat_writer = ChatHistoryWriter(db)
+    _chat_writer.start()
+    return _chat_writer
 
-        transaction = db.transaction()
-        _run(transaction)
 
+async def stop_chat_history_writer() -> None:
+    global _chat_writer
+    if _chat_writer is not None:
+        await _chat_writer.stop()
+        _chat_writer = None
 
+
+@track_firestore_operation
 async def log_chat_message(db: firestore.Client, user_id: int, role: str, text: str) -> None:
-    def _log_sync() -> None:
-        ref = _users_col(db).document(str(user_id)).collection("chat_history").document()
-        ref.set(
-            {
-                "role": role,
-                "text": text,
-                "timestamp": firestore.SERVER_TIMESTAMP,
-            }
-        )
+    if _chat_writer is not None and _chat_writer.running:
+        await _chat_writer.enqueue(user_id, role, text)
+        return
 
-    await asyncio.to_thread(_log_sync)
+    for _, ref, data, merge in _chat_history_writes(db, [(user_id, role, text)]):
+        await write_document(db, ref, data, merge=merge)
 
 
+@track_firestore_operation
 async def get_chat_history(db: firestore.Client, user_id: int, limit: int = 20) -> list[Dict[str, Any]]:
-    def _get_sync() -> list[Dict[str, Any]]:
-        history: list[Dict[str, Any]] = []
-        query = (
-            _users_col(db)
-            .document(str(user_id))
-            .collection("chat_history")
-            .order_by("timestamp", direction=firestore.Query.DESCENDING)
-            .limit(limit)
-        )
-        for snap in query.stream():
-            data = snap.to_dict() or {}
-            history.append(data)
-        return history
+    """Return the newest ``limit`` chat lines, newest first."""
+    if _CHAT_HISTORY_STORAGE == "daily":
+        # Today's and yesterday's index documents name their parts; read the newest parts
+        # by id until ``limit`` lines are collected.
+        days_col = _user_ref(db, user_id).collection("chat_days")
+        today = datetime.now(timezone.utc)
+        days = [_chat_day_key(today), _chat_day_key(today - timedelta(days=1))]
+        indexes = await read_documents(db, [days_col.document(day) for day in days])
+
+        messages: list[Dict[str, Any]] = []
+        for index in indexes:
+            part_ids = list(reversed((index.to_dict() or {}).get("parts") or [])) if index.exists else []
+            for start in range(0, len(part_ids), _CHAT_DAY_READ_PARTS):
+                refs = [days_col.document(part_id) for part_id in part_ids[start : start + _CHAT_DAY_READ_PARTS]]
+                for snap in await read_documents(db, refs):
+                    part_messages = ((snap.to_dict() or {}).get("messages") or []) if snap.exists else []
+                    messages.extend(
+                        {"role": entry.get("role"), "text": entry.get("text", ""), "timestamp": entry.get("at")}
+                        for entry in reversed(part_messages)
+                    )
+                if len(messages) >= limit:
+                    return messages[:limit]
+        if messages:
+            return messages
+
+    query = (
+        _user_ref(db, user_id)
+        .collection("chat_history")
+        .order_by("timestamp", direction=firestore.Query.DESCENDING)
+        .limit(limit)
+    )
+    return [snap.to_dict() or {} for snap in await query_documents(db, query)]
 
-    return await asyncio.to_thread(_get_sync)
 
-async def claim_ai_action_lock(db: firestore.Client, user_id: int, action_key: str) -> bool:
-    def _tx_sync() -> bool:
-        ref = _users_col(db).document(str(user_id))
+@track_firestore_operation
+async def sweep_chat_history(db: firestore.Client) -> int:
+    """Delete chat history older than CHAT_HISTORY_RETENTION_DAYS in both storage layouts.
 
-        @firestore.transactional
-        def _run(transaction: firestore.Transaction) -> bool:
-            snap = ref.get(transaction=transaction)
-            data = snap.to_dict() or {} if snap.exists else {}
-            
-            if data.get("active_ai_lock"):
-                lock_at = data.get("active_ai_lock_at")
-                if lock_at:
-                    import datetime
-                    now = datetime.datetime.now(datetime.timezone.utc)
-                    if (now - lock_at).total_seconds() < 300:
-                        return False
-            
-            transaction.set(
-                ref,
-                {
-                    "active_ai_lock": action_key,
-                    "active_ai_lock_at": firestore.SERVER_TIMESTAMP,
-                },
-                merge=True,
-            )
-            return True
+    Needs collection-group single-field indexes on ``chat_days.day`` and
+    ``chat_history.timestamp``.
+    """
+    if _CHAT_HISTORY_RETENTION_DAYS <= 0:
+        return 0
 
-        transaction = db.transaction()
-        return _run(transaction)
+    cutoff = datetime.now(timezone.utc) - timedelta(days=_CHAT_HISTORY_RETENTION_DAYS)
+    queries = (
+        db.collection_group("chat_days").where("day", "<", _chat_day_key(cutoff)),
+        db.collection_group("chat_history").where("timestamp", "<", cutoff),
+    )
 
-    return await asyncio.to_thread(_tx_sync)
+    deleted = 0
+    for query in queries:
+        # Project to the document name only; an empty projection would return every field.
+        page_query = query.select(["__name__"]).limit(_CHAT_HISTORY_SWEEP_PAGE)
+        while True:
+            snaps = await query_documents(db, page_query)
+            if not snaps:
+                break
+            batch = db.batch()
+            for snap in snaps:
+                batch.delete(snap.reference)
+            await commit_batch(db, batch)
+            deleted += len(snaps)
+            if len(snaps) < _CHAT_HISTORY_SWEEP_PAGE:
+                break
+
+    logger.info(
+        "CHAT_HISTORY_SWEEP deleted=%s retention_days=%s storage=%s",
+        deleted,
+        _CHAT_HISTORY_RETENTION_DAYS,
+        _CHAT_HISTORY_STORAGE,
+    )
+    return deleted
 
 
-async def release_ai_action_lock(db: firestore.Client, user_id: int, action_key: str | None = None) -> None:
-    def _release_sync() -> None:
-        ref = _users_col(db).document(str(user_id))
-        if action_key is not None:
-            snap = ref.get()
-            data = snap.to_dict() or {} if snap.exists else {}
-            if data.get("active_ai_lock") != action_key:
-                return
-        ref.set(
+def _seconds_since(value: Any) -> Optional[float]:
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - value).total_seconds()
+
+
+def _ai_lock_held(data: Dict[str, Any]) -> bool:
+    if not data.get("active_ai_lock"):
+        return False
+    age = _seconds_since(data.get("active_ai_lock_at"))
+    return age is not None and age < _AI_LOCK_STALE_SECONDS
+
+
+@track_firestore_operation
+async def claim_ai_action_lock(db: firestore.Client, user_id: int, action_key: str) -> bool:
+    ref = _user_ref(db, user_id)
+
+    def _body(transaction: Any):
+        snap = yield ref
+        data = snap.to_dict() or {} if snap.exists else {}
+
+        if _ai_lock_held(data):
+            return False
+
+        transaction.set(
+            ref,
             {
-                "active_ai_lock": firestore.DELETE_FIELD,
-                "active_ai_lock_at": firestore.DELETE_FIELD,
+                "active_ai_lock": action_key,
+                "active_ai_lock_at": firestore.SERVER_TIMESTAMP,
             },
             merge=True,
         )
+        return True
+
+    claimed = await run_transaction(db, _body)
+    if claimed:
+        _user_cache.invalidate(user_id)
+    return claimed
+
+
+@dataclass(frozen=True)
+class PaidActionReservation:
+    """Outcome of :func:`reserve_paid_action`.
+
+    ``status`` is ``"reserved"``, ``"locked"`` (another AI action is running) or
+    ``"insufficient"``; ``balance`` is the balance after the debit, or the current one.
+    """
+
+    status: str
+    balance: int
+    token: Optional[str] = None
+
+    @property
+    def reserved(self) -> bool:
+        return self.status == "reserved"
+
+
+@track_firestore_operation
+async def reserve_paid_action(
+    db: firestore.Client,
+    user_id: int,
+    action_key: str,
+    price: int,
+) -> PaidActionReservation:
+    """Take the AI action lock and debit ``price`` in a single transaction.
+
+    The debit is recorded under ``ai_reservations.<token>`` so it can later be settled
+    with :func:`commit_paid_action` or returned with :func:`refund_paid_action`.
+    """
+    ref = _user_ref(db, user_id)
+    token = uuid.uuid4().hex
+
+    def _body(transaction: Any):
+        snap = yield ref
+        before = (snap.to_dict() or {}) if snap.exists else None
+        data = before or {}
+
+        if _ai_lock_held(data):
+            return PaidActionReservation("locked", _as_int(data.get("balance", 0)))
+
+        balance = _as_int(data.get("balance", 0))
+        if balance < price:
+            return PaidActionReservation("insufficient", balance)
+
+        reservations: Dict[str, Any] = {
+            token: {
+                "action_key": action_key,
+                "price": price,
+                "created_at": firestore.SERVER_TIMESTAMP,
+            }
+        }
+        for old_token, reservation in (data.get("ai_reservations") or {}).items():
+            age = _seconds_since((reservation or {}).get("created_at"))
+            if age is None or age > _AI_RESERVATION_TTL_SECONDS:
+                # Abandoned flow (menu navigation, restart); the debit stays spent.
+                reservations[old_token] = firestore.DELETE_FIELD
+
+        updates = {
+            "balance": balance - price,
+            "active_ai_lock": action_key,
+            "active_ai_lock_at": firestore.SERVER_TIMESTAMP,
+            "ai_reservations": reservations,
+        }
+        transaction.set(ref, updates, merge=True)
+        _stage_user_stats_delta(db, transaction, before, _apply_fields(before, {"balance": balance - price}))
+        return PaidActionReservation("reserved", balance - price, token)
+
+    result = await run_transaction(db, _body)
+    if result.reserved:
+        _user_cache.invalidate(user_id)
+    return result
+
+
+async def _settle_paid_action(db: firestore.Client, user_id: int, token: str, *, refund: bool) -> int:
+    ref = _user_ref(db, user_id)
+
+    def _body(transaction: Any):
+        snap = yield ref
+        if not snap.exists:
+            return 0
+        before = snap.to_dict() or {}
+        reservation = (before.get("ai_reservations") or {}).get(token)
+        if not reservation:
+            return 0
+
+        updates: Dict[str, Any] = {"ai_reservations": {token: firestore.DELETE_FIELD}}
+        if before.get("active_ai_lock") == reservation.get("action_key"):
+            updates["active_ai_lock"] = firestore.DELETE_FIELD
+            updates["active_ai_lock_at"] = firestore.DELETE_FIELD
+
+        amount = _as_int(reservation.get("price", 0)) if refund else 0
+        if amount:
+            updates["balance"] = _as_int(before.get("balance", 0)) + amount
+            _stage_user_stats_delta(db, transaction, before, _apply_fields(before, {"balance": updates["balance"]}))
+        transaction.set(ref, updates, merge=True)
+        return amount
+
+    amount = await run_transaction(db, _body)
+    _user_cache.invalidate(user_id)
+    return amount
+
+
+@track_firestore_operation
+async def commit_paid_action(db: firestore.Client, user_id: int, token: str) -> None:
+    """Keep the debit of a reservation and release its lock. Safe to call twice."""
+    try:
+        await _settle_paid_action(db, user_id, token, refund=False)
+    except Exception as exc:
+        logger.warning(
+            "PAID_ACTION_COMMIT_FAILED user_id=%s token=%s error_type=%s error=%s",
+            user_id,
+            token,
+            type(exc).__name__,
+            exc,
+        )
+
+
+@track_firestore_operation
+async def refund_paid_action(db: firestore.Client, user_id: int, token: str) -> int:
+    """Return a reservation's debit and release its lock; returns the refunded amount.
+
+    Only the first call refunds, so retries cannot credit the user twice.
+    """
+    return await _settle_paid_action(db, user_id, token, refund=True)
+
+
+@track_firestore_operation
+async def release_ai_action_lock(db: firestore.Client, user_id: int, action_key: str | None = None) -> None:
+    ref = _user_ref(db, user_id)
+    release_fields = {
+        "active_ai_lock": firestore.DELETE_FIELD,
+        "active_ai_lock_at": firestore.DELETE_FIELD,
+    }
 
     try:
-        await asyncio.to_thread(_release_sync)
+        if action_key is not None:
+            snap = await read_document(db, ref)
+            data = snap.to_dict() or {} if snap.exists else {}
+            if data.get("active_ai_lock") != action_key:
+                return
+        await write_document(db, ref, release_fields, merge=True)
+        _user_cache.merge(user_id, release_fields)
     except Exception as exc:
         logger.warning(
             "AI_ACTION_LOCK_RELEASE_FAILED user_id=%s error_type=%s error=%s",
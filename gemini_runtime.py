@@ -1,17 +1,62 @@
 from __future__ import annotations
 
 import asyncio
+import collections
+import contextlib
 import ctypes
+import functools
 import gc
+import hashlib
+import heapq
+import itertools
 import logging
-from typing import Any
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import metrics
+from gemini_usage import record_usage
 
 
 GEMINI_TIMEOUT_SECONDS = 60
-_gemini_semaphore = asyncio.Semaphore(1)
 _MAX_PENDING_REQUESTS = 8
-_pending_requests = 0
 _MEMORY_PRESSURE_LIMIT_MB = 430.0
+_GEMINI_MAX_CONCURRENCY = max(1, int(os.getenv("GEMINI_MAX_CONCURRENCY", "3")))
+# Rough RSS cost of one in-flight request: fixed SDK/proto overhead plus a share per
+# thousand characters of prompt and expected response. Tune from GEMINI_REQUEST_FINISHED logs.
+_GEMINI_REQUEST_BASE_MB = float(os.getenv("GEMINI_REQUEST_BASE_MB", "8"))
+_GEMINI_MB_PER_1K_CHARS = float(os.getenv("GEMINI_MB_PER_1K_CHARS", "0.25"))
+_INLINE_MEDIA_COPIES = 3
+_GEMINI_DEFAULT_OUTPUT_CHARS = 3000
+# GEMINI_ASYNC=0 falls back to running the blocking SDK call in the default executor.
+_GEMINI_ASYNC = os.getenv("GEMINI_ASYNC", "1").strip().lower() not in {"0", "false", "no"}
+
+PRIORITY_PAID = "paid"
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+_PRIORITY_RANK = {PRIORITY_PAID: 0, PRIORITY_INTERACTIVE: 1, PRIORITY_BACKGROUND: 2}
+# Share of the pending-request cap each class may fill before it is shed.
+_PRIORITY_PENDING_SHARE = {PRIORITY_PAID: 1.0, PRIORITY_INTERACTIVE: 0.75, PRIORITY_BACKGROUND: 0.25}
+
+# Circuit breaker: open a model for CIRCUIT_OPEN_SECONDS when, over the last
+# CIRCUIT_WINDOW_SECONDS and at least CIRCUIT_MIN_CALLS calls, too many failed or were slow.
+_CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "60"))
+_CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+_CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+_CIRCUIT_SLOW_SECONDS = float(os.getenv("CIRCUIT_SLOW_SECONDS", "30"))
+_CIRCUIT_SLOW_RATE = float(os.getenv("CIRCUIT_SLOW_RATE", "0.5"))
+_CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+# Hedging: a request still waiting past the primary model's GEMINI_HEDGE_PERCENTILE latency
+# gets a second attempt on the next model, for at most GEMINI_HEDGE_BUDGET of the hedgeable
+# requests seen over the last GEMINI_HEDGE_WINDOW_SECONDS.
+_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0.9"))
+_HEDGE_BUDGET = float(os.getenv("GEMINI_HEDGE_BUDGET", "0.05"))
+_HEDGE_WINDOW_SECONDS = float(os.getenv("GEMINI_HEDGE_WINDOW_SECONDS", "300"))
+_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+_HEDGE_MIN_DELAY_SECONDS = 1.0
+_REQUEST_LATENCY = "karma_gemini_request_seconds"
+_FIRST_CHUNK_LATENCY = "karma_gemini_first_chunk_seconds"
 
 
 def rss_mb() -> float | None:
@@ -26,6 +71,44 @@ def rss_mb() -> float | None:
     return None
 
 
+_MEMORY_SAMPLE_INTERVAL_SECONDS = float(os.getenv("MEMORY_SAMPLE_INTERVAL_SECONDS", "15"))
+# Trim when RSS has grown this far above the level left by the previous trim...
+_MEMORY_TRIM_GROWTH_MB = float(os.getenv("MEMORY_TRIM_GROWTH_MB", "48"))
+# ...or when malloc holds this much free-but-unreturned heap, as a share of the heap.
+_MEMORY_TRIM_FREE_HEAP_MB = float(os.getenv("MEMORY_TRIM_FREE_HEAP_MB", "24"))
+_MEMORY_TRIM_FRAGMENTATION = float(os.getenv("MEMORY_TRIM_FRAGMENTATION", "0.35"))
+_MEMORY_TRIM_COOLDOWN_SECONDS = float(os.getenv("MEMORY_TRIM_COOLDOWN_SECONDS", "120"))
+_RECLAIMED_MB_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0)
+
+
+class _MallInfo2(ctypes.Structure):
+    _fields_ = [
+        (name, ctypes.c_size_t)
+        for name in ("arena", "ordblks", "smblks", "hblks", "hblkhd", "usmblks", "fsmblks", "uordblks", "fordblks", "keepcost")
+    ]
+
+
+def _load_mallinfo2() -> Any:
+    try:
+        mallinfo2 = ctypes.CDLL(None).mallinfo2
+    except (AttributeError, OSError):
+        return None
+    mallinfo2.restype = _MallInfo2
+    mallinfo2.argtypes = []
+    return mallinfo2
+
+
+_mallinfo2 = _load_mallinfo2()
+
+
+def malloc_heap_mb() -> tuple[float, float] | None:
+    """(in use, free but retained) heap size in MB, or None without glibc mallinfo2."""
+    if _mallinfo2 is None:
+        return None
+    info = _mallinfo2()
+    return info.uordblks / (1024 * 1024), info.fordblks / (1024 * 1024)
+
+
 def release_unused_memory() -> tuple[float | None, float | None]:
     before = rss_mb()
     gc.collect()
@@ -40,66 +123,895 @@ def _format_rss(value: float | None) -> str:
     return f"{value:.1f}" if value is not None else "unknown"
 
 
-async def memory_maintenance() -> None:
-    while True:
-        await asyncio.sleep(60 * 60)
-        before, after = await asyncio.to_thread(release_unused_memory)
+class MemoryGovernor:
+    """Sample RSS on an interval and trim the heap only when growth or fragmentation warrants it."""
+
+    def __init__(self) -> None:
+        self.rss_mb: float | None = None
+        self.baseline_mb: float | None = None
+        self.last_trim_at = float("-inf")
+        self._trim_lock = asyncio.Lock()
+
+    def sample(self) -> float | None:
+        self.rss_mb = rss_mb()
+        if self.baseline_mb is None:
+            self.baseline_mb = self.rss_mb
+        return self.rss_mb
+
+    def _trim_reason(self) -> str | None:
+        if self.rss_mb is None:
+            return None
+        if time.monotonic() - self.last_trim_at < _MEMORY_TRIM_COOLDOWN_SECONDS:
+            return None
+        if self.rss_mb >= _MEMORY_PRESSURE_LIMIT_MB:
+            return "pressure"
+        if self.baseline_mb is not None and self.rss_mb - self.baseline_mb >= _MEMORY_TRIM_GROWTH_MB:
+            return "growth"
+        heap = malloc_heap_mb()
+        if heap is not None:
+            used, free = heap
+            if free >= _MEMORY_TRIM_FREE_HEAP_MB and free / max(used + free, 1.0) >= _MEMORY_TRIM_FRAGMENTATION:
+                return "fragmentation"
+        return None
+
+    async def trim(self, reason: str) -> tuple[float | None, float | None]:
+        async with self._trim_lock:
+            started = time.perf_counter()
+            before, after = await asyncio.to_thread(release_unused_memory)
+            elapsed = time.perf_counter() - started
+            self.rss_mb = after
+            self.baseline_mb = after
+            self.last_trim_at = time.monotonic()
+
+        reclaimed = max(0.0, before - after) if before is not None and after is not None else 0.0
+        metrics.registry.inc("karma_memory_trims_total", reason=reason)
+        metrics.registry.observe("karma_memory_trim_seconds", elapsed, reason=reason)
+        metrics.registry.observe("karma_memory_trim_reclaimed_mb", reclaimed, buckets=_RECLAIMED_MB_BUCKETS, reason=reason)
         logging.info(
-            "MEMORY_MAINTENANCE rss_before_mb=%s rss_after_mb=%s",
+            "MEMORY_TRIM reason=%s rss_before_mb=%s rss_after_mb=%s reclaimed_mb=%.1f seconds=%.3f",
+            reason,
             _format_rss(before),
             _format_rss(after),
+            reclaimed,
+            elapsed,
+        )
+        return before, after
+
+    async def run(self) -> None:
+        while True:
+            self.sample()
+            reason = self._trim_reason()
+            if reason is not None:
+                await self.trim(reason)
+            await asyncio.sleep(_MEMORY_SAMPLE_INTERVAL_SECONDS)
+
+
+_governor = MemoryGovernor()
+
+
+def current_rss_mb() -> float | None:
+    """Most recent RSS sample; reads /proc only until the governor has taken its first one."""
+    if _governor.rss_mb is None:
+        return _governor.sample()
+    return _governor.rss_mb
+
+
+async def memory_governor() -> None:
+    await _governor.run()
+
+
+def _collect_memory_metrics() -> None:
+    if _governor.rss_mb is not None:
+        metrics.registry.set_gauge("karma_process_rss_mb", _governor.rss_mb)
+    heap = malloc_heap_mb()
+    if heap is not None:
+        metrics.registry.set_gauge("karma_malloc_heap_mb", heap[0], state="used")
+        metrics.registry.set_gauge("karma_malloc_heap_mb", heap[1], state="free")
+
+
+metrics.registry.add_collector(_collect_memory_metrics)
+
+
+def _content_chars(content: Any) -> int:
+    if isinstance(content, str):
+        return len(content)
+    if isinstance(content, dict):
+        return sum(_content_chars(value) for value in content.values())
+    if isinstance(content, (list, tuple)):
+        return sum(_content_chars(part) for part in content)
+    return 0
+
+
+def _inline_bytes(content: Any) -> int:
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return len(content)
+    if isinstance(content, dict):
+        return sum(_inline_bytes(value) for value in content.values())
+    if isinstance(content, (list, tuple)):
+        return sum(_inline_bytes(part) for part in content)
+    return 0
+
+
+def estimate_request_mb(content: Any, expected_output_chars: int | None = None) -> float:
+    """Expected RSS cost of one request, used as its admission weight."""
+    output_chars = expected_output_chars or _GEMINI_DEFAULT_OUTPUT_CHARS
+    # Inline media (voice notes) is held as bytes, then as its base64 copy in the request body.
+    media_mb = _inline_bytes(content) * _INLINE_MEDIA_COPIES / (1024 * 1024)
+    return _GEMINI_REQUEST_BASE_MB + media_mb + (_content_chars(content) + output_chars) * _GEMINI_MB_PER_1K_CHARS / 1000
+
+
+class GeminiShedError(RuntimeError):
+    """Raised when a request is rejected before reaching the model: queue overload or memory pressure."""
+
+
+class GeminiScheduler:
+    """Admit up to ``max_concurrency`` Gemini requests while their weights fit under the RSS limit.
+
+    A request is admitted when a slot is free and ``rss + reserved + weight`` stays below
+    ``memory_limit_mb``; a lone request is always admitted so the queue cannot stall.
+    Waiters are served by priority class (paid, interactive, background), then arrival
+    order; a waiter that does not fit yet is skipped rather than blocking those behind
+    it, and background work never takes the last free slot. Under overload lower classes
+    are refused first, and a paid request evicts the newest lower-class waiter.
+    Background work is capped by its own backlog, not by how busy the other classes are.
+    """
+
+    def __init__(self, max_concurrency: int, memory_limit_mb: float, max_pending: int) -> None:
+        self.max_concurrency = max_concurrency
+        self.memory_limit_mb = memory_limit_mb
+        self.max_pending = max_pending
+        self.inflight = 0
+        self.inflight_by_priority: dict[str, int] = dict.fromkeys(_PRIORITY_RANK, 0)
+        self.reserved_mb = 0.0
+        self.shed: dict[str, int] = dict.fromkeys(_PRIORITY_RANK, 0)
+        self._waiters: list[tuple[int, int, float, str, asyncio.Future[None]]] = []
+        self._sequence = itertools.count()
+
+    @property
+    def pending(self) -> int:
+        return self.inflight + len(self._waiters)
+
+    def queued(self, priority: str) -> int:
+        return sum(1 for entry in self._waiters if entry[3] == priority and not entry[4].done())
+
+    def _over_limit(self, priority: str) -> bool:
+        limit = self.max_pending * _PRIORITY_PENDING_SHARE[priority]
+        if priority == PRIORITY_BACKGROUND:
+            own_pending = self.inflight_by_priority[priority] + self.queued(priority)
+            return own_pending >= limit or self.pending >= self.max_pending
+        return self.pending >= limit
+
+    def _fits(self, weight_mb: float, priority: str) -> bool:
+        if self.inflight == 0:
+            return True
+        if self.inflight >= self.max_concurrency:
+            return False
+        if priority == PRIORITY_BACKGROUND and self.inflight >= self.max_concurrency - 1:
+            return False
+        current_rss = current_rss_mb()
+        if current_rss is None:
+            return True
+        return current_rss + self.reserved_mb + weight_mb <= self.memory_limit_mb
+
+    def _admit(self, weight_mb: float, priority: str) -> None:
+        self.inflight += 1
+        self.inflight_by_priority[priority] += 1
+        self.reserved_mb += weight_mb
+
+    def _shed(self, priority: str, reason: str) -> GeminiShedError:
+        self.shed[priority] += 1
+        metrics.registry.inc("karma_gemini_shed_total", priority=priority)
+        logging.warning("GEMINI_REQUEST_SHED priority=%s reason=%s pending=%s", priority, reason, self.pending)
+        return GeminiShedError(f"Gemini request queue is full ({reason})")
+
+    def _evict_lower(self, rank: int) -> bool:
+        victims = [entry for entry in self._waiters if entry[0] > rank and not entry[4].done()]
+        if not victims:
+            return False
+        victim = max(victims, key=lambda entry: (entry[0], entry[1]))
+        self._waiters.remove(victim)
+        heapq.heapify(self._waiters)
+        victim[4].set_exception(self._shed(victim[3], "evicted"))
+        return True
+
+    async def acquire(self, weight_mb: float, priority: str = PRIORITY_INTERACTIVE) -> None:
+        rank = _PRIORITY_RANK[priority]
+        if self._over_limit(priority):
+            if priority != PRIORITY_PAID or not self._evict_lower(rank):
+                raise self._shed(priority, "overload")
+
+        if not self._waiters and self._fits(weight_mb, priority):
+            self._admit(weight_mb, priority)
+            return
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        entry = (rank, next(self._sequence), weight_mb, priority, future)
+        heapq.heappush(self._waiters, entry)
+        # A free slot the waiters at the head cannot use may still fit this request.
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Admitted just before the cancellation landed: give the slot back. An evicted
+            # waiter's future holds an exception instead and never took a slot.
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release(weight_mb, priority)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self, weight_mb: float, priority: str) -> None:
+        self.inflight -= 1
+        self.inflight_by_priority[priority] -= 1
+        self.reserved_mb = self.reserved_mb - weight_mb if self.inflight else 0.0
+        self._wake()
+
+    def _wake(self) -> None:
+        remaining: list[tuple[int, int, float, str, asyncio.Future[None]]] = []
+        for entry in sorted(self._waiters):
+            _, _, weight_mb, priority, future = entry
+            if future.done():
+                continue
+            if not self._fits(weight_mb, priority):
+                remaining.append(entry)
+                continue
+            self._admit(weight_mb, priority)
+            future.set_result(None)
+        # A sorted list is already a valid heap.
+        self._waiters = remaining
+
+
+_scheduler = GeminiScheduler(_GEMINI_MAX_CONCURRENCY, _MEMORY_PRESSURE_LIMIT_MB, _MAX_PENDING_REQUESTS)
+
+
+def _collect_scheduler_metrics() -> None:
+    metrics.registry.set_gauge("karma_gemini_inflight", _scheduler.inflight)
+    for priority in _PRIORITY_RANK:
+        metrics.registry.set_gauge("karma_gemini_queued", _scheduler.queued(priority), priority=priority)
+    metrics.registry.set_gauge("karma_gemini_reserved_mb", _scheduler.reserved_mb)
+
+
+metrics.registry.add_collector(_collect_scheduler_metrics)
+
+
+class GeminiCircuitOpenError(RuntimeError):
+    """Raised when every model a router could use has an open circuit."""
+
+
+class CircuitBreaker:
+    """Closed -> open on a bad error or slow-call rate; half-open lets one probe call through."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._calls: collections.deque[tuple[float, bool, bool]] = collections.deque()
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < _CIRCUIT_OPEN_SECONDS:
+                return False
+            self._set_state(self.HALF_OPEN)
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def release(self, probe: bool) -> None:
+        """Forget an admitted call that ended without a verdict (shed or cancelled)."""
+        if probe:
+            self._probe_in_flight = False
+
+    def record(self, ok: bool, seconds: float, *, probe: bool = False) -> None:
+        """Count a finished call; ``probe`` marks the call ``allow`` let through while half-open."""
+        if probe:
+            self._probe_in_flight = False
+            if ok:
+                self._calls.clear()
+                self._set_state(self.CLOSED)
+            else:
+                self._open()
+            return
+        if self.state != self.CLOSED:
+            # Admitted before the circuit opened; only the probe decides when it closes.
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, ok, seconds >= _CIRCUIT_SLOW_SECONDS))
+        while self._calls and now - self._calls[0][0] > _CIRCUIT_WINDOW_SECONDS:
+            self._calls.popleft()
+        if self.state != self.CLOSED or len(self._calls) < _CIRCUIT_MIN_CALLS:
+            return
+        failures = sum(1 for _, call_ok, _ in self._calls if not call_ok)
+        slow = sum(1 for _, _, call_slow in self._calls if call_slow)
+        if failures / len(self._calls) >= _CIRCUIT_ERROR_RATE or slow / len(self._calls) >= _CIRCUIT_SLOW_RATE:
+            self._open()
+
+    def _open(self) -> None:
+        self.opened_at = time.monotonic()
+        self._calls.clear()
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logging.warning("GEMINI_CIRCUIT_%s model=%s", state.upper(), self.name)
+            self.state = state
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_CIRCUIT_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+
+def circuit_breaker(model: Any) -> CircuitBreaker:
+    """Breaker shared by every router that uses a model with this name."""
+    name = getattr(model, "model_name", type(model).__name__)
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+def _collect_circuit_metrics() -> None:
+    for name, breaker in _breakers.items():
+        metrics.registry.set_gauge("karma_gemini_circuit_state", _CIRCUIT_STATE_VALUES[breaker.state], model=name)
+
+
+metrics.registry.add_collector(_collect_circuit_metrics)
+
+
+class HedgeBudget:
+    """Allow hedges for at most ``ratio`` of the requests seen in the last ``window_seconds``.
+
+    A sliding window keeps hours of healthy traffic from banking an allowance that an
+    outage would then spend hedging nearly every request.
+    """
+
+    def __init__(self, ratio: float, window_seconds: float) -> None:
+        self.ratio = ratio
+        self.window_seconds = window_seconds
+        self._requests: collections.deque[float] = collections.deque()
+        self._hedges: collections.deque[float] = collections.deque()
+
+    def _trim(self, now: float) -> None:
+        cutoff = now - self.window_seconds
+        for window in (self._requests, self._hedges):
+            while window and window[0] < cutoff:
+                window.popleft()
+
+    def record_request(self) -> None:
+        now = time.monotonic()
+        self._trim(now)
+        self._requests.append(now)
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._hedges) + 1 > self.ratio * len(self._requests):
+            return False
+        self._hedges.append(now)
+        return True
+
+
+_hedge_budget = HedgeBudget(_HEDGE_BUDGET, _HEDGE_WINDOW_SECONDS)
+
+
+def _hedge_delay(model: Any, latency_metric: str) -> float | None:
+    """Seconds after which to hedge a request to ``model``, or None without enough samples."""
+    name = getattr(model, "model_name", type(model).__name__)
+    if metrics.registry.observation_count(latency_metric, model=name) < _HEDGE_MIN_SAMPLES:
+        return None
+    threshold = metrics.registry.quantile(latency_metric, _HEDGE_PERCENTILE, model=name)
+    return max(threshold, _HEDGE_MIN_DELAY_SECONDS) if threshold is not None else None
+
+
+async def _single(request: Awaitable[Any]) -> AsyncIterator[Any]:
+    yield await request
+
+
+class _Attempt:
+    """One model's try at a routed request, with its first item fetched in a task."""
+
+    def __init__(self, model: Any, stream: AsyncIterator[Any], *, probe: bool) -> None:
+        self.model = model
+        self.breaker = circuit_breaker(model)
+        self.probe = probe
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.first: asyncio.Future[Any] = asyncio.ensure_future(stream.__anext__())
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def record(self, ok: bool) -> None:
+        self.breaker.record(ok, self.elapsed(), probe=self.probe)
+
+    def release(self) -> None:
+        self.breaker.release(self.probe)
+
+    async def abandon(self) -> None:
+        self.first.cancel()
+        with contextlib.suppress(BaseException):
+            await self.first
+        with contextlib.suppress(Exception):
+            await self.stream.aclose()
+        self.release()
+
+
+class ModelRouter:
+    """Send requests to the first model whose circuit admits them, failing over down the list.
+
+    Pass a router anywhere generate_content or stream_content accepts a model. A failed
+    call counts against that model's breaker and is retried on the next model; shed
+    requests and cancellations are not model failures and propagate unchanged. With
+    ``hedge=True`` a request that outlives the primary's latency percentile is also sent
+    to the next model, and whichever answers first wins.
+    """
+
+    def __init__(self, models: list[Any]) -> None:
+        self.models = [model for model in models if model is not None]
+        if not self.models:
+            raise ValueError("ModelRouter needs at least one model")
+
+    @property
+    def model_name(self) -> str:
+        return getattr(self.models[0], "model_name", type(self.models[0]).__name__)
+
+    def _failed(self, attempt: _Attempt, exc: BaseException) -> None:
+        attempt.record(False)
+        metrics.registry.inc("karma_gemini_model_failures_total", model=attempt.breaker.name)
+        logging.warning(
+            "GEMINI_MODEL_FAILED model=%s error_type=%s error=%s",
+            attempt.breaker.name,
+            type(exc).__name__,
+            exc,
         )
 
+    async def _route(
+        self,
+        open_stream: Callable[[Any], AsyncIterator[Any]],
+        *,
+        hedge: bool,
+        latency_metric: str,
+    ) -> AsyncIterator[Any]:
+        remaining = iter(self.models)
+
+        def launch() -> _Attempt | None:
+            for model in remaining:
+                breaker = circuit_breaker(model)
+                if breaker.allow():
+                    # allow() only admits a call while half-open when it is that state's probe.
+                    return _Attempt(model, open_stream(model), probe=breaker.state == CircuitBreaker.HALF_OPEN)
+            return None
+
+        first = launch()
+        if first is None:
+            raise GeminiCircuitOpenError("All Gemini models have an open circuit")
+        pending = [first]
+        hedge_after = None
+        if hedge and len(self.models) > 1:
+            _hedge_budget.record_request()
+            hedge_after = _hedge_delay(first.model, latency_metric)
+
+        winner: _Attempt | None = None
+        try:
+            while winner is None:
+                timeout = None
+                if hedge_after is not None:
+                    timeout = max(0.0, hedge_after - first.elapsed())
+                done, _ = await asyncio.wait(
+                    [attempt.first for attempt in pending],
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    hedge_after = None
+                    if _hedge_budget.take():
+                        backup = launch()
+                        if backup is not None:
+                            pending.append(backup)
+                            metrics.registry.inc("karma_gemini_hedges_total", model=first.breaker.name)
+                            logging.info("GEMINI_HEDGE from_model=%s to_model=%s", first.breaker.name, backup.breaker.name)
+                    continue
 
-async def generate_content(model: Any, content: Any, **kwargs: Any) -> Any:
-    """Run one bounded Gemini request at a time on the small Render instance."""
-    global _pending_requests
-    if _pending_requests >= _MAX_PENDING_REQUESTS:
-        logging.warning("GEMINI_QUEUE_FULL pending=%s", _pending_requests)
-        raise RuntimeError("Gemini request queue is full")
-    _pending_requests += 1
+                last_error: BaseException | None = None
+                last_failed = first
+                for attempt in [attempt for attempt in pending if attempt.first in done]:
+                    error = attempt.first.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner = attempt
+                        break
+                    pending.remove(attempt)
+                    if isinstance(error, GeminiShedError):
+                        attempt.release()
+                        raise error
+                    self._failed(attempt, error)
+                    last_error, last_failed = error, attempt
 
+                if winner is None and not pending:
+                    backup = launch()
+                    if backup is None:
+                        raise last_error or GeminiCircuitOpenError("All Gemini models have an open circuit")
+                    source = last_failed.breaker.name
+                    metrics.registry.inc("karma_gemini_failovers_total", from_model=source, to_model=backup.breaker.name)
+                    logging.warning("GEMINI_FAILOVER from_model=%s to_model=%s", source, backup.breaker.name)
+                    pending.append(backup)
+        finally:
+            for attempt in pending:
+                if attempt is not winner:
+                    await attempt.abandon()
+
+        if winner is not first and len(pending) > 1:
+            metrics.registry.inc("karma_gemini_hedge_wins_total", model=winner.breaker.name)
+        if isinstance(winner.first.exception(), StopAsyncIteration):
+            winner.record(True)
+            return
+
+        try:
+            yield winner.first.result()
+            async for item in winner.stream:
+                yield item
+        except (GeminiShedError, asyncio.CancelledError, GeneratorExit):
+            winner.release()
+            raise
+        except Exception as exc:
+            self._failed(winner, exc)
+            raise
+        finally:
+            with contextlib.suppress(Exception):
+                await winner.stream.aclose()
+        winner.record(True)
+
+    async def generate_content(self, content: Any, *, hedge: bool = False, **kwargs: Any) -> Any:
+        routed = self._route(
+            lambda model: _single(_generate_content(model, content, **kwargs)),
+            hedge=hedge,
+            latency_metric=_REQUEST_LATENCY,
+        )
+        # Drain the single-item stream so the winning model's success is recorded.
+        responses = [response async for response in routed]
+        return responses[0]
+
+    async def stream_content(self, content: Any, *, hedge: bool = False, **kwargs: Any) -> AsyncIterator[str]:
+        """Fail over or hedge only until the first chunk arrives; later errors propagate to the caller."""
+        routed = self._route(
+            lambda model: stream_content(model, content, **kwargs),
+            hedge=hedge,
+            latency_metric=_FIRST_CHUNK_LATENCY,
+        )
+        async with contextlib.aclosing(routed) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+
+def _uses_async_api(model: Any) -> bool:
+    return _GEMINI_ASYNC and callable(getattr(model, "generate_content_async", None))
+
+
+async def _call_model(model: Any, content: Any, request_options: dict[str, Any], kwargs: dict[str, Any]) -> Any:
+    if _uses_async_api(model):
+        # The coroutine owns the RPC, so wait_for cancelling it on timeout cancels the call itself.
+        request = model.generate_content_async(content, request_options=request_options, **kwargs)
+    else:
+        # A timed-out thread keeps running until the SDK's own deadline fires.
+        request = asyncio.to_thread(model.generate_content, content, request_options=request_options, **kwargs)
+    return await asyncio.wait_for(request, timeout=GEMINI_TIMEOUT_SECONDS + 5)
+
+
+@contextlib.asynccontextmanager
+async def _admitted(model_name: str, weight_mb: float, priority: str) -> AsyncIterator[None]:
+    queued_at = time.perf_counter()
+    await _scheduler.acquire(weight_mb, priority)
+    metrics.registry.observe("karma_gemini_queue_wait_seconds", time.perf_counter() - queued_at, priority=priority)
+
+    try:
+        current_rss = current_rss_mb()
+        if current_rss is not None and current_rss >= _MEMORY_PRESSURE_LIMIT_MB:
+            before, after = await _governor.trim("pressure")
+            logging.warning(
+                "MEMORY_PRESSURE_BEFORE_GEMINI model=%s rss_before_mb=%s rss_after_mb=%s",
+                model_name,
+                _format_rss(before),
+                _format_rss(after),
+            )
+            if after is not None and after >= _MEMORY_PRESSURE_LIMIT_MB:
+                raise GeminiShedError("Gemini skipped due to high memory pressure")
+        yield
+    finally:
+        _scheduler.release(weight_mb, priority)
+
+
+def _log_request_started(model_name: str, priority: str, transport: str, weight_mb: float) -> None:
+    logging.info(
+        "GEMINI_REQUEST_STARTED model=%s priority=%s transport=%s rss_mb=%s weight_mb=%.1f inflight=%s reserved_mb=%.1f",
+        model_name,
+        priority,
+        transport,
+        _format_rss(current_rss_mb()),
+        weight_mb,
+        _scheduler.inflight,
+        _scheduler.reserved_mb,
+    )
+
+
+def _log_request_finished(model_name: str, started: float) -> None:
+    logging.info(
+        "GEMINI_REQUEST_FINISHED model=%s seconds=%.2f rss_mb=%s",
+        model_name,
+        time.perf_counter() - started,
+        _format_rss(current_rss_mb()),
+    )
+
+
+def _request_options(kwargs: dict[str, Any]) -> dict[str, Any]:
     request_options = dict(kwargs.pop("request_options", {}) or {})
     request_options.setdefault("timeout", GEMINI_TIMEOUT_SECONDS)
-    model_name = getattr(model, "model_name", type(model).__name__)
+    return request_options
 
+
+def _chunk_text(chunk: Any) -> str:
     try:
-        async with _gemini_semaphore:
-            current_rss = rss_mb()
-            if current_rss is not None and current_rss >= _MEMORY_PRESSURE_LIMIT_MB:
-                before, after = await asyncio.to_thread(release_unused_memory)
-                logging.warning(
-                    "MEMORY_PRESSURE_BEFORE_GEMINI model=%s rss_before_mb=%s rss_after_mb=%s",
-                    model_name,
-                    _format_rss(before),
-                    _format_rss(after),
-                )
-                if after is not None and after >= _MEMORY_PRESSURE_LIMIT_MB:
-                    raise RuntimeError("Gemini skipped due to high memory pressure")
+        return chunk.text or ""
+    except ValueError:
+        # Chunks without text parts (safety stops, finish markers) raise on ``.text``.
+        return ""
+
+
+def _outcome(exc: BaseException) -> str:
+    if isinstance(exc, GeminiShedError):
+        return "shed"
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(exc, (asyncio.CancelledError, GeneratorExit)):
+        return "cancelled"
+    return "error"
+
+
+def _hash_content(digest: Any, content: Any) -> None:
+    if isinstance(content, str):
+        digest.update(b"s" + content.encode("utf-8"))
+    elif isinstance(content, (bytes, bytearray, memoryview)):
+        digest.update(b"b" + bytes(content))
+    elif isinstance(content, dict):
+        for key in sorted(content, key=str):
+            digest.update(b"k" + str(key).encode("utf-8"))
+            _hash_content(digest, content[key])
+    elif isinstance(content, (list, tuple)):
+        digest.update(b"[")
+        for part in content:
+            _hash_content(digest, part)
+        digest.update(b"]")
+    else:
+        # Uploaded files and SDK protos; their repr carries the file name or the fields.
+        digest.update(b"r" + repr(content).encode("utf-8"))
+
+
+def _coalesce_key(model: Any, content: Any, priority: str, kwargs: dict[str, Any]) -> tuple[int, str, str]:
+    digest = hashlib.sha256()
+    _hash_content(digest, content)
+    digest.update(repr(sorted((key, repr(value)) for key, value in kwargs.items())).encode("utf-8"))
+    return id(model), priority, digest.hexdigest()
+
+
+class _SharedRequest:
+    """One in-flight Gemini call awaited by every identical request; cancelled when nobody waits."""
+
+    __slots__ = ("key", "task", "waiters")
+
+    def __init__(self, key: tuple[int, str, str], task: asyncio.Task) -> None:
+        self.key = key
+        self.task = task
+        self.waiters = 0
+        task.add_done_callback(lambda _: self.forget())
+
+    def forget(self) -> None:
+        if _inflight.get(self.key) is self:
+            del _inflight[self.key]
+
+    async def join(self) -> Any:
+        self.waiters += 1
+        try:
+            return await asyncio.shield(self.task)
+        finally:
+            self.waiters -= 1
+            if not self.waiters and not self.task.done():
+                # Unlist it now: the done callback runs a loop step later, and a request
+                # arriving in between must start a fresh call, not join a cancelled one.
+                self.forget()
+                self.task.cancel()
+
+
+_inflight: dict[tuple[int, str, str], _SharedRequest] = {}
+
+
+def _collect_coalesce_metrics() -> None:
+    metrics.registry.set_gauge("karma_gemini_coalesce_inflight", len(_inflight))
+
+
+metrics.registry.add_collector(_collect_coalesce_metrics)
+
+
+async def generate_content(
+    model: Any,
+    content: Any,
+    *,
+    priority: str = PRIORITY_INTERACTIVE,
+    expected_output_chars: int | None = None,
+    hedge: bool = False,
+    feature: str = "other",
+    coalesce: bool = True,
+    **kwargs: Any,
+) -> Any:
+    """Run a bounded Gemini request once the scheduler has room for it.
+
+    ``priority`` is one of PRIORITY_PAID, PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND.
+    ``expected_output_chars`` sizes the request's memory weight; large batch prompts
+    should pass it so they do not get admitted next to other heavy requests.
+    ``model`` may be a ModelRouter, which picks the model and fails over; ``hedge=True``
+    additionally races a slow request against the router's next model.
+    ``feature`` tags the call in the usage rollup (tokens, latency, outcome).
+    While an identical request (same model, priority, content and options) is in flight,
+    the call waits for its response instead of sending another; ``coalesce=False`` opts out.
+    """
+    request = functools.partial(
+        _generate_content,
+        model,
+        content,
+        priority=priority,
+        expected_output_chars=expected_output_chars,
+        hedge=hedge,
+        feature=feature,
+        **kwargs,
+    )
+    if not coalesce:
+        return await request()
 
-            logging.info("GEMINI_REQUEST_STARTED model=%s rss_mb=%s", model_name, _format_rss(rss_mb()))
+    key = _coalesce_key(model, content, priority, kwargs)
+    shared = _inflight.get(key)
+    if shared is None:
+        shared = _inflight[key] = _SharedRequest(key, asyncio.ensure_future(request()))
+        role = "leader"
+    else:
+        role = "follower"
+        logging.info("GEMINI_REQUEST_COALESCED feature=%s waiters=%s", feature, shared.waiters + 1)
+    metrics.registry.inc("karma_gemini_coalesce_requests_total", feature=feature, role=role)
+    return await shared.join()
+
+
+async def _generate_content(
+    model: Any,
+    content: Any,
+    *,
+    priority: str = PRIORITY_INTERACTIVE,
+    expected_output_chars: int | None = None,
+    hedge: bool = False,
+    feature: str = "other",
+    **kwargs: Any,
+) -> Any:
+    if isinstance(model, ModelRouter):
+        return await model.generate_content(
+            content,
+            priority=priority,
+            expected_output_chars=expected_output_chars,
+            hedge=hedge,
+            feature=feature,
+                **kwargs,
+        )
+
+    request_options = _request_options(kwargs)
+    model_name = getattr(model, "model_name", type(model).__name__)
+    weight_mb = estimate_request_mb(content, expected_output_chars)
+
+    queued_at = time.perf_counter()
+    outcome, usage_metadata = "error", None
+    try:
+        async with _admitted(model_name, weight_mb, priority):
+            _log_request_started(model_name, priority, "async" if _uses_async_api(model) else "thread", weight_mb)
+            started = time.perf_counter()
             try:
-                response = await asyncio.wait_for(
-                    asyncio.to_thread(
-                        model.generate_content,
-                        content,
-                        request_options=request_options,
-                        **kwargs,
-                    ),
-                    timeout=GEMINI_TIMEOUT_SECONDS + 5,
-                )
+                response = await _call_model(model, content, request_options, kwargs)
             except asyncio.TimeoutError:
                 logging.error("GEMINI_REQUEST_TIMEOUT model=%s", model_name)
+                metrics.registry.inc("karma_gemini_timeouts_total", model=model_name)
                 raise
             finally:
-                before, after = await asyncio.to_thread(release_unused_memory)
-                logging.info(
-                    "GEMINI_REQUEST_FINISHED model=%s rss_before_trim_mb=%s rss_after_trim_mb=%s",
-                    model_name,
-                    _format_rss(before),
-                    _format_rss(after),
-                )
+                _log_request_finished(model_name, started)
+        metrics.registry.observe(_REQUEST_LATENCY, time.perf_counter() - started, model=model_name)
+        outcome, usage_metadata = "ok", getattr(response, "usage_metadata", None)
+        return response
+    except BaseException as exc:
+        outcome = _outcome(exc)
+        raise
     finally:
-        _pending_requests -= 1
+        record_usage(feature, model_name, outcome, time.perf_counter() - queued_at, usage_metadata)
+
+
+async def stream_content(
+    model: Any,
+    content: Any,
+    *,
+    priority: str = PRIORITY_INTERACTIVE,
+    expected_output_chars: int | None = None,
+    hedge: bool = False,
+    feature: str = "other",
+    **kwargs: Any,
+) -> AsyncIterator[str]:
+    """Like generate_content, but yield text pieces as Gemini produces them.
 
-    return response
+    The scheduler slot is held until the generator is exhausted or closed, so callers
+    that may stop early should wrap it in ``contextlib.aclosing``. Without the async
+    SDK path the whole response is yielded as a single piece.
+    """
+    if isinstance(model, ModelRouter):
+        routed = model.stream_content(
+            content,
+            priority=priority,
+            expected_output_chars=expected_output_chars,
+            hedge=hedge,
+            feature=feature,
+                **kwargs,
+        )
+        async with contextlib.aclosing(routed) as chunks:
+            async for chunk in chunks:
+                yield chunk
+        return
+
+    request_options = _request_options(kwargs)
+    model_name = getattr(model, "model_name", type(model).__name__)
+    weight_mb = estimate_request_mb(content, expected_output_chars)
+
+    queued_at = time.perf_counter()
+    outcome, usage_metadata = "error", None
+    try:
+        async with _admitted(model_name, weight_mb, priority):
+            streaming = _uses_async_api(model)
+            _log_request_started(model_name, priority, "stream" if streaming else "thread", weight_mb)
+            started = time.perf_counter()
+            first_chunk = True
+            try:
+                if not streaming:
+                    response = await _call_model(model, content, request_options, kwargs)
+                    usage_metadata = getattr(response, "usage_metadata", None)
+                    text = _chunk_text(response)
+                    if text:
+                        yield text
+                else:
+                    response = await asyncio.wait_for(
+                        model.generate_content_async(content, stream=True, request_options=request_options, **kwargs),
+                        timeout=GEMINI_TIMEOUT_SECONDS + 5,
+                    )
+                    chunks = response.__aiter__()
+                    while True:
+                        try:
+                            # Bounds the gap between chunks; the request_options timeout bounds the whole stream.
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=GEMINI_TIMEOUT_SECONDS + 5)
+                        except StopAsyncIteration:
+                            break
+                        # Each chunk carries the running totals; the last one has the final counts.
+                        usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                        text = _chunk_text(chunk)
+                        if not text:
+                            continue
+                        if first_chunk:
+                            first_chunk = False
+                            metrics.registry.observe(_FIRST_CHUNK_LATENCY, time.perf_counter() - started, model=model_name)
+                        yield text
+            except asyncio.TimeoutError:
+                logging.error("GEMINI_REQUEST_TIMEOUT model=%s", model_name)
+                metrics.registry.inc("karma_gemini_timeouts_total", model=model_name)
+                raise
+            finally:
+                _log_request_finished(model_name, started)
+        outcome = "ok"
+    except BaseException as exc:
+        outcome = _outcome(exc)
+        raise
+    finally:
+        record_usage(feature, model_name, outcome, time.perf_counter() - queued_at, usage_metadata)
@@ -0,0 +1,64 @@
+"""Gemini usage per feature, model and outcome: aggregated in memory, flushed to ``gemini_usage/{day}``."""
+
+import logging
+from datetime import datetime, timezone
+from typing import Any
+
+from firebase_admin import firestore
+
+import metrics
+from firebase_db import add_gemini_usage
+
+_USAGE_FIELDS = ("calls", "prompt_tokens", "cached_tokens", "output_tokens", "seconds")
+
+_usage: dict[tuple[str, str, str], dict[str, float]] = {}
+
+
+def _token_counts(usage_metadata: Any) -> tuple[int, int, int]:
+    """Prompt, cached (a subset of prompt) and output token counts."""
+    if usage_metadata is None:
+        return 0, 0, 0
+    prompt_tokens = getattr(usage_metadata, "prompt_token_count", 0) or 0
+    cached_tokens = getattr(usage_metadata, "cached_content_token_count", 0) or 0
+    output_tokens = getattr(usage_metadata, "candidates_token_count", 0) or 0
+    return int(prompt_tokens), int(cached_tokens), int(output_tokens)
+
+
+def record_usage(feature: str, model_name: str, outcome: str, seconds: float, usage_metadata: Any = None) -> None:
+    prompt_tokens, cached_tokens, output_tokens = _token_counts(usage_metadata)
+    metrics.registry.inc("karma_gemini_calls_total", feature=feature, model=model_name, outcome=outcome)
+    metrics.registry.inc("karma_gemini_tokens_total", prompt_tokens, feature=feature, kind="prompt")
+    metrics.registry.inc("karma_gemini_tokens_total", cached_tokens, feature=feature, kind="cached")
+    metrics.registry.inc("karma_gemini_tokens_total", output_tokens, feature=feature, kind="output")
+    metrics.registry.observe("karma_gemini_feature_seconds", seconds, feature=feature)
+
+    totals = _usage.setdefault((feature, model_name, outcome), dict.fromkeys(_USAGE_FIELDS, 0))
+    totals["calls"] += 1
+    totals["prompt_tokens"] += prompt_tokens
+    totals["cached_tokens"] += cached_tokens
+    totals["output_tokens"] += output_tokens
+    totals["seconds"] += seconds
+
+
+def _merge_back(rows: dict[tuple[str, str, str], dict[str, float]]) -> None:
+    for key, totals in rows.items():
+        target = _usage.setdefault(key, dict.fromkeys(_USAGE_FIELDS, 0))
+        for field, value in totals.items():
+            target[field] += value
+
+
+async def flush_gemini_usage(db: firestore.Client) -> int:
+    """Add the usage collected since the last flush to today's rollup; returns the rows written."""
+    if not _usage:
+        return 0
+    rows = dict(_usage)
+    _usage.clear()
+    day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    try:
+        await add_gemini_usage(db, day, rows)
+    except Exception as exc:
+        _merge_back(rows)
+        logging.warning("GEMINI_USAGE_FLUSH_FAILED rows=%s error_type=%s error=%s", len(rows), type(exc).__name__, exc)
+        return 0
+    logging.info("GEMINI_USAGE_FLUSHED day=%s rows=%s", day, len(rows))
+    return len(rows)
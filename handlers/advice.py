@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import logging
 import os
 from typing import Any
 
@@ -11,19 +12,19 @@ from firebase_admin import firestore
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
 from firebase_db import (
-    InsufficientBalanceError,
-    claim_ai_action_lock,
-    ensure_user,
-    get_balance,
-    get_user_language,
-    increment_balance,
+    UserDoc,
+    commit_paid_action,
+    load_user_doc,
     log_chat_message,
+    refund_paid_action,
     release_ai_action_lock,
+    reserve_paid_action,
 )
 from handlers.payment import send_stars_invoice
 from keyboards import CB_ADVICE, back_to_menu_kb, main_menu_kb
 from lexicon import get_text
-from gemini_runtime import generate_content
+from utils.telegram_stream import stream_to_chat
+from gemini_runtime import PRIORITY_PAID, stream_content
 
 router = Router()
 
@@ -88,60 +89,40 @@ def _advice_format_prompt(lang: str, target_language: str) -> str:
     )
 
 
-async def _gemini_text(model: Any, prompt: str) -> str:
-    try:
-        resp = await generate_content(model, prompt, safety_settings=SAFETY_SETTINGS)
-        if not resp or not hasattr(resp, "candidates") or not resp.candidates:
-            return ""
-        return resp.text.strip()
-    except Exception as e:
-        print(f"Advice Gen Error: {e}")
-        return ""
-
-
 @router.callback_query(F.data == CB_ADVICE)
-async def ask_advice_start(callback: CallbackQuery, state: FSMContext, db: firestore.Client) -> None:
+async def ask_advice_start(
+    callback: CallbackQuery,
+    state: FSMContext,
+    db: firestore.Client,
+    user_doc: UserDoc | None = None,
+) -> None:
     if not callback.from_user:
         return
-    await ensure_user(
-        db,
-        user_id=callback.from_user.id,
-        username=callback.from_user.username or "",
-        first_name=callback.from_user.first_name or "",
-    )
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
 
-    lang = await get_user_language(db, callback.from_user.id)
+    lang = user_doc.language
     action_key = "advice"
-    if not await claim_ai_action_lock(db, callback.from_user.id, action_key):
+    is_admin = callback.from_user.id in ADMIN_IDS
+    reservation = await reserve_paid_action(db, callback.from_user.id, action_key, 0 if is_admin else ADVICE_PRICE)
+
+    if reservation.status == "locked":
         await callback.answer(get_text(lang, "magic_wait"), show_alert=True)
         return
 
     await callback.answer()
-    is_admin = callback.from_user.id in ADMIN_IDS
 
-    if not is_admin:
-        balance = await get_balance(db, callback.from_user.id)
-        if balance < ADVICE_PRICE:
-            await release_ai_action_lock(db, callback.from_user.id, action_key)
-            await send_stars_invoice(
-                callback=callback,
-                title=get_text(lang, "invoice_advice_title"),
-                description=get_text(lang, "invoice_advice_desc"),
-                amount_stars=ADVICE_PRICE,
-                payload=f"advice:{ADVICE_PRICE}",
-            )
-            return
-
-        try:
-            await increment_balance(db, callback.from_user.id, -ADVICE_PRICE)
-        except InsufficientBalanceError:
-            if callback.message:
-                await callback.message.answer(get_text(lang, "error_payment"))
-            await release_ai_action_lock(db, callback.from_user.id, action_key)
-            return
+    if reservation.status == "insufficient":
+        await send_stars_invoice(
+            callback=callback,
+            title=get_text(lang, "invoice_advice_title"),
+            description=get_text(lang, "invoice_advice_desc"),
+            amount_stars=ADVICE_PRICE,
+            payload=f"advice:{ADVICE_PRICE}",
+        )
+        return
 
     await state.set_state(AdviceStates.waiting_for_question)
-    await state.update_data(price=ADVICE_PRICE, action_key=action_key)
+    await state.update_data(price=ADVICE_PRICE, action_key=action_key, reservation=reservation.token)
 
     if callback.message:
         await callback.message.answer(
@@ -151,16 +132,23 @@ async def ask_advice_start(callback: CallbackQuery, state: FSMContext, db: fires
 
 
 @router.message(AdviceStates.waiting_for_question)
-async def advice_process(message: Message, state: FSMContext, advice_model: Any, db: firestore.Client) -> None:
+async def advice_process(
+    message: Message,
+    state: FSMContext,
+    advice_model: Any,
+    db: firestore.Client,
+    user_doc: UserDoc | None = None,
+) -> None:
     if not message.from_user:
         return
 
-    lang = await get_user_language(db, message.from_user.id)
+    user_doc = user_doc or await load_user_doc(db, message.from_user)
+    lang = user_doc.language
     user_text = message.text or get_text(lang, "default_advice_request")
 
     data = await state.get_data()
     action_key = data.get("action_key", "advice")
-    price = data.get("price", 1)
+    reservation = data.get("reservation")
 
     msg = await message.answer(get_text(lang, "loading_advice"), reply_markup=ReplyKeyboardRemove(), parse_mode="HTML")
 
@@ -173,31 +161,52 @@ async def advice_process(message: Message, state: FSMContext, advice_model: Any,
         + format_prompt
     )
 
-    text = await _gemini_text(advice_model, prompt)
+    current_img = IMAGES_ADVICE.get(lang, IMAGES_ADVICE["uk"])
+
+    async def show_answer() -> Message:
+        return await message.answer_photo(photo=current_img, caption=get_text(lang, "universe_answer"), parse_mode="HTML")
 
-    await msg.delete()
+    try:
+        text = await stream_to_chat(
+            message,
+            stream_content(
+                advice_model,
+                prompt,
+                priority=PRIORITY_PAID,
+                hedge=True,
+                feature="advice",
+                safety_settings=SAFETY_SETTINGS,
+            ),
+            placeholder=msg,
+            on_start=show_answer,
+        )
+    except Exception:
+        logging.exception("ADVICE_GENERATION_FAILED user_id=%s", message.from_user.id)
+        text = ""
 
     if not text:
-        is_admin = message.from_user.id in ADMIN_IDS
         refund_note = ""
-        if not is_admin:
+        settled = False
+        if reservation:
             try:
-                await increment_balance(db, message.from_user.id, price)
-                refund_note = get_text(lang, "refund_note").format(price=price)
+                refunded = await refund_paid_action(db, message.from_user.id, reservation)
+                settled = True
             except Exception:
-                pass
+                refunded = 0
+            if refunded:
+                refund_note = get_text(lang, "refund_note").format(price=refunded)
 
         silent_msg = get_text(lang, "universe_silent")
         await message.answer(f"{silent_msg} {refund_note}".strip(), reply_markup=main_menu_kb(lang), parse_mode="HTML")
-        await release_ai_action_lock(db, message.from_user.id, action_key)
+        if not settled:
+            await release_ai_action_lock(db, message.from_user.id, action_key)
         await state.clear()
         return
 
-    current_img = IMAGES_ADVICE.get(lang, IMAGES_ADVICE["uk"])
-    await message.answer_photo(photo=current_img, caption=get_text(lang, "universe_answer"), parse_mode="HTML")
-
-    await message.answer(text, parse_mode="HTML")
     await log_chat_message(db, message.from_user.id, "bot", text)
     await message.answer(get_text(lang, "more_action_btn"), reply_markup=main_menu_kb(lang), parse_mode="HTML")
-    await release_ai_action_lock(db, message.from_user.id, action_key)
+    if reservation:
+        await commit_paid_action(db, message.from_user.id, reservation)
+    else:
+        await release_ai_action_lock(db, message.from_user.id, action_key)
     await state.clear()
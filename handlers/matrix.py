@@ -11,13 +11,25 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import CallbackQuery, Message, BufferedInputFile
 from firebase_admin import firestore
 
-from firebase_db import claim_ai_action_lock, get_user_language, log_chat_message, release_ai_action_lock, get_balance, increment_balance
+from firebase_db import (
+    UserDoc,
+    claim_ai_action_lock,
+    commit_paid_action,
+    consume_matrix_free_slot,
+    load_user_doc,
+    log_chat_message,
+    refund_paid_action,
+    release_ai_action_lock,
+    reserve_paid_action,
+    update_user_fields,
+)
 from handlers.admin import ADMIN_IDS
 from keyboards import back_to_menu_kb, matrix_upsell_kb, matrix_saved_dob_kb, CB_MATRIX_FINANCE, CB_MATRIX_LOVE, CB_MATRIX_CLOSE, CB_MATRIX_USE_SAVED, CB_MATRIX_BUY_SLOT
 from lexicon import get_text
 from utils.matrix_math import calculate_matrix
 from utils.matrix_image import generate_matrix_image
-from gemini_runtime import generate_content
+from gemini_runtime import PRIORITY_INTERACTIVE, PRIORITY_PAID
+from matrix_cache import CHANNEL_BASE, get_matrix_interpretation
 
 router = Router()
 
@@ -29,11 +41,12 @@ class MatrixStates(StatesGroup):
 
 
 @router.callback_query(F.data == CB_MATRIX)
-async def start_matrix(callback: CallbackQuery, state: FSMContext, db: firestore.Client) -> None:
+async def start_matrix(callback: CallbackQuery, state: FSMContext, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
 
-    lang = await get_user_language(db, callback.from_user.id)
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
     
     action_key = "matrix_base"
     locked = await claim_ai_action_lock(db, callback.from_user.id, action_key)
@@ -44,9 +57,7 @@ async def start_matrix(callback: CallbackQuery, state: FSMContext, db: firestore
     await state.set_state(MatrixStates.waiting_for_dob)
     await state.update_data(action_key=action_key)
 
-    doc = await asyncio.to_thread(lambda: db.collection("users").document(str(callback.from_user.id)).get())
-    user_data = doc.to_dict() or {}
-    saved_dob = user_data.get("matrix_dob")
+    saved_dob = user_doc.matrix_dob
 
     if saved_dob:
         text = get_text(lang, "matrix_intro_saved").format(dob=saved_dob)
@@ -77,12 +88,10 @@ async def start_matrix(callback: CallbackQuery, state: FSMContext, db: firestore
     await callback.answer()
 
 
-async def _execute_saved_dob_logic(message: Message, clean_dob: str, user_id: int, state: FSMContext, db: firestore.Client, tarot_model: Any, lang: str):
-    doc_ref = db.collection("users").document(str(user_id))
-    doc = await asyncio.to_thread(lambda: doc_ref.get())
-    user_data = doc.to_dict() or {}
-    
-    last_req = user_data.get("matrix_last_own_req")
+async def _execute_saved_dob_logic(message: Message, clean_dob: str, user_doc: UserDoc, state: FSMContext, db: firestore.Client, tarot_model: Any):
+    user_id = user_doc.user_id
+    lang = user_doc.language
+    last_req = user_doc.matrix_last_own_req
     if last_req and user_id not in ADMIN_IDS:
         now = datetime.datetime.now(datetime.timezone.utc)
         diff = now - last_req
@@ -90,7 +99,7 @@ async def _execute_saved_dob_logic(message: Message, clean_dob: str, user_id: in
             await message.answer(get_text(lang, "matrix_limit_own"), parse_mode="HTML")
             return
             
-    await asyncio.to_thread(lambda: doc_ref.set({"matrix_last_own_req": firestore.SERVER_TIMESTAMP}, merge=True))
+    await update_user_fields(db, user_id, {"matrix_last_own_req": firestore.SERVER_TIMESTAMP})
     
     data = await state.get_data()
     action_key = data.get("action_key", "matrix_base")
@@ -99,16 +108,12 @@ async def _execute_saved_dob_logic(message: Message, clean_dob: str, user_id: in
 
 
 @router.callback_query(F.data == CB_MATRIX_USE_SAVED, MatrixStates.waiting_for_dob)
-async def use_saved_dob(callback: CallbackQuery, state: FSMContext, db: firestore.Client, tarot_model: Any) -> None:
+async def use_saved_dob(callback: CallbackQuery, state: FSMContext, db: firestore.Client, tarot_model: Any, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
         
-    user_id = callback.from_user.id
-    lang = await get_user_language(db, user_id)
-    
-    doc = await asyncio.to_thread(lambda: db.collection("users").document(str(user_id)).get())
-    user_data = doc.to_dict() or {}
-    clean_dob = user_data.get("matrix_dob")
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    clean_dob = user_doc.matrix_dob
     
     if not clean_dob:
         await callback.answer("Дані втрачено", show_alert=True)
@@ -126,16 +131,17 @@ async def use_saved_dob(callback: CallbackQuery, state: FSMContext, db: firestor
         async def answer_photo(self, *args, **kwargs):
             return await self._msg.answer_photo(*args, **kwargs)
             
-    await _execute_saved_dob_logic(FakeMessage(callback.message, clean_dob), clean_dob, user_id, state, db, tarot_model, lang)
+    await _execute_saved_dob_logic(FakeMessage(callback.message, clean_dob), clean_dob, user_doc, state, db, tarot_model)
 
 
 @router.message(MatrixStates.waiting_for_dob)
-async def process_dob(message: Message, state: FSMContext, db: firestore.Client, tarot_model: Any) -> None:
+async def process_dob(message: Message, state: FSMContext, db: firestore.Client, tarot_model: Any, user_doc: UserDoc | None = None) -> None:
     if not message.from_user or not message.text:
         return
 
     user_id = message.from_user.id
-    lang = await get_user_language(db, user_id)
+    user_doc = user_doc or await load_user_doc(db, message.from_user)
+    lang = user_doc.language
     dob_str = message.text.strip()
 
     try:
@@ -151,24 +157,21 @@ async def process_dob(message: Message, state: FSMContext, db: firestore.Client,
         )
         return
 
-    doc_ref = db.collection("users").document(str(user_id))
-    doc = await asyncio.to_thread(lambda: doc_ref.get())
-    user_data = doc.to_dict() or {}
-    saved_dob = user_data.get("matrix_dob")
+    saved_dob = user_doc.matrix_dob
 
     if not saved_dob:
         # First time ever saving dob! It's free.
-        await asyncio.to_thread(lambda: doc_ref.set({"matrix_dob": clean_dob}, merge=True))
-        await _execute_saved_dob_logic(message, clean_dob, user_id, state, db, tarot_model, lang)
+        await update_user_fields(db, user_id, {"matrix_dob": clean_dob})
+        await _execute_saved_dob_logic(message, clean_dob, user_doc, state, db, tarot_model)
         return
     elif clean_dob == saved_dob:
         # Repeating their own date. Fallback to use_saved_dob logic (3 day limit).
-        await _execute_saved_dob_logic(message, clean_dob, user_id, state, db, tarot_model, lang)
+        await _execute_saved_dob_logic(message, clean_dob, user_doc, state, db, tarot_model)
         return
     else:
-        # Foreign date logic
-        matrix_free_slots = int(user_data.get("matrix_free_slots", 2))
-        if matrix_free_slots <= 0 and user_id not in ADMIN_IDS:
+        # Foreign date logic: consume a slot against the stored count, not the snapshot
+        consumed = await consume_matrix_free_slot(db, user_id)
+        if not consumed and user_id not in ADMIN_IDS:
             from keyboards import matrix_limit_foreign_kb
             await message.answer(
                 get_text(lang, "matrix_limit_foreign"),
@@ -176,9 +179,6 @@ async def process_dob(message: Message, state: FSMContext, db: firestore.Client,
                 parse_mode="HTML"
             )
             return
-            
-        # Consume slot
-        await asyncio.to_thread(lambda: doc_ref.set({"matrix_free_slots": matrix_free_slots - 1}, merge=True))
         
         data = await state.get_data()
         action_key = data.get("action_key", "matrix_base")
@@ -188,13 +188,6 @@ async def process_dob(message: Message, state: FSMContext, db: firestore.Client,
 async def _process_matrix_generation(message: Message, clean_dob: str, user_id: int, state: FSMContext, db: firestore.Client, tarot_model: Any, lang: str, action_key: str):
     processing_msg = await message.answer(get_text(lang, "matrix_processing"), parse_mode="HTML")
 
-    prompt_lang_map = {
-        "uk": "українською мовою",
-        "en": "англійською мовою (in English)",
-        "ru": "російською мовою"
-    }
-    prompt_lang = prompt_lang_map.get(lang, "українською мовою")
-
     try:
         matrix = calculate_matrix(clean_dob)
         
@@ -203,20 +196,11 @@ async def _process_matrix_generation(message: Message, clean_dob: str, user_id:
 
         # 1. Генерація зображення (Pillow)
 
-        # 2. Генерація тексту (Gemini)
-        prompt = (
-            f"Я розрахував Матрицю Долі для людини, яка народилася {clean_dob}.\n"
-            f"Основні аркани:\n"
-            f"- Портрет (як людину бачить соціум): Аркан {matrix['portrait']}\n"
-            f"- Характер/Центр (основа особистості): Аркан {matrix['center']}\n\n"
-            f"Напиши містичну, глибоку, але сучасну розшифровку цих двох енергій (Портрет і Характер). "
-            f"Використовуй езотеричний, але зрозумілий стиль. Форматування має бути красивим, з емодзі. "
-            f"Відповідай {prompt_lang}. Звертайся до людини на 'ти'. Обсяг: приблизно 200-250 слів."
+        # 2. Текст розбору: з кешу інтерпретацій або Gemini
+        reply_text = await get_matrix_interpretation(
+            db, tarot_model, matrix, CHANNEL_BASE, lang, priority=PRIORITY_INTERACTIVE
         )
 
-        response = await generate_content(tarot_model, prompt)
-        reply_text = response.text
-
         if not reply_text:
             raise ValueError("Empty response from AI")
 
@@ -246,41 +230,19 @@ async def _process_matrix_generation(message: Message, clean_dob: str, user_id:
         await state.set_state(None)
 
 
-async def execute_matrix_upsell(user_id: int, message: Message, channel: str, dob: str, matrix: dict, db: firestore.Client, tarot_model: Any, lang: str):
+async def execute_matrix_upsell(user_id: int, message: Message, channel: str, dob: str, matrix: dict, db: firestore.Client, tarot_model: Any, lang: str, reservation: str):
     """
     Виконує безпосередню генерацію Upsell розбору (фінанси або стосунки).
-    Викликається з handlers/matrix.py або з handlers/payment.py
+    Викликається з handlers/matrix.py або з handlers/payment.py після reserve_paid_action;
+    резерв підтверджується після успіху або повертається при помилці.
     """
-    action_key = f"matrix_upsell_{channel}"
-    locked = await claim_ai_action_lock(db, user_id, action_key)
-    if not locked:
-        await message.answer(get_text(lang, "error_energy_flows"), parse_mode="HTML")
-        return
-
     processing_msg = await message.answer(get_text(lang, "matrix_upsell_processing"), parse_mode="HTML")
 
-    prompt_lang_map = {
-        "uk": "українською мовою",
-        "en": "англійською мовою (in English)",
-        "ru": "російською мовою"
-    }
-    prompt_lang = prompt_lang_map.get(lang, "українською мовою")
-
     try:
-        topic_key = "matrix_topic_finance" if channel == "finance" else "matrix_topic_love"
-        topic = get_text(lang, topic_key)
-        
-        prompt = (
-            f"Я розрахував Матрицю Долі для людини, яка народилася {dob}.\n"
-            f"Аркани: Портрет {matrix.get('portrait')}, Талант {matrix.get('talent')}, "
-            f"Карма {matrix.get('karma')}, Соціум {matrix.get('social')}, Центр {matrix.get('center')}.\n\n"
-            f"Зроби глибокий аналіз {topic} на основі цих енергій. "
-            f"Відповідай {prompt_lang}. Стиль: сучасна містика. Обсяг: приблизно 200-250 слів."
+        reply_text = await get_matrix_interpretation(
+            db, tarot_model, matrix, channel, lang, priority=PRIORITY_PAID
         )
 
-        response = await generate_content(tarot_model, prompt)
-        reply_text = response.text
-
         await processing_msg.edit_text(reply_text, reply_markup=matrix_upsell_kb(lang), parse_mode="HTML")
         
         await log_chat_message(db, user_id, "user", f"[Matrix Upsell {channel}]")
@@ -288,28 +250,27 @@ async def execute_matrix_upsell(user_id: int, message: Message, channel: str, do
 
     except Exception as e:
         logging.error(f"Matrix upsell error for user {user_id}: {e}", exc_info=True)
+        await refund_paid_action(db, user_id, reservation)
         await processing_msg.edit_text(get_text(lang, "error_energy_flows"), parse_mode="HTML")
-        await increment_balance(db, user_id, MATRIX_UPSELL_PRICE) # Refund
-    finally:
-        await release_ai_action_lock(db, user_id, action_key)
+    else:
+        await commit_paid_action(db, user_id, reservation)
 
 
 @router.callback_query(F.data.in_([CB_MATRIX_FINANCE, CB_MATRIX_LOVE]))
-async def handle_matrix_upsell(callback: CallbackQuery, state: FSMContext, db: firestore.Client, tarot_model: Any) -> None:
+async def handle_matrix_upsell(callback: CallbackQuery, state: FSMContext, db: firestore.Client, tarot_model: Any, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
         
     user_id = callback.from_user.id
-    lang = await get_user_language(db, user_id)
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
     
     data = await state.get_data()
     dob = data.get("dob")
     matrix = data.get("matrix")
     
     if not dob:
-        doc = await asyncio.to_thread(lambda: db.collection("users").document(str(user_id)).get())
-        user_data = doc.to_dict() or {}
-        dob = user_data.get("matrix_dob")
+        dob = user_doc.matrix_dob
         
     if not dob:
         await callback.answer(get_text(lang, "matrix_data_lost_alert"), show_alert=True)
@@ -322,8 +283,14 @@ async def handle_matrix_upsell(callback: CallbackQuery, state: FSMContext, db: f
     
     from handlers.payment import send_stars_invoice
     
-    balance = await get_balance(db, user_id)
-    if balance < MATRIX_UPSELL_PRICE and user_id not in ADMIN_IDS:
+    price = 0 if user_id in ADMIN_IDS else MATRIX_UPSELL_PRICE
+    reservation = await reserve_paid_action(db, user_id, f"matrix_upsell_{channel}", price)
+
+    if reservation.status == "locked":
+        await callback.answer(get_text(lang, "error_energy_flows"), show_alert=True)
+        return
+
+    if reservation.status == "insufficient":
         title_key = "matrix_btn_finance" if channel == "finance" else "matrix_btn_love"
         desc_key = "matrix_desc_finance" if channel == "finance" else "matrix_desc_love"
         await send_stars_invoice(
@@ -334,27 +301,24 @@ async def handle_matrix_upsell(callback: CallbackQuery, state: FSMContext, db: f
             payload=f"matrix:{channel}:{MATRIX_UPSELL_PRICE}"
         )
         return
-        
-    # Списуємо баланс (зроблено вручну, адміни безкоштовно)
-    if user_id not in ADMIN_IDS:
-        await increment_balance(db, user_id, -MATRIX_UPSELL_PRICE)
-    
+
     # Прибираємо клавіатуру на поточному повідомленні
     try:
         await callback.message.edit_reply_markup(reply_markup=None)
     except Exception:
         pass
         
-    await execute_matrix_upsell(user_id, callback.message, channel, dob, matrix, db, tarot_model, lang)
+    await execute_matrix_upsell(user_id, callback.message, channel, dob, matrix, db, tarot_model, lang, reservation.token)
     await callback.answer()
 
 
 @router.callback_query(F.data == CB_MATRIX_CLOSE)
-async def matrix_close_handler(callback: CallbackQuery, db: firestore.Client, state: FSMContext) -> None:
+async def matrix_close_handler(callback: CallbackQuery, db: firestore.Client, state: FSMContext, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
 
-    lang = await get_user_language(db, callback.from_user.id)
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
     
     # Прибираємо кнопку Назад, залишаємо канали
     try:
@@ -373,12 +337,12 @@ async def matrix_close_handler(callback: CallbackQuery, db: firestore.Client, st
 
 
 @router.callback_query(F.data == CB_MATRIX_BUY_SLOT)
-async def handle_matrix_buy_slot(callback: CallbackQuery, db: firestore.Client) -> None:
+async def handle_matrix_buy_slot(callback: CallbackQuery, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
         
-    user_id = callback.from_user.id
-    lang = await get_user_language(db, user_id)
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
     
     from handlers.payment import send_stars_invoice
     
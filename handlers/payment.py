@@ -7,7 +7,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, LabeledPrice, Message, PreCheckoutQuery
 from firebase_admin import firestore
 
-from firebase_db import ensure_user, increment_balance, get_user_language, claim_ai_action_lock
+from firebase_db import UserDoc, add_matrix_free_slots, increment_balance, load_user_doc, reserve_paid_action
 from lexicon import get_text
 from keyboards import back_to_menu_kb
 
@@ -49,23 +49,24 @@ async def pre_checkout(pre_checkout_query: PreCheckoutQuery) -> None:
 
 
 @router.message(F.successful_payment)
-async def successful_payment(message: Message, state: FSMContext, db: firestore.Client, tarot_model=None) -> None:
+async def successful_payment(
+    message: Message,
+    state: FSMContext,
+    db: firestore.Client,
+    tarot_model=None,
+    user_doc: UserDoc | None = None,
+) -> None:
     sp = message.successful_payment
     if not sp or not message.from_user:
         return
 
-    await ensure_user(
-        db,
-        user_id=message.from_user.id,
-        username=message.from_user.username or "",
-        first_name=message.from_user.first_name or "",
-    )
+    user_doc = user_doc or await load_user_doc(db, message.from_user)
 
     total_amount = int(sp.total_amount or 0)
     if total_amount > 0:
         await increment_balance(db, message.from_user.id, total_amount)
 
-    lang = await get_user_language(db, message.from_user.id)
+    lang = user_doc.language
     payload = sp.invoice_payload or ""
 
     if total_amount > 0:
@@ -102,12 +103,19 @@ async def successful_payment(message: Message, state: FSMContext, db: firestore.
         price = int(parts[2])
         action_key = f"reading:{reading_key}"
         
-        # Миттєво списуємо суму
-        await increment_balance(db, message.from_user.id, -price)
-        await claim_ai_action_lock(db, message.from_user.id, action_key)
+        # Миттєво резервуємо суму
+        reservation = await reserve_paid_action(db, message.from_user.id, action_key, price)
+        if not reservation.reserved:
+            await message.answer(get_text(lang, f"paid_action_{reservation.status}"), reply_markup=back_to_menu_kb(lang), parse_mode="HTML")
+            return
         
         await state.set_state(ReadingStates.waiting_for_context)
-        await state.update_data(reading_key=reading_key, price=price, action_key=action_key)
+        await state.update_data(
+            reading_key=reading_key,
+            price=price,
+            action_key=action_key,
+            reservation=reservation.token,
+        )
         
         prompt_key = "ask_love_context" if reading_key == "relationship" else "ask_career_context"
         
@@ -123,12 +131,14 @@ async def successful_payment(message: Message, state: FSMContext, db: firestore.
         price = int(payload.split(":")[1])
         action_key = "advice"
         
-        # Миттєво списуємо суму
-        await increment_balance(db, message.from_user.id, -price)
-        await claim_ai_action_lock(db, message.from_user.id, action_key)
+        # Миттєво резервуємо суму
+        reservation = await reserve_paid_action(db, message.from_user.id, action_key, price)
+        if not reservation.reserved:
+            await message.answer(get_text(lang, f"paid_action_{reservation.status}"), reply_markup=back_to_menu_kb(lang), parse_mode="HTML")
+            return
         
         await state.set_state(AdviceStates.waiting_for_question)
-        await state.update_data(price=price, action_key=action_key)
+        await state.update_data(price=price, action_key=action_key, reservation=reservation.token)
         
         await message.answer(
             f"<b>Баланс поповнено!</b>\n\n{get_text(lang, 'ask_question')}",
@@ -143,25 +153,25 @@ async def successful_payment(message: Message, state: FSMContext, db: firestore.
         channel = parts[1]
         price = int(parts[2])
         
-        await increment_balance(db, message.from_user.id, -price)
-        
         data = await state.get_data()
         dob = data.get("dob")
         matrix = data.get("matrix")
         
+        # Без даних Матриці зірки залишаються на балансі
         if not dob or not matrix:
             await message.answer(get_text(lang, "matrix_payment_success_data_lost"), parse_mode="HTML")
             return
+
+        reservation = await reserve_paid_action(db, message.from_user.id, f"matrix_upsell_{channel}", price)
+        if not reservation.reserved:
+            await message.answer(get_text(lang, f"paid_action_{reservation.status}"), reply_markup=back_to_menu_kb(lang), parse_mode="HTML")
+            return
             
-        await execute_matrix_upsell(message.from_user.id, message, channel, dob, matrix, db, tarot_model, lang)
+        await execute_matrix_upsell(message.from_user.id, message, channel, dob, matrix, db, tarot_model, lang, reservation.token)
         return
 
     elif payload.startswith("matrix_slot:"):
-        doc_ref = db.collection("users").document(str(message.from_user.id))
-        doc = await asyncio.to_thread(lambda: doc_ref.get())
-        user_data = doc.to_dict() or {}
-        slots = int(user_data.get("matrix_free_slots", 2))
-        await asyncio.to_thread(lambda: doc_ref.set({"matrix_free_slots": slots + 1}, merge=True))
+        await add_matrix_free_slots(db, message.from_user.id)
         
         await message.answer(
             "<b>Успіх!</b> Ти відкрив 1 додатковий слот для розрахунку нової дати.\nПовертайся в меню і натискай «Матриця Долі».",
@@ -1,5 +1,6 @@
 import html
 import logging
+from dataclasses import replace
 from urllib.parse import urlencode
 
 from aiogram import F, Router
@@ -10,8 +11,9 @@ from firebase_admin import firestore
 
 from firebase_db import (
     REFERRAL_DAILY_BONUS,
+    UserDoc,
     bind_referrer,
-    ensure_user,
+    load_user_doc,
     release_ai_action_lock,
     update_horoscope_enabled,
     update_user_language,
@@ -255,16 +257,13 @@ def _horoscope_settings_kb(lang: str, enabled: bool) -> InlineKeyboardMarkup:
     )
 
 
-async def _render_horoscope_settings(callback: CallbackQuery, db: firestore.Client) -> None:
+async def _render_horoscope_settings(callback: CallbackQuery, user_doc: UserDoc) -> None:
     if not callback.from_user or not callback.message:
         return
 
-    user_id = str(callback.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    user_data = doc.to_dict() or {}
-    lang = user_data.get("language", "uk")
-    enabled = bool(user_data.get("horoscope_enabled", True))
-    current_zodiac = user_data.get("zodiac_sign", "all")
+    lang = user_doc.language
+    enabled = user_doc.horoscope_enabled
+    current_zodiac = user_doc.zodiac_sign
     zodiac_dict = get_text(lang, "zodiacs")
     zodiac_name = zodiac_dict.get(current_zodiac, zodiac_dict.get("all"))
     text = _horoscope_settings_text(lang, zodiac_name, enabled)
@@ -277,19 +276,14 @@ async def _render_horoscope_settings(callback: CallbackQuery, db: firestore.Clie
 
 
 @router.message(CommandStart())
-async def command_start(message: Message, db: firestore.Client) -> None:
+async def command_start(message: Message, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not message.from_user:
         return
 
     await release_ai_action_lock(db, message.from_user.id)
 
     try:
-        is_new = await ensure_user(
-            db,
-            user_id=message.from_user.id,
-            username=message.from_user.username or "",
-            first_name=message.from_user.first_name or "",
-        )
+        user_doc = user_doc or await load_user_doc(db, message.from_user)
     except Exception as exc:
         logging.warning(
             "START_ENSURE_USER_FAILED user_id=%s error_type=%s error=%s",
@@ -302,7 +296,7 @@ async def command_start(message: Message, db: firestore.Client) -> None:
         )
         return
 
-    if is_new:
+    if user_doc.is_new:
         from handlers.admin import ADMIN_IDS
         logging.info("New user registered: %s", message.from_user.id)
         
@@ -334,16 +328,18 @@ async def command_start(message: Message, db: firestore.Client) -> None:
 
 @router.callback_query(F.data.startswith("set_lang:"))
 @router.callback_query(F.data.startswith(f"{LANG_PROFILE_PREFIX}:"))
-async def process_language_selection(callback: CallbackQuery, db: firestore.Client) -> None:
+async def process_language_selection(callback: CallbackQuery, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
 
     callback_prefix, lang = callback.data.split(":", 1)
     await update_user_language(db, callback.from_user.id, lang)
     await callback.answer(get_text(lang, "lang_saved"))
+    if user_doc is not None:
+        user_doc = replace(user_doc, language=lang)
 
     if callback_prefix == LANG_PROFILE_PREFIX:
-        await profile(callback, db)
+        await profile(callback, db, user_doc)
         return
 
     current_text = callback.message.text or callback.message.caption or ""
@@ -354,7 +350,7 @@ async def process_language_selection(callback: CallbackQuery, db: firestore.Clie
         "выберите язык",
     ]
     if not any(marker in lowered for marker in choose_language_markers):
-        await profile(callback, db)
+        await profile(callback, db, user_doc)
         return
 
     await callback.message.delete()
@@ -381,14 +377,13 @@ async def process_language_selection(callback: CallbackQuery, db: firestore.Clie
 
 
 @router.callback_query(F.data == CB_PROFILE)
-async def profile(callback: CallbackQuery, db: firestore.Client) -> None:
+async def profile(callback: CallbackQuery, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user:
         return
 
     user_id = str(callback.from_user.id)
     try:
-        doc = db.collection("users").document(user_id).get()
-        user_data = doc.to_dict() or {}
+        user_doc = user_doc or await load_user_doc(db, callback.from_user)
     except Exception as exc:
         logging.warning(
             "PROFILE_LOAD_FAILED user_id=%s error_type=%s error=%s",
@@ -403,11 +398,11 @@ async def profile(callback: CallbackQuery, db: firestore.Client) -> None:
         await callback.answer()
         return
 
-    lang = user_data.get("language", "uk")
-    balance = int(user_data.get("balance", 0) or 0)
-    current_zodiac = user_data.get("zodiac_sign", "all")
-    referral_rewards_total = int(user_data.get("referral_rewards_total", 0) or 0)
-    referrals_count = int(user_data.get("referrals_count", 0) or 0)
+    lang = user_doc.language
+    balance = user_doc.balance
+    current_zodiac = user_doc.zodiac_sign
+    referral_rewards_total = user_doc.referral_rewards_total
+    referrals_count = user_doc.referrals_count
 
     zodiac_dict = get_text(lang, "zodiacs")
     zodiac_name = zodiac_dict.get(current_zodiac, zodiac_dict.get("all"))
@@ -436,14 +431,12 @@ async def profile(callback: CallbackQuery, db: firestore.Client) -> None:
 
 
 @router.callback_query(F.data == CB_CHANGE_LANGUAGE)
-async def change_language_from_profile(callback: CallbackQuery, db: firestore.Client) -> None:
+async def change_language_from_profile(callback: CallbackQuery, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
 
-    user_id = str(callback.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    user_data = doc.to_dict() or {}
-    lang = user_data.get("language", "uk")
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
 
     await callback.message.edit_text(
         _localized(_LANGUAGE_PROMPT, lang),
@@ -454,14 +447,12 @@ async def change_language_from_profile(callback: CallbackQuery, db: firestore.Cl
 
 
 @router.callback_query(F.data == CB_INVITE_FRIEND)
-async def invite_friend(callback: CallbackQuery, db: firestore.Client) -> None:
+async def invite_friend(callback: CallbackQuery, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
 
-    user_id = str(callback.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    user_data = doc.to_dict() or {}
-    lang = user_data.get("language", "uk")
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
 
     me = await callback.bot.get_me()
     if not me.username:
@@ -496,13 +487,12 @@ async def invite_friend(callback: CallbackQuery, db: firestore.Client) -> None:
 
 
 @router.callback_query(F.data == CB_BACK_MENU)
-async def back_to_menu_handler(callback: CallbackQuery, db: firestore.Client, state: FSMContext) -> None:
+async def back_to_menu_handler(callback: CallbackQuery, db: firestore.Client, state: FSMContext, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user:
         return
 
-    user_id = str(callback.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    lang = doc.to_dict().get("language", "uk") if doc.exists else "uk"
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
 
     await release_ai_action_lock(db, callback.from_user.id)
     await state.clear()
@@ -523,53 +513,50 @@ async def back_to_menu_handler(callback: CallbackQuery, db: firestore.Client, st
 
 
 @router.callback_query(F.data == CB_CHANGE_ZODIAC)
-async def setup_zodiac(callback: CallbackQuery, db: firestore.Client) -> None:
+async def setup_zodiac(callback: CallbackQuery, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user:
         return
 
-    await _render_horoscope_settings(callback, db)
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    await _render_horoscope_settings(callback, user_doc)
     await callback.answer()
 
 
 @router.callback_query(F.data == CB_TOGGLE_HOROSCOPE)
-async def toggle_horoscope_delivery(callback: CallbackQuery, db: firestore.Client) -> None:
+async def toggle_horoscope_delivery(callback: CallbackQuery, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user:
         return
 
-    user_id = str(callback.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    user_data = doc.to_dict() or {}
-    lang = user_data.get("language", "uk")
-    current = bool(user_data.get("horoscope_enabled", True))
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
+    current = user_doc.horoscope_enabled
     await update_horoscope_enabled(db, callback.from_user.id, not current)
-    await _render_horoscope_settings(callback, db)
+    await _render_horoscope_settings(callback, replace(user_doc, horoscope_enabled=not current))
     await callback.answer(_horoscope_status_text(lang, not current))
 
 
 @router.callback_query(F.data.startswith("set_zodiac:"))
-async def process_set_zodiac(callback: CallbackQuery, db: firestore.Client) -> None:
+async def process_set_zodiac(callback: CallbackQuery, db: firestore.Client, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user:
         return
 
     zodiac = callback.data.split(":")[1]
     await update_user_zodiac(db, callback.from_user.id, zodiac)
 
-    user_id = str(callback.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    lang = doc.to_dict().get("language", "uk") if doc.exists else "uk"
+    user_doc = replace(user_doc or await load_user_doc(db, callback.from_user), zodiac_sign=zodiac)
+    lang = user_doc.language
 
     await callback.answer(get_text(lang, "zodiac_saved"))
-    await _render_horoscope_settings(callback, db)
+    await _render_horoscope_settings(callback, user_doc)
 
 
 @router.callback_query(F.data == CB_CLOSE)
-async def close_menu_handler(callback: CallbackQuery, db: firestore.Client, state: FSMContext) -> None:
+async def close_menu_handler(callback: CallbackQuery, db: firestore.Client, state: FSMContext, user_doc: UserDoc | None = None) -> None:
     if not callback.from_user or not callback.message:
         return
 
-    user_id = str(callback.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    lang = doc.to_dict().get("language", "uk") if doc.exists else "uk"
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
+    lang = user_doc.language
 
     await state.clear()
     await release_ai_action_lock(db, callback.from_user.id)
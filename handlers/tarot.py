@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 import asyncio
+import io
+import logging
 import os
-import tempfile
 from datetime import datetime
-from typing import Any
+from typing import Any, AsyncIterator
 
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
@@ -12,33 +13,38 @@ from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from aiogram import F, Router
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import CallbackQuery, Message, ReplyKeyboardRemove
+from aiogram.types import CallbackQuery, Message, ReplyKeyboardRemove, Voice
 from firebase_admin import firestore
 
+from daily_card_pool import pop_daily_card
 from firebase_db import (
     REFERRAL_DAILY_BONUS,
-    InsufficientBalanceError,
-    claim_ai_action_lock,
+    UserDoc,
     claim_daily_card_slot,
+    commit_paid_action,
     complete_daily_card_slot,
-    ensure_user,
-    get_balance,
     get_user_language,
     grant_referral_bonus_for_daily_card,
-    increment_balance,
     log_chat_message,
     release_ai_action_lock,
+    load_user_doc,
+    refund_paid_action,
     release_daily_card_slot,
+    reserve_paid_action,
 )
 from handlers.payment import send_stars_invoice
 from keyboards import CB_CAREER, CB_DAILY, CB_RELATIONSHIP, back_to_menu_kb, main_menu_kb
 from lexicon import get_text
-from gemini_runtime import GEMINI_TIMEOUT_SECONDS, generate_content
+from prompts import TARGET_LANGUAGES, daily_card_prompt, tarot_format_prompt
+from utils.telegram_stream import stream_to_chat
+from gemini_runtime import GEMINI_TIMEOUT_SECONDS, PRIORITY_INTERACTIVE, PRIORITY_PAID, stream_content
 
 router = Router()
 
 RELATIONSHIP_PRICE = 75
 CAREER_PRICE = 100
+# Gemini rejects requests over 20 MB; larger voice notes go through the File API instead.
+_INLINE_AUDIO_MAX_BYTES = int(os.getenv("GEMINI_INLINE_AUDIO_MAX_BYTES", str(15 * 1024 * 1024)))
 
 _admin_env = os.getenv("ADMIN_IDS", "469764985")
 ADMIN_IDS = [int(x.strip()) for x in _admin_env.split(",") if x.strip().isdigit()]
@@ -75,106 +81,59 @@ _REFERRAL_BONUS_NOTICE = {
 }
 
 
-HEADING_GUIDE = {
-    "uk": {
-        "cards": "Карти",
-        "reading": "Твій розклад",
-        "advice": "Порада від Karma",
-        "affirmation": "Афірмація",
-    },
-    "en": {
-        "cards": "Cards",
-        "reading": "Your reading",
-        "advice": "Advice from Karma",
-        "affirmation": "Affirmation",
-    },
-    "ru": {
-        "cards": "Карты",
-        "reading": "Твой расклад",
-        "advice": "Совет от Karma",
-        "affirmation": "Аффирмация",
-    },
-}
-
-
 class ReadingStates(StatesGroup):
     waiting_for_context = State()
 
 
-def _heading_guide(lang: str) -> dict[str, str]:
-    return HEADING_GUIDE.get(lang, HEADING_GUIDE["uk"])
-
-
-def _tarot_format_prompt(lang: str, target_language: str) -> str:
-    headings = _heading_guide(lang)
-    return (
-        f"Write the entire response only in {target_language}. Do not mix languages. "
-        f"Use Telegram HTML only. Do not use Markdown. "
-        f"Keep the emojis exactly as shown. Keep exactly one empty line after each heading and one empty line between blocks. "
-        f"Return the answer in exactly this structure:\n\n"
-        f"🪄 <b>{headings['cards']}:</b>\n\n"
-        f"[text]\n\n"
-        f"🧘 <b>{headings['reading']}:</b>\n\n"
-        f"[text]\n\n"
-        f"🕯 <b>{headings['advice']}:</b>\n\n"
-        f"[text]\n\n"
-        f"✨ <b>{headings['affirmation']}:</b>\n\n"
-        f"[text]\n\n"
-        f"The affirmation must also be fully in {target_language}."
-    )
+def _gemini_stream(model: Any, content: Any, priority: str, feature: str, *, hedge: bool = False) -> AsyncIterator[str]:
+    return stream_content(model, content, priority=priority, hedge=hedge, feature=feature, safety_settings=SAFETY_SETTINGS)
 
 
-async def _gemini_generate_text(model: Any, prompt: str) -> str:
-    try:
-        resp = await generate_content(model, prompt, safety_settings=SAFETY_SETTINGS)
-        if not resp or not hasattr(resp, "candidates") or not resp.candidates:
-            return ""
-        return resp.text.strip()
-    except Exception as e:
-        print(f"GenAI Text Error: {e}")
-        return ""
-
-
-async def _gemini_generate_with_audio(model: Any, prompt: str, audio_bytes: bytes) -> str:
-    fd, path = tempfile.mkstemp(suffix=".ogg")
-    os.close(fd)
-    try:
-        with open(path, "wb") as f:
-            f.write(audio_bytes)
-        uploaded = await asyncio.wait_for(
-            asyncio.to_thread(genai.upload_file, path),
-            timeout=GEMINI_TIMEOUT_SECONDS + 5,
-        )
-        resp = await generate_content(model, [prompt, uploaded], safety_settings=SAFETY_SETTINGS)
-        return resp.text.strip() if resp else ""
-    except Exception as e:
-        print(f"GenAI Audio Error: {e}")
-        return ""
-    finally:
-        try:
+class _DownloadChunks(list):
+    """``Bot.download_file`` destination that keeps the received chunks as they are."""
 
-            os.remove(path)
-        except OSError:
-            pass
+    def write(self, chunk: bytes) -> None:
+        self.append(chunk)
 
-async def _send_long(message: Message, text: str, reply_markup: Any = None, lang: str = "uk") -> None:
-    limit = 4000
-    chunks = [text[i : i + limit] for i in range(0, len(text), limit)]
-    for chunk in chunks:
-        await message.answer(chunk)
+    def flush(self) -> None:
+        pass
 
-    if reply_markup:
-        await message.answer(
-            get_text(lang, "more_action_btn"),
-            reply_markup=reply_markup,
-            parse_mode="HTML",
-        )
+    def seek(self, offset: int) -> None:
+        pass
+
+
+async def _voice_part(bot: Any, voice: Voice) -> Any:
+    """Voice note as an inline audio part; only notes above the inline limit go through the File API."""
+    mime_type = voice.mime_type or "audio/ogg"
+    file_info = await bot.get_file(voice.file_id)
+    chunks = _DownloadChunks()
+    await bot.download_file(file_info.file_path, destination=chunks)
+    # The SDK's Blob accepts only bytes, so the chunks are joined once instead of copied
+    # into a BytesIO and then out of it again.
+    data = b"".join(chunks)
+    chunks.clear()
+    if len(data) <= _INLINE_AUDIO_MAX_BYTES:
+        return {"mime_type": mime_type, "data": data}
+    # BytesIO shares ``data`` until written to, so the upload reads it without a copy.
+    return await asyncio.wait_for(
+        asyncio.to_thread(genai.upload_file, io.BytesIO(data), mime_type=mime_type),
+        timeout=GEMINI_TIMEOUT_SECONDS + 5,
+    )
+
+
+async def _send_menu(message: Message, reply_markup: Any, lang: str = "uk") -> None:
+    await message.answer(
+        get_text(lang, "more_action_btn"),
+        reply_markup=reply_markup,
+        parse_mode="HTML",
+    )
 
 
 async def _start_paid_reading(
     callback: CallbackQuery,
     state: FSMContext,
     db: firestore.Client,
+    user_doc: UserDoc | None,
     *,
     reading_key: str,
     price: int,
@@ -183,47 +142,37 @@ async def _start_paid_reading(
     if not callback.from_user:
         return
 
-    await ensure_user(
-        db,
-        user_id=callback.from_user.id,
-        username=callback.from_user.username or "",
-        first_name=callback.from_user.first_name or "",
-    )
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
     await callback.answer()
 
-    lang = await get_user_language(db, callback.from_user.id)
+    lang = user_doc.language
     action_key = f"reading:{reading_key}"
-    if not await claim_ai_action_lock(db, callback.from_user.id, action_key):
-        await callback.answer(get_text(lang, "magic_wait"), show_alert=True)
-        return
-
     is_admin = callback.from_user.id in ADMIN_IDS
+    reservation = await reserve_paid_action(db, callback.from_user.id, action_key, 0 if is_admin else price)
 
-    if not is_admin:
-        balance = await get_balance(db, callback.from_user.id)
-        if balance < price:
-            title_key = "invoice_love_title" if reading_key == "relationship" else "invoice_career_title"
-            desc_key = "invoice_love_desc" if reading_key == "relationship" else "invoice_career_desc"
-            await release_ai_action_lock(db, callback.from_user.id, action_key)
-            await send_stars_invoice(
-                callback=callback,
-                title=get_text(lang, title_key),
-                description=get_text(lang, desc_key),
-                amount_stars=price,
-                payload=f"reading:{reading_key}:{price}",
-            )
-            return
+    if reservation.status == "locked":
+        await callback.answer(get_text(lang, "magic_wait"), show_alert=True)
+        return
 
-        try:
-            await increment_balance(db, callback.from_user.id, -price)
-        except InsufficientBalanceError:
-            if callback.message:
-                await callback.message.answer(get_text(lang, "error_payment"))
-            await release_ai_action_lock(db, callback.from_user.id, action_key)
-            return
+    if reservation.status == "insufficient":
+        title_key = "invoice_love_title" if reading_key == "relationship" else "invoice_career_title"
+        desc_key = "invoice_love_desc" if reading_key == "relationship" else "invoice_career_desc"
+        await send_stars_invoice(
+            callback=callback,
+            title=get_text(lang, title_key),
+            description=get_text(lang, desc_key),
+            amount_stars=price,
+            payload=f"reading:{reading_key}:{price}",
+        )
+        return
 
     await state.set_state(ReadingStates.waiting_for_context)
-    await state.update_data(reading_key=reading_key, price=price, action_key=action_key)
+    await state.update_data(
+        reading_key=reading_key,
+        price=price,
+        action_key=action_key,
+        reservation=reservation.token,
+    )
 
     if callback.message:
         await callback.message.answer(
@@ -234,18 +183,17 @@ async def _start_paid_reading(
 
 
 @router.callback_query(F.data == CB_DAILY)
-async def daily_card(callback: CallbackQuery, db: firestore.Client, tarot_model: Any) -> None:
+async def daily_card(
+    callback: CallbackQuery,
+    db: firestore.Client,
+    tarot_model: Any,
+    user_doc: UserDoc | None = None,
+) -> None:
     if not callback.from_user:
         return
-    user_id = str(callback.from_user.id)
-    await ensure_user(
-        db,
-        user_id=callback.from_user.id,
-        username=callback.from_user.username or "",
-        first_name=callback.from_user.first_name or "",
-    )
+    user_doc = user_doc or await load_user_doc(db, callback.from_user)
 
-    lang = await get_user_language(db, callback.from_user.id)
+    lang = user_doc.language
     today_str = datetime.now().strftime("%Y-%m-%d")
 
     is_admin = callback.from_user.id in ADMIN_IDS
@@ -260,24 +208,28 @@ async def daily_card(callback: CallbackQuery, db: firestore.Client, tarot_model:
 
     await callback.answer()
 
-    ai_languages = {"uk": "Ukrainian", "en": "English", "ru": "Russian"}
-    target_language = ai_languages.get(lang, "Ukrainian")
-    prompt = (
-        "Draw a card of the day and explain the energy of this day. "
-        + _tarot_format_prompt(lang, target_language)
-    )
+    current_img = IMAGES_DAILY.get(lang, IMAGES_DAILY["uk"])
 
-    ai_task = asyncio.create_task(_gemini_generate_text(tarot_model, prompt))
-
-    msg = await callback.message.answer(get_text(lang, "loading_daily_1"), parse_mode="HTML")
-    await asyncio.sleep(1.5)
-    await msg.edit_text(get_text(lang, "loading_daily_2"), parse_mode="HTML")
-    await asyncio.sleep(1.5)
-    await msg.edit_text(get_text(lang, "loading_daily_3"), parse_mode="HTML")
+    async def show_card() -> Message:
+        return await callback.message.answer_photo(photo=current_img, caption=get_text(lang, "daily_energy_here"), parse_mode="HTML")
 
     referral_bonus_granted_to = None
+    delivered = False
     try:
-        text = await ai_task
+        text = await pop_daily_card(db, tarot_model, lang)
+        if text:
+            await show_card()
+            await callback.message.answer(text, parse_mode="HTML")
+            delivered = True
+        else:
+            msg = await callback.message.answer(get_text(lang, "loading_daily_1"), parse_mode="HTML")
+            text = await stream_to_chat(
+                callback.message,
+                _gemini_stream(tarot_model, daily_card_prompt(lang), PRIORITY_INTERACTIVE, "daily"),
+                placeholder=msg,
+                on_start=show_card,
+            )
+            delivered = bool(text)
         if text:
             await complete_daily_card_slot(db, callback.from_user.id, today_str)
             if not is_admin:
@@ -287,12 +239,7 @@ async def daily_card(callback: CallbackQuery, db: firestore.Client, tarot_model:
                     REFERRAL_DAILY_BONUS,
                 )
 
-        await msg.delete()
-
-        if text:
-            current_img = IMAGES_DAILY.get(lang, IMAGES_DAILY["uk"])
-            await callback.message.answer_photo(photo=current_img, caption=get_text(lang, "daily_energy_here"), parse_mode="HTML")
-            await _send_long(callback.message, text, reply_markup=main_menu_kb(lang), lang=lang)
+            await _send_menu(callback.message, main_menu_kb(lang), lang)
             await log_chat_message(db, callback.from_user.id, "bot", text)
 
             if referral_bonus_granted_to:
@@ -305,24 +252,32 @@ async def daily_card(callback: CallbackQuery, db: firestore.Client, tarot_model:
                 except Exception:
                     pass
         else:
+            # Nothing was delivered: give today's card back.
+            if not is_admin:
+                await release_daily_card_slot(db, callback.from_user.id, today_str)
             await callback.message.answer(get_text(lang, "error_generate"), reply_markup=main_menu_kb(lang))
-    except Exception as e:
-        print(f"Daily Handler Error: {e}")
+    except Exception:
+        logging.exception("DAILY_CARD_FAILED user_id=%s delivered=%s", callback.from_user.id, delivered)
+        if delivered:
+            # The card was shown and only a follow-up failed, so the claim is not given back.
+            return
         if not is_admin:
             await release_daily_card_slot(db, callback.from_user.id, today_str)
-        try:
-            await msg.delete()
-        except Exception:
-            pass
         await callback.message.answer(get_text(lang, "error_generate"), reply_markup=main_menu_kb(lang))
 
 
 @router.callback_query(F.data == CB_RELATIONSHIP)
-async def relationship_reading(callback: CallbackQuery, state: FSMContext, db: firestore.Client) -> None:
+async def relationship_reading(
+    callback: CallbackQuery,
+    state: FSMContext,
+    db: firestore.Client,
+    user_doc: UserDoc | None = None,
+) -> None:
     await _start_paid_reading(
         callback,
         state,
         db,
+        user_doc,
         reading_key="relationship",
         price=RELATIONSHIP_PRICE,
         prompt_key="ask_love_context",
@@ -330,11 +285,17 @@ async def relationship_reading(callback: CallbackQuery, state: FSMContext, db: f
 
 
 @router.callback_query(F.data == CB_CAREER)
-async def career_reading(callback: CallbackQuery, state: FSMContext, db: firestore.Client) -> None:
+async def career_reading(
+    callback: CallbackQuery,
+    state: FSMContext,
+    db: firestore.Client,
+    user_doc: UserDoc | None = None,
+) -> None:
     await _start_paid_reading(
         callback,
         state,
         db,
+        user_doc,
         reading_key="career",
         price=CAREER_PRICE,
         prompt_key="ask_career_context",
@@ -342,15 +303,23 @@ async def career_reading(callback: CallbackQuery, state: FSMContext, db: firesto
 
 
 @router.message(ReadingStates.waiting_for_context)
-async def reading_context_message(message: Message, state: FSMContext, db: firestore.Client, bot: Any, tarot_model: Any) -> None:
+async def reading_context_message(
+    message: Message,
+    state: FSMContext,
+    db: firestore.Client,
+    bot: Any,
+    tarot_model: Any,
+    user_doc: UserDoc | None = None,
+) -> None:
     if not message.from_user:
         return
-    lang = await get_user_language(db, message.from_user.id)
+    user_doc = user_doc or await load_user_doc(db, message.from_user)
+    lang = user_doc.language
 
     data = await state.get_data()
     reading_key = data.get("reading_key")
     action_key = data.get("action_key") or (f"reading:{reading_key}" if reading_key else None)
-    price = data.get("price", 1)
+    reservation = data.get("reservation")
 
     topic_by_lang = {
         "uk": {"relationship": "стосунки", "career": "кар'єра"},
@@ -361,59 +330,69 @@ async def reading_context_message(message: Message, state: FSMContext, db: fires
     wait_text = get_text(lang, "loading_love_cards") if reading_key == "relationship" else get_text(lang, "loading_cards")
     msg = await message.answer(wait_text, reply_markup=ReplyKeyboardRemove(), parse_mode="HTML")
 
-    ai_languages = {"uk": "Ukrainian", "en": "English", "ru": "Russian"}
-    target_language = ai_languages.get(lang, "Ukrainian")
-    format_prompt = _tarot_format_prompt(lang, target_language)
+    target_language = TARGET_LANGUAGES.get(lang, "Ukrainian")
+    format_prompt = tarot_format_prompt(lang, target_language)
+
+    img_dict = IMAGES_LOVE if reading_key == "relationship" else IMAGES_CAREER
+    img_to_send = img_dict.get(lang, img_dict["uk"])
+
+    async def show_cards() -> Message:
+        return await message.answer_photo(photo=img_to_send, caption=get_text(lang, "cards_on_table"), parse_mode="HTML")
 
     text = ""
     try:
         if message.voice:
-            file_info = await bot.get_file(message.voice.file_id)
-            audio_bytes = (await bot.download_file(file_info.file_path)).read()
             prompt = (
                 f"The user sent voice context about {topic}. Create a tarot reading. "
                 + format_prompt
             )
-            text = await _gemini_generate_with_audio(tarot_model, prompt, audio_bytes)
+            content: Any = [prompt, await _voice_part(bot, message.voice)]
         else:
             user_text = message.text or ""
-            prompt = (
+            content = (
                 f"The user context about {topic} is: {user_text}. Create a tarot reading. "
                 + format_prompt
             )
-            text = await _gemini_generate_text(tarot_model, prompt)
-    except Exception as e:
-        print(f"Reading Context Error: {e}")
-
-    await msg.delete()
+        text = await stream_to_chat(
+            message,
+            _gemini_stream(tarot_model, content, PRIORITY_PAID, reading_key or "other", hedge=True),
+            placeholder=msg,
+            on_start=show_cards,
+        )
+    except Exception:
+        logging.exception("READING_GENERATION_FAILED user_id=%s reading=%s", message.from_user.id, reading_key)
+        try:
+            await msg.delete()
+        except Exception:
+            pass
 
     if not text:
-        if message.from_user.id not in ADMIN_IDS:
+        refund_note = ""
+        settled = False
+        if reservation:
             try:
-                await increment_balance(db, message.from_user.id, price)
-                refund_note = get_text(lang, "refund_note_balance").format(price=price)
+                refunded = await refund_paid_action(db, message.from_user.id, reservation)
+                settled = True
             except Exception:
-                refund_note = ""
-        else:
-            refund_note = ""
+                refunded = 0
+            if refunded:
+                refund_note = get_text(lang, "refund_note_balance").format(price=refunded)
 
         await message.answer(
             get_text(lang, "magic_interrupted").format(refund_note=refund_note),
             reply_markup=main_menu_kb(lang),
             parse_mode="HTML",
         )
-        if action_key:
+        if action_key and not settled:
             await release_ai_action_lock(db, message.from_user.id, action_key)
         await state.clear()
         return
 
-    img_dict = IMAGES_LOVE if reading_key == "relationship" else IMAGES_CAREER
-    img_to_send = img_dict.get(lang, img_dict["uk"])
-
-    await message.answer_photo(photo=img_to_send, caption=get_text(lang, "cards_on_table"), parse_mode="HTML")
-    await _send_long(message, text, reply_markup=main_menu_kb(lang), lang=lang)
+    await _send_menu(message, main_menu_kb(lang), lang)
     await log_chat_message(db, message.from_user.id, "bot", text)
-    if action_key:
+    if reservation:
+        await commit_paid_action(db, message.from_user.id, reservation)
+    elif action_key:
         await release_ai_action_lock(db, message.from_user.id, action_key)
     await state.clear()
 
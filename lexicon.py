@@ -19,6 +19,8 @@ LEXICON = {
         "matrix_upsell_processing": "✨ Занурююсь у глибини вашої Матриці...",
         "matrix_data_lost_alert": "⏳ Дані втрачено (час очікування вийшов). Будь ласка, почніть розрахунок Матриці спочатку.",
         "matrix_payment_success_data_lost": "Оплата успішна, але дані Матриці втрачено. Зробіть базовий розрахунок ще раз у меню.",
+        "paid_action_locked": "<b>Баланс поповнено!</b>\n\nПопередній запит ще обробляється, тому зірки залишились на балансі.\nСпробуй запит ще раз з меню.",
+        "paid_action_insufficient": "<b>Баланс поповнено!</b>\n\nЗірок на балансі поки не вистачає для цього запиту, тому вони залишились на балансі.\nПоповни баланс або обери інший запит у меню.",
         "matrix_desc_finance": "Фінансовий канал Матриці",
         "matrix_desc_love": "Канал стосунків Матриці",
         "matrix_topic_finance": "ФІНАНСОВОГО КАНАЛУ (гроші, професія, блоки)",
@@ -97,6 +99,8 @@ LEXICON = {
         "matrix_upsell_processing": "✨ Diving into the depths of your Matrix...",
         "matrix_data_lost_alert": "⏳ Data lost (timeout). Please start the Matrix calculation again.",
         "matrix_payment_success_data_lost": "Payment successful, but Matrix data is lost. Please do the basic calculation again from the menu.",
+        "paid_action_locked": "<b>Balance topped up!</b>\n\nYour previous request is still being processed, so the stars stay on your balance.\nPlease try the request again from the menu.",
+        "paid_action_insufficient": "<b>Balance topped up!</b>\n\nThere are not enough stars on your balance for this request yet, so they stay on your balance.\nTop up or choose another request from the menu.",
         "matrix_desc_finance": "Financial channel of the Matrix",
         "matrix_desc_love": "Relationship channel of the Matrix",
         "matrix_topic_finance": "FINANCIAL CHANNEL (money, profession, blocks)",
@@ -175,6 +179,8 @@ LEXICON = {
         "matrix_upsell_processing": "✨ Погружаюсь в глубины вашей Матрицы...",
         "matrix_data_lost_alert": "⏳ Данные потеряны (время ожидания вышло). Пожалуйста, начните расчет Матрицы сначала.",
         "matrix_payment_success_data_lost": "Оплата успешна, но данные Матрицы потеряны. Сделайте базовый расчет еще раз в меню.",
+        "paid_action_locked": "<b>Баланс пополнен!</b>\n\nПредыдущий запрос ещё обрабатывается, поэтому звёзды остались на балансе.\nПопробуй запрос ещё раз из меню.",
+        "paid_action_insufficient": "<b>Баланс пополнен!</b>\n\nЗвёзд на балансе пока не хватает для этого запроса, поэтому они остались на балансе.\nПополни баланс или выбери другой запрос в меню.",
         "matrix_desc_finance": "Финансовый канал Матрицы",
         "matrix_desc_love": "Канал отношений Матрицы",
         "matrix_topic_finance": "ФИНАНСОВОГО КАНАЛА (деньги, профессия, блоки)",
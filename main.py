@@ -5,6 +5,7 @@ import signal
 import sys
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Any
 
 import google.generativeai as genai
 from aiohttp import web
@@ -13,19 +14,33 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from firebase_admin import firestore
 from google.generativeai.types import HarmBlockThreshold, HarmCategory
 import pytz
 
 from config import load_settings
-from firebase_db import check_firestore_access, init_firestore
+from daily_card_pool import refill_daily_card_pool
+from fake_gemini import FakeGenerativeModel
+from matrix_cache import prewarm_matrix_interpretations
+from firebase_db import (
+    check_firestore_access,
+    init_firestore,
+    log_user_cache_stats,
+    reconcile_user_stats,
+    start_chat_history_writer,
+    sweep_chat_history,
+    stop_chat_history_writer,
+)
 from handlers.admin import router as admin_router
 from handlers.advice import router as advice_router
 from handlers.payment import router as payment_router
 from handlers.start import router as start_router
 from handlers.tarot import router as tarot_router
 from handlers.matrix import router as matrix_router
-from middleware import ChatLoggingMiddleware, ThrottlingMiddleware
-from gemini_runtime import memory_maintenance
+from middleware import ChatLoggingMiddleware, ThrottlingMiddleware, UserSnapshotMiddleware
+from gemini_runtime import ModelRouter, memory_governor
+from gemini_usage import flush_gemini_usage
+import metrics
 from notifications import send_daily_horoscope, send_monthly_card_reminders
 from prompts import KARMA_SYSTEM_PROMPT, UNIVERSE_ADVICE_SYSTEM_PROMPT
 
@@ -41,9 +56,17 @@ async def health_check(request: web.Request) -> web.Response:
     return web.Response(text="Bot is alive")
 
 
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(
+        body=metrics.registry.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
 async def _run_web_server(port: int) -> None:
     app = web.Application()
     app.router.add_get("/", health_check)
+    app.router.add_get("/metrics", metrics_endpoint)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, host="0.0.0.0", port=port)
@@ -53,12 +76,22 @@ async def _run_web_server(port: int) -> None:
     finally:
         await runner.cleanup()
 
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _start_deferred_write_probes(db: firestore.Client) -> None:
+    task = asyncio.create_task(check_firestore_access(db, phase="writes"))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
 def handle_exit(sig, frame):
     logging.warning(f"Received signal {sig}. Shutting down bot...")
     # Ми не виходимо тут примусово, дозволяємо asyncio завершити роботу
 
 async def main() -> None:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    # Sync Firestore calls, file uploads and image rendering; Gemini requests use the SDK's async API
     asyncio.get_running_loop().set_default_executor(
         ThreadPoolExecutor(max_workers=4, thread_name_prefix="karma-worker")
     )
@@ -67,48 +100,61 @@ async def main() -> None:
         settings.firebase_cred_path,
         firebase_credentials_json=settings.firebase_credentials_json,
         firebase_credentials_b64=settings.firebase_credentials_b64,
+        client_mode=settings.firestore_client,
+        backend=settings.firestore_backend,
     )
-    await check_firestore_access(db)
+    # FAST_BOOT: only read probes gate startup; write probes run once polling has started
+    await check_firestore_access(db, phase="reads" if settings.fast_boot else "full")
 
-    genai.configure(api_key=settings.gemini_api_key)
+    if settings.gemini_backend == "fake":
+        logging.warning("Using fake Gemini models (GEMINI_BACKEND=fake); responses are generated locally")
+    else:
+        genai.configure(api_key=settings.gemini_api_key)
+
+    def build_model(name: str, system_instruction: str) -> Any:
+        if settings.gemini_backend == "fake":
+            return FakeGenerativeModel.from_env(name, system_instruction=system_instruction)
+        return genai.GenerativeModel(model_name=name, system_instruction=system_instruction)
 
     model_name = settings.primary_model_name
 
-    tarot_model = genai.GenerativeModel(
-        model_name=model_name,
-        system_instruction=KARMA_SYSTEM_PROMPT,
-    )
+    tarot_model = build_model(model_name, KARMA_SYSTEM_PROMPT)
     fallback_model = None
     if settings.fallback_model_name and settings.fallback_model_name != model_name:
-        fallback_model = genai.GenerativeModel(
-            model_name=settings.fallback_model_name,
-            system_instruction=KARMA_SYSTEM_PROMPT,
-        )
+        fallback_model = build_model(settings.fallback_model_name, KARMA_SYSTEM_PROMPT)
     logging.info(
-        "Gemini models configured primary=%s fallback=%s",
+        "Gemini models configured primary=%s fallback=%s backend=%s",
         model_name,
         settings.fallback_model_name or "<none>",
+        settings.gemini_backend,
     )
 
+    advice_model = build_model(model_name, UNIVERSE_ADVICE_SYSTEM_PROMPT)
+    advice_fallback_model = None
+    if fallback_model is not None:
+        advice_fallback_model = build_model(settings.fallback_model_name, UNIVERSE_ADVICE_SYSTEM_PROMPT)
 
-    advice_model = genai.GenerativeModel(
-        model_name=model_name,
-        system_instruction=UNIVERSE_ADVICE_SYSTEM_PROMPT,
-    )
+    # Routers fail over to the fallback model while the primary's circuit is open
+    tarot_models = ModelRouter([tarot_model, fallback_model])
+    advice_models = ModelRouter([advice_model, advice_fallback_model])
 
     bot = Bot(token=settings.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp = Dispatcher(storage=MemoryStorage())
 
+    dp.update.outer_middleware(UserSnapshotMiddleware())
     dp.update.middleware(ThrottlingMiddleware(rate_limit=3.0))
     dp.message.middleware(ChatLoggingMiddleware())
 
     dp.workflow_data.update(
         db=db,
-        tarot_model=tarot_model,
-        advice_model=advice_model,
+        tarot_model=tarot_models,
+        advice_model=advice_models,
         safety_settings=SAFETY_SETTINGS,
     )
 
+    if settings.fast_boot:
+        dp.startup.register(_start_deferred_write_probes)
+
     dp.include_router(admin_router)
     dp.include_router(payment_router)
     dp.include_router(start_router)
@@ -116,13 +162,22 @@ async def main() -> None:
     dp.include_router(advice_router)
     dp.include_router(matrix_router)
 
+    start_chat_history_writer(db)
+
     port = int(os.environ.get("PORT", 8080))
     web_task = asyncio.create_task(_run_web_server(port))
-    memory_task = asyncio.create_task(memory_maintenance())
+    memory_task = asyncio.create_task(memory_governor())
 
     scheduler = AsyncIOScheduler(timezone="Europe/Kyiv")
+    scheduler.add_job(log_user_cache_stats, trigger="interval", minutes=30)
+    scheduler.add_job(flush_gemini_usage, trigger="interval", minutes=5, args=[db])
+    scheduler.add_job(reconcile_user_stats, trigger="cron", hour=4, minute=30, args=[db])
+    scheduler.add_job(sweep_chat_history, trigger="cron", hour=3, minute=30, args=[db])
+    scheduler.add_job(refill_daily_card_pool, trigger="cron", hour=4, minute=0, args=[db, tarot_models])
+    # No-op unless MATRIX_CACHE_PREWARM is set
+    scheduler.add_job(prewarm_matrix_interpretations, trigger="cron", hour=5, minute=0, args=[db, tarot_models])
     scheduler.add_job(send_monthly_card_reminders, trigger="cron", day=1, hour=12, minute=0, args=[bot, db])
-    scheduler.add_job(send_daily_horoscope, trigger="cron", hour=9, minute=0, args=[bot, db, tarot_model, fallback_model])
+    scheduler.add_job(send_daily_horoscope, trigger="cron", hour=9, minute=0, args=[bot, db, tarot_models])
     
     # Редундантна перевірка кожні 20 хв (Self-healing на випадок збоїв планувальника)
     scheduler.add_job(
@@ -130,17 +185,22 @@ async def main() -> None:
         trigger="cron",
         hour="9-12",
         minute=20,
-        args=[bot, db, tarot_model, fallback_model]
+        args=[bot, db, tarot_models]
     )
     
     scheduler.start()
 
+    # Load the daily card pool and top it up; generation runs at background priority
+    refill_task = asyncio.create_task(refill_daily_card_pool(db, tarot_models))
+    _background_tasks.add(refill_task)
+    refill_task.add_done_callback(_background_tasks.discard)
+
     # Catch-up: перевірка чи не пропущено гороскоп (якщо бот стартував після 09:00)
     tz = pytz.timezone("Europe/Kyiv")
     now = datetime.now(tz)
     if now.hour >= 9:
         logging.info("It's past 09:00 AM. Checking for missed daily horoscope...")
-        asyncio.create_task(send_daily_horoscope(bot, db, tarot_model, fallback_model))
+        asyncio.create_task(send_daily_horoscope(bot, db, tarot_models))
 
     # Реєстрація сигналів для логування
     for sig in (signal.SIGTERM, signal.SIGINT):
@@ -155,6 +215,8 @@ async def main() -> None:
         web_task.cancel()
         memory_task.cancel()
         await asyncio.gather(web_task, memory_task, return_exceptions=True)
+        await flush_gemini_usage(db)
+        await stop_chat_history_writer()
 
 
 if __name__ == "__main__":
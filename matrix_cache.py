@@ -0,0 +1,198 @@
+"""Matrix of Destiny interpretations cached by arcana, channel and language.
+
+The base reading depends only on the portrait and center arcana, the finance and love
+readings on the five main arcana, so every user with the same combination can share
+one of a few stored variants instead of a fresh Gemini call.
+"""
+
+import asyncio
+import collections
+import datetime
+import functools
+import logging
+import os
+import random
+from typing import Any
+
+from firebase_admin import firestore
+
+import metrics
+from firebase_db import add_matrix_interpretation, get_matrix_interpretations, record_matrix_interpretation_hit
+from gemini_runtime import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, generate_content
+from lexicon import get_text
+from utils.matrix_math import calculate_matrix
+from utils.telegram_stream import MESSAGE_LIMIT
+
+CHANNEL_BASE = "base"
+_MATRIX_CACHE_VARIANTS = max(1, int(os.getenv("MATRIX_CACHE_VARIANTS", "3")))
+# Number of most frequent base combinations per language to pre-generate; 0 disables pre-warming.
+_MATRIX_CACHE_PREWARM = int(os.getenv("MATRIX_CACHE_PREWARM", "0"))
+_MEMORY_CACHE_MAX_ENTRIES = 2048
+_PREWARM_MAX_FAILURES = 3
+_PREWARM_LANGUAGES = ("uk", "en", "ru")
+_CHANNEL_ARCANA = {
+    CHANNEL_BASE: ("portrait", "center"),
+    "finance": ("portrait", "talent", "karma", "social", "center"),
+    "love": ("portrait", "talent", "karma", "social", "center"),
+}
+
+_PROMPT_LANG = {
+    "uk": "українською мовою",
+    "en": "англійською мовою (in English)",
+    "ru": "російською мовою",
+}
+
+# Keys whose variant list is already full; anything else still needs generation.
+_full_keys: collections.OrderedDict[str, tuple[str, ...]] = collections.OrderedDict()
+_hit_tasks: set[asyncio.Task] = set()
+
+
+def cache_key(matrix: dict[str, int], channel: str, lang: str) -> str:
+    arcana = "-".join(str(matrix[name]) for name in _CHANNEL_ARCANA[channel])
+    return f"{channel}_{lang}_{arcana}"
+
+
+def _prompt(matrix: dict[str, int], channel: str, lang: str) -> str:
+    prompt_lang = _PROMPT_LANG.get(lang, _PROMPT_LANG["uk"])
+    if channel == CHANNEL_BASE:
+        return (
+            f"Я розрахував Матрицю Долі людини.\n"
+            f"Основні аркани:\n"
+            f"- Портрет (як людину бачить соціум): Аркан {matrix['portrait']}\n"
+            f"- Характер/Центр (основа особистості): Аркан {matrix['center']}\n\n"
+            f"Напиши містичну, глибоку, але сучасну розшифровку цих двох енергій (Портрет і Характер). "
+            f"Використовуй езотеричний, але зрозумілий стиль. Форматування має бути красивим, з емодзі. "
+            f"Відповідай {prompt_lang}. Звертайся до людини на 'ти'. Обсяг: приблизно 200-250 слів."
+        )
+
+    topic = get_text(lang, "matrix_topic_finance" if channel == "finance" else "matrix_topic_love")
+    return (
+        f"Я розрахував Матрицю Долі людини.\n"
+        f"Аркани: Портрет {matrix.get('portrait')}, Талант {matrix.get('talent')}, "
+        f"Карма {matrix.get('karma')}, Соціум {matrix.get('social')}, Центр {matrix.get('center')}.\n\n"
+        f"Зроби глибокий аналіз {topic} на основі цих енергій. "
+        f"Відповідай {prompt_lang}. Стиль: сучасна містика. Обсяг: приблизно 200-250 слів."
+    )
+
+
+def _remember_full(key: str, variants: list[str]) -> None:
+    if len(variants) < _MATRIX_CACHE_VARIANTS:
+        return
+    _full_keys[key] = tuple(variants)
+    _full_keys.move_to_end(key)
+    while len(_full_keys) > _MEMORY_CACHE_MAX_ENTRIES:
+        _full_keys.popitem(last=False)
+
+
+def _record_hit(db: firestore.Client, key: str, channel: str) -> None:
+    metrics.registry.inc("karma_matrix_cache_requests_total", channel=channel, result="hit")
+
+    async def _write() -> None:
+        try:
+            await record_matrix_interpretation_hit(db, key)
+        except Exception as exc:
+            logging.warning("MATRIX_CACHE_HIT_WRITE_FAILED key=%s error=%s", key, exc)
+
+    task = asyncio.create_task(_write())
+    _hit_tasks.add(task)
+    task.add_done_callback(_hit_tasks.discard)
+
+
+async def _generate(db: firestore.Client, model: Any, matrix: dict[str, int], channel: str, lang: str, priority: str) -> tuple[str, list[str]]:
+    key = cache_key(matrix, channel, lang)
+    feature = "matrix_base" if channel == CHANNEL_BASE else "matrix_upsell"
+    response = await generate_content(model, _prompt(matrix, channel, lang), priority=priority, feature=feature)
+    text = (getattr(response, "text", "") or "").strip()
+    if not text:
+        raise ValueError("Empty response from AI")
+    if len(text) > MESSAGE_LIMIT:
+        return text, []
+
+    meta = {"channel": channel, "lang": lang, "arcana": {name: matrix[name] for name in _CHANNEL_ARCANA[channel]}}
+    try:
+        variants = await add_matrix_interpretation(db, key, text, max_variants=_MATRIX_CACHE_VARIANTS, meta=meta)
+    except Exception as exc:
+        logging.warning("MATRIX_CACHE_STORE_FAILED key=%s error_type=%s error=%s", key, type(exc).__name__, exc)
+        variants = []
+    _remember_full(key, variants)
+    return text, variants
+
+
+async def get_matrix_interpretation(
+    db: firestore.Client,
+    model: Any,
+    matrix: dict[str, int],
+    channel: str,
+    lang: str,
+    *,
+    priority: str = PRIORITY_INTERACTIVE,
+) -> str:
+    """Return a stored interpretation for this arcana combination, generating one while variants are missing."""
+    key = cache_key(matrix, channel, lang)
+    variants = _full_keys.get(key)
+    if variants is None:
+        try:
+            stored = await get_matrix_interpretations(db, key)
+        except Exception as exc:
+            logging.warning("MATRIX_CACHE_READ_FAILED key=%s error_type=%s error=%s", key, type(exc).__name__, exc)
+            stored = []
+        _remember_full(key, stored)
+        if len(stored) >= _MATRIX_CACHE_VARIANTS:
+            variants = tuple(stored)
+
+    if variants:
+        _record_hit(db, key, channel)
+        return random.choice(variants)
+
+    metrics.registry.inc("karma_matrix_cache_requests_total", channel=channel, result="miss")
+    text, _ = await _generate(db, model, matrix, channel, lang, priority)
+    return text
+
+
+@functools.lru_cache(maxsize=1)
+def _base_combinations_by_frequency() -> list[dict[str, int]]:
+    """Base-reading arcana for birth dates 1950-2012, most frequent combination first."""
+    counts: collections.Counter[tuple[int, int]] = collections.Counter()
+    day = datetime.date(1950, 1, 1)
+    while day.year <= 2012:
+        matrix = calculate_matrix(day.strftime("%d.%m.%Y"))
+        counts[(matrix["portrait"], matrix["center"])] += 1
+        day += datetime.timedelta(days=1)
+    return [{"portrait": portrait, "center": center} for (portrait, center), _ in counts.most_common()]
+
+
+async def prewarm_matrix_interpretations(db: firestore.Client, model: Any, limit: int = _MATRIX_CACHE_PREWARM) -> int:
+    """Fill every variant for the ``limit`` most frequent base combinations in each language."""
+    if limit <= 0:
+        return 0
+
+    combinations = (await asyncio.to_thread(_base_combinations_by_frequency))[:limit]
+    generated = 0
+    failures = 0
+    for lang in _PREWARM_LANGUAGES:
+        for matrix in combinations:
+            key = cache_key(matrix, CHANNEL_BASE, lang)
+            if key in _full_keys:
+                continue
+            variants = await get_matrix_interpretations(db, key)
+            while len(variants) < _MATRIX_CACHE_VARIANTS and failures < _PREWARM_MAX_FAILURES:
+                try:
+                    _, stored = await _generate(db, model, matrix, CHANNEL_BASE, lang, PRIORITY_BACKGROUND)
+                except Exception as exc:
+                    failures += 1
+                    logging.warning("MATRIX_CACHE_PREWARM_FAILED key=%s error_type=%s error=%s", key, type(exc).__name__, exc)
+                    continue
+                if not stored:
+                    # Too long to cache or the write failed; count it so a bad streak ends the run.
+                    failures += 1
+                    continue
+                failures = 0
+                generated += 1
+                variants = stored
+            _remember_full(key, variants)
+            if failures >= _PREWARM_MAX_FAILURES:
+                logging.warning("MATRIX_CACHE_PREWARM_STOPPED generated=%s", generated)
+                return generated
+
+    logging.info("MATRIX_CACHE_PREWARMED combinations=%s generated=%s", len(combinations), generated)
+    return generated
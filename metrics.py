@@ -0,0 +1,183 @@
+"""Process-local metrics registry, rendered in Prometheus text format on ``/metrics``."""
+
+from __future__ import annotations
+
+import contextvars
+import functools
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+LATENCY_BUCKETS_SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+_F = TypeVar("_F", bound=Callable[..., Awaitable[Any]])
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate the ``q`` quantile by linear interpolation inside the matching bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, in_bucket in zip(self.buckets, self.counts):
+            if in_bucket and seen + in_bucket >= rank:
+                return lower + (bound - lower) * (rank - seen) / in_bucket
+            seen += in_bucket
+            lower = bound
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors: list[Callable[[], None]] = []
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Register a callback that refreshes gauges right before every render."""
+        self._collectors.append(collector)
+
+    def inc(self, name: str, amount: float = 1.0, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, *, buckets: Tuple[float, ...] = LATENCY_BUCKETS_SECONDS, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def quantile(self, name: str, q: float, **labels: Any) -> Optional[float]:
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(_labels(labels))
+            return histogram.quantile(q) if histogram is not None else None
+
+    def observation_count(self, name: str, **labels: Any) -> int:
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(_labels(labels))
+            return histogram.count if histogram is not None else 0
+
+    def counter_value(self, name: str, **labels: Any) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_labels(labels), 0.0)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            collector()
+
+        lines: list[str] = []
+        with self._lock:
+            for kind, families in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted(families):
+                    if name in self._help:
+                        lines.append(f"# HELP {name} {self._help[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in sorted(families[name].items()):
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+            for name in sorted(self._histograms):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, in_bucket in zip(histogram.buckets, histogram.counts):
+                        cumulative += in_bucket
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+FIRESTORE_LATENCY = "karma_firestore_operation_seconds"
+FIRESTORE_ERRORS = "karma_firestore_operation_errors_total"
+FIRESTORE_RETRIES = "karma_firestore_transaction_retries_total"
+
+registry.describe(FIRESTORE_LATENCY, "Latency of Firestore-backed operations by operation name.")
+registry.describe(FIRESTORE_ERRORS, "Firestore-backed operations that raised, by operation and error type.")
+registry.describe(FIRESTORE_RETRIES, "Transaction body re-runs caused by contention, by outermost operation.")
+
+_current_operation: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("firestore_operation", default=None)
+
+
+def current_operation() -> Optional[str]:
+    """Name of the outermost tracked Firestore operation running in this context."""
+    return _current_operation.get()
+
+
+def track_firestore_operation(fn: _F) -> _F:
+    operation = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        token = _current_operation.set(operation) if _current_operation.get() is None else None
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as exc:
+            registry.inc(FIRESTORE_ERRORS, operation=operation, error_type=type(exc).__name__)
+            raise
+        finally:
+            registry.observe(FIRESTORE_LATENCY, time.perf_counter() - started, operation=operation)
+            if token is not None:
+                _current_operation.reset(token)
+
+    return wrapper  # type: ignore[return-value]
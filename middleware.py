@@ -1,4 +1,3 @@
-import asyncio
 import logging
 import time
 from typing import Any, Awaitable, Callable, Dict
@@ -6,12 +5,37 @@ from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
 from aiogram.types import CallbackQuery, Message, TelegramObject
 
-from firebase_db import get_user_language, log_chat_message
+from firebase_db import get_user_language, load_user_doc, log_chat_message
 from lexicon import get_text
 
 logger = logging.getLogger(__name__)
 
 
+class UserSnapshotMiddleware(BaseMiddleware):
+    """Load the sender's user document once per update and expose it as ``user_doc``."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        db = data.get("db")
+        if user is not None and db is not None and not user.is_bot:
+            try:
+                data["user_doc"] = await load_user_doc(db, user)
+            except Exception as exc:
+                logger.warning(
+                    "USER_SNAPSHOT_LOAD_FAILED user_id=%s error_type=%s error=%s",
+                    user.id,
+                    type(exc).__name__,
+                    exc,
+                )
+
+        return await handler(event, data)
+
+
 class ThrottlingMiddleware(BaseMiddleware):
     def __init__(self, rate_limit: float = 3.0):
         self.rate_limit = rate_limit
@@ -50,8 +74,12 @@ class ThrottlingMiddleware(BaseMiddleware):
         last_time = self.ai_cache.get(user_id, 0.0)
 
         if user_id in self.ai_inflight or current_time - last_time < self.rate_limit:
+            user_doc = data.get("user_doc")
             db = data.get("db")
-            lang = await get_user_language(db, user_id) if db else "uk"
+            if user_doc is not None:
+                lang = user_doc.language
+            else:
+                lang = await get_user_language(db, user_id) if db else "uk"
             await event.answer(get_text(lang, "magic_wait"), show_alert=True)
             return None
 
@@ -64,26 +92,6 @@ class ThrottlingMiddleware(BaseMiddleware):
 
 
 class ChatLoggingMiddleware(BaseMiddleware):
-    def __init__(self, max_pending_logs: int = 50) -> None:
-        self.max_pending_logs = max_pending_logs
-        self._pending_logs: set[asyncio.Task[Any]] = set()
-
-    async def _safe_log_chat_message(self, db: Any, user_id: int, text: str) -> None:
-        try:
-            await log_chat_message(
-                db=db,
-                user_id=user_id,
-                role="user",
-                text=text,
-            )
-        except Exception as exc:
-            logger.warning(
-                "CHAT_HISTORY_WRITE_FAILED user_id=%s error_type=%s error=%s",
-                user_id,
-                type(exc).__name__,
-                exc,
-            )
-
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -93,17 +101,19 @@ class ChatLoggingMiddleware(BaseMiddleware):
         if isinstance(event, Message) and event.text:
             db = data.get("db")
             if db and event.from_user:
-                if len(self._pending_logs) >= self.max_pending_logs:
-                    logger.warning("CHAT_HISTORY_QUEUE_FULL pending=%s", len(self._pending_logs))
-                else:
-                    task = asyncio.create_task(
-                        self._safe_log_chat_message(
-                            db=db,
-                            user_id=event.from_user.id,
-                            text=event.text,
-                        )
+                try:
+                    await log_chat_message(
+                        db=db,
+                        user_id=event.from_user.id,
+                        role="user",
+                        text=event.text,
+                    )
+                except Exception as exc:
+                    logger.warning(
+                        "CHAT_HISTORY_WRITE_FAILED user_id=%s error_type=%s error=%s",
+                        event.from_user.id,
+                        type(exc).__name__,
+                        exc,
                     )
-                    self._pending_logs.add(task)
-                    task.add_done_callback(self._pending_logs.discard)
 
         return await handler(event, data)
@@ -3,15 +3,23 @@ import logging
 import os
 import re
 from datetime import datetime, timedelta
-from typing import Any
+from typing import Any, AsyncIterator
 
 import pytz
 from aiogram import Bot
 from aiogram.exceptions import TelegramForbiddenError
 from firebase_admin import firestore
 
-from firebase_db import log_chat_message
-from gemini_runtime import generate_content
+from firebase_db import (
+    iter_document_pages,
+    log_chat_message,
+    read_document,
+    run_transaction,
+    update_user_fields,
+    write_document,
+)
+from gemini_runtime import PRIORITY_BACKGROUND, ModelRouter, generate_content
+from metrics import track_firestore_operation
 from keyboards import main_menu_kb
 
 _MONTHLY_REMINDER_TEXT = {
@@ -149,9 +157,20 @@ _EMERGENCY_HOROSCOPE_TEMPLATES = {
 }
 _GENERATION_RETRY_DELAYS = (0, 30, 90)
 _HOROSCOPE_BATCH_DAYS = 1
+# Three languages x (12 signs + general text) of a few hundred characters each.
+_HOROSCOPE_OUTPUT_CHARS_PER_DAY = 15000
 _DELIVERY_LOCK_STALE_MINUTES = 15
 _FIRESTORE_TIMEOUT_SECONDS = 30
 _DAILY_JOB_TIMEOUT_SECONDS = 10 * 60
+_BROADCAST_PAGE_SIZE = max(1, int(os.getenv("BROADCAST_PAGE_SIZE", "200")))
+_BROADCAST_USER_FIELDS = [
+    "language",
+    "zodiac_sign",
+    "horoscope_enabled",
+    "last_horoscope_share_date",
+    "last_daily_card_date",
+    "last_monthly_card_reminder_month",
+]
 
 # Список тем для урізноманітнення гороскопів
 _DAILY_THEMES = [
@@ -205,73 +224,75 @@ def _daily_horoscope_doc(db: firestore.Client, date_key: str):
     return db.collection("daily_horoscopes").document(date_key)
 
 
-async def _load_users(db: firestore.Client) -> list[Any]:
-    def _read_sync() -> list[Any]:
-        return list(
-            db.collection("users").stream(timeout=_FIRESTORE_TIMEOUT_SECONDS)
-        )
-
-    return await asyncio.wait_for(
-        asyncio.to_thread(_read_sync),
-        timeout=_FIRESTORE_TIMEOUT_SECONDS + 5,
+async def _iter_users(db: firestore.Client) -> AsyncIterator[Any]:
+    pages = iter_document_pages(
+        db,
+        db.collection("users"),
+        page_size=_BROADCAST_PAGE_SIZE,
+        fields=_BROADCAST_USER_FIELDS,
+        timeout=_FIRESTORE_TIMEOUT_SECONDS,
     )
+    try:
+        while True:
+            try:
+                page = await asyncio.wait_for(pages.__anext__(), timeout=_FIRESTORE_TIMEOUT_SECONDS + 5)
+            except StopAsyncIteration:
+                return
+            for doc in page:
+                yield doc
+    finally:
+        await pages.aclose()
 
 
+@track_firestore_operation
 async def _store_share_text(db: firestore.Client, user_id: str, text: str, date_key: str) -> None:
-    def _write_sync() -> None:
-        db.collection("users").document(user_id).set(
-            {
-                "last_horoscope_share_text": text,
-                "last_horoscope_share_date": date_key,
-            },
-            merge=True,
-        )
-
-    await asyncio.to_thread(_write_sync)
+    await update_user_fields(
+        db,
+        int(user_id),
+        {
+            "last_horoscope_share_text": text,
+            "last_horoscope_share_date": date_key,
+        },
+    )
 
 
+@track_firestore_operation
 async def _mark_monthly_reminder_sent(db: firestore.Client, user_id: str, month_key: str) -> None:
-    def _write_sync() -> None:
-        db.collection("users").document(user_id).set(
-            {"last_monthly_card_reminder_month": month_key},
-            merge=True,
-        )
-
-    await asyncio.to_thread(_write_sync)
+    await update_user_fields(db, int(user_id), {"last_monthly_card_reminder_month": month_key})
 
 
+@track_firestore_operation
 async def _get_cached_horoscope_payload(db: firestore.Client, date_key: str) -> dict[str, dict[str, str]] | None:
-    def _read_sync() -> dict[str, dict[str, str]] | None:
-        snap = _daily_horoscope_doc(db, date_key).get(
-            timeout=_FIRESTORE_TIMEOUT_SECONDS
-        )
-        if not snap.exists:
-            return None
-        data = snap.to_dict() or {}
-        payload = data.get("payload")
-        return payload if isinstance(payload, dict) else None
-
-    return await asyncio.to_thread(_read_sync)
+    snap = await read_document(
+        db,
+        _daily_horoscope_doc(db, date_key),
+        timeout=_FIRESTORE_TIMEOUT_SECONDS,
+    )
+    if not snap.exists:
+        return None
+    data = snap.to_dict() or {}
+    payload = data.get("payload")
+    return payload if isinstance(payload, dict) else None
 
 
+@track_firestore_operation
 async def _store_cached_horoscope_payload(
     db: firestore.Client,
     date_key: str,
     payload: dict[str, dict[str, str]],
     source: str = "gemini",
 ) -> None:
-    def _write_sync() -> None:
-        _daily_horoscope_doc(db, date_key).set(
-            {
-                "source": source,
-                "payload": payload,
-                "created_at": firestore.SERVER_TIMESTAMP,
-                "generation_error": firestore.DELETE_FIELD,
-            },
-            merge=True,
-        )
-
-    await asyncio.to_thread(_write_sync)
+    await write_document(
+        db,
+        _daily_horoscope_doc(db, date_key),
+        {
+            "source": source,
+            "payload": payload,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "generation_error": firestore.DELETE_FIELD,
+        },
+        merge=True,
+    )
 
 async def _notify_admins_local_horoscope(bot: Bot, date_key: str, reason: str) -> None:
     message = (
@@ -295,9 +316,12 @@ async def _notify_admins_local_horoscope(bot: Bot, date_key: str, reason: str) -
 
 
 
+@track_firestore_operation
 async def _set_generation_error(db: firestore.Client, date_key: str, message: str, attempt: int) -> None:
-    def _write_sync() -> None:
-        _daily_horoscope_doc(db, date_key).set(
+    try:
+        await write_document(
+            db,
+            _daily_horoscope_doc(db, date_key),
             {
                 "generation_error": message,
                 "generation_attempt": attempt,
@@ -305,9 +329,6 @@ async def _set_generation_error(db: firestore.Client, date_key: str, message: st
             },
             merge=True,
         )
-
-    try:
-        await asyncio.to_thread(_write_sync)
     except Exception as exc:
         logging.warning(
             "HOROSCOPE_GENERATION_ERROR_WRITE_FAILED date_key=%s error_type=%s error=%s",
@@ -317,72 +338,65 @@ async def _set_generation_error(db: firestore.Client, date_key: str, message: st
         )
 
 
+@track_firestore_operation
 async def _claim_delivery(db: firestore.Client, date_key: str, now: datetime) -> bool:
-    def _tx_sync() -> bool:
-        ref = _daily_horoscope_doc(db, date_key)
-        now_iso = now.isoformat()
-        stale_before_iso = (now - timedelta(minutes=_DELIVERY_LOCK_STALE_MINUTES)).isoformat()
-
-        @firestore.transactional
-        def _run(transaction: firestore.Transaction) -> bool:
-            snap = ref.get(
-                transaction=transaction,
-                timeout=_FIRESTORE_TIMEOUT_SECONDS,
-            )
-            data = snap.to_dict() or {}
-
-            if data.get("delivery_completed_at"):
-                return False
-
-            started_at = data.get("delivery_started_at")
-            if started_at and isinstance(started_at, str) and started_at > stale_before_iso:
-                return False
-
-            transaction.set(
-                ref,
-                {
-                    "delivery_started_at": now_iso,
-                    "delivery_error": firestore.DELETE_FIELD,
-                },
-                merge=True,
-            )
-            return True
+    ref = _daily_horoscope_doc(db, date_key)
+    now_iso = now.isoformat()
+    stale_before_iso = (now - timedelta(minutes=_DELIVERY_LOCK_STALE_MINUTES)).isoformat()
 
-        transaction = db.transaction()
-        return _run(transaction)
+    def _body(transaction: Any):
+        snap = yield ref
+        data = snap.to_dict() or {}
 
-    return await asyncio.to_thread(_tx_sync)
+        if data.get("delivery_completed_at"):
+            return False
 
+        started_at = data.get("delivery_started_at")
+        if started_at and isinstance(started_at, str) and started_at > stale_before_iso:
+            return False
 
-async def _mark_delivery_completed(db: firestore.Client, date_key: str, sent_count: int) -> None:
-    def _write_sync() -> None:
-        _daily_horoscope_doc(db, date_key).set(
+        transaction.set(
+            ref,
             {
-                "delivery_completed_at": datetime.utcnow().isoformat(),
-                "delivery_sent_count": sent_count,
+                "delivery_started_at": now_iso,
                 "delivery_error": firestore.DELETE_FIELD,
-                "delivery_started_at": firestore.DELETE_FIELD,
             },
             merge=True,
-            timeout=_FIRESTORE_TIMEOUT_SECONDS,
         )
+        return True
 
-    await asyncio.to_thread(_write_sync)
+    return await run_transaction(db, _body, read_timeout=_FIRESTORE_TIMEOUT_SECONDS)
 
 
-async def _mark_delivery_error(db: firestore.Client, date_key: str, message: str) -> None:
-    def _write_sync() -> None:
-        _daily_horoscope_doc(db, date_key).set(
-            {
-                "delivery_error": message,
-                "delivery_failed_at": datetime.utcnow().isoformat(),
-                "delivery_started_at": firestore.DELETE_FIELD,
-            },
-            merge=True,
-            timeout=_FIRESTORE_TIMEOUT_SECONDS,
-        )
+@track_firestore_operation
+async def _mark_delivery_completed(db: firestore.Client, date_key: str, sent_count: int) -> None:
+    await write_document(
+        db,
+        _daily_horoscope_doc(db, date_key),
+        {
+            "delivery_completed_at": datetime.utcnow().isoformat(),
+            "delivery_sent_count": sent_count,
+            "delivery_error": firestore.DELETE_FIELD,
+            "delivery_started_at": firestore.DELETE_FIELD,
+        },
+        merge=True,
+        timeout=_FIRESTORE_TIMEOUT_SECONDS,
+    )
 
-    await asyncio.to_thread(_write_sync)
+
+@track_firestore_operation
+async def _mark_delivery_error(db: firestore.Client, date_key: str, message: str) -> None:
+    await write_document(
+        db,
+        _daily_horoscope_doc(db, date_key),
+        {
+            "delivery_error": message,
+            "delivery_failed_at": datetime.utcnow().isoformat(),
+            "delivery_started_at": firestore.DELETE_FIELD,
+        },
+        merge=True,
+        timeout=_FIRESTORE_TIMEOUT_SECONDS,
+    )
 
 
 def _build_horoscope_prompt(day_configs: list[dict[str, str]]) -> str:
@@ -588,7 +602,8 @@ async def _get_or_generate_horoscope_payload(
             return None
 
     model_candidates = [tarot_model]
-    if fallback_model is not None and fallback_model is not tarot_model:
+    # A router already fails over to its fallback model; adding it here would retry twice.
+    if fallback_model is not None and fallback_model is not tarot_model and not isinstance(tarot_model, ModelRouter):
         model_candidates.append(fallback_model)
     today_config = next(config for config in batch_configs if config["date"] == date_key)
 
@@ -609,7 +624,13 @@ async def _get_or_generate_horoscope_payload(
         )
 
         try:
-            response = await generate_content(model, prompt)
+            response = await generate_content(
+                model,
+                prompt,
+                priority=PRIORITY_BACKGROUND,
+                expected_output_chars=_HOROSCOPE_OUTPUT_CHARS_PER_DAY * len(attempt_configs),
+                feature="horoscope_batch",
+            )
             raw_text = getattr(response, "text", "").strip()
             if not raw_text:
                 raise ValueError("Gemini returned empty batch text")
@@ -694,10 +715,8 @@ async def send_monthly_card_reminders(bot: Bot, db: firestore.Client):
     now = datetime.now(tz)
     today = now.date()
     month_key = now.strftime("%Y-%m")
-    users = await _load_users(db)
-
     count = 0
-    for doc in users:
+    async for doc in _iter_users(db):
         user_data = doc.to_dict() or {}
         user_id = doc.id
         lang = user_data.get("language", "uk")
@@ -772,9 +791,8 @@ async def _send_daily_horoscope(
 
         me = await bot.get_me()
         bot_link = f"https://t.me/{me.username}" if me.username else None
-        users = await _load_users(db)
 
-        for doc in users:
+        async for doc in _iter_users(db):
             user_data = doc.to_dict() or {}
             user_id = doc.id
             lang = user_data.get("language", "uk")
@@ -35,3 +35,57 @@ Output must be Telegram-safe HTML only.
 Use only tags like <b> and <i> when formatting is needed.
 Do not use Markdown.
 """
+
+TARGET_LANGUAGES = {"uk": "Ukrainian", "en": "English", "ru": "Russian"}
+
+HEADING_GUIDE = {
+    "uk": {
+        "cards": "Карти",
+        "reading": "Твій розклад",
+        "advice": "Порада від Karma",
+        "affirmation": "Афірмація",
+    },
+    "en": {
+        "cards": "Cards",
+        "reading": "Your reading",
+        "advice": "Advice from Karma",
+        "affirmation": "Affirmation",
+    },
+    "ru": {
+        "cards": "Карты",
+        "reading": "Твой расклад",
+        "advice": "Совет от Karma",
+        "affirmation": "Аффирмация",
+    },
+}
+
+
+def heading_guide(lang: str) -> dict[str, str]:
+    return HEADING_GUIDE.get(lang, HEADING_GUIDE["uk"])
+
+
+def tarot_format_prompt(lang: str, target_language: str) -> str:
+    headings = heading_guide(lang)
+    return (
+        f"Write the entire response only in {target_language}. Do not mix languages. "
+        f"Use Telegram HTML only. Do not use Markdown. "
+        f"Keep the emojis exactly as shown. Keep exactly one empty line after each heading and one empty line between blocks. "
+        f"Return the answer in exactly this structure:\n\n"
+        f"🪄 <b>{headings['cards']}:</b>\n\n"
+        f"[text]\n\n"
+        f"🧘 <b>{headings['reading']}:</b>\n\n"
+        f"[text]\n\n"
+        f"🕯 <b>{headings['advice']}:</b>\n\n"
+        f"[text]\n\n"
+        f"✨ <b>{headings['affirmation']}:</b>\n\n"
+        f"[text]\n\n"
+        f"The affirmation must also be fully in {target_language}."
+    )
+
+
+def daily_card_prompt(lang: str) -> str:
+    target_language = TARGET_LANGUAGES.get(lang, "Ukrainian")
+    return (
+        "Draw a card of the day and explain the energy of this day. "
+        + tarot_format_prompt(lang, target_language)
+    )
@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from google.api_core.exceptions import InvalidArgument
+
+import fake_firestore
+from fake_firestore import FakeFirestoreClient
+import firebase_db
+
+
+@pytest.fixture(autouse=True)
+def daily_storage(monkeypatch):
+    monkeypatch.setattr(firebase_db, "_CHAT_HISTORY_STORAGE", "daily")
+    monkeypatch.setattr(firebase_db, "_CHAT_HISTORY_DAY_PART_MESSAGES", 3)
+    monkeypatch.setattr(firebase_db, "_chat_day_parts", {})
+
+
+def _today():
+    return firebase_db._chat_day_key(datetime.now(timezone.utc))
+
+
+def _days(db, user_id):
+    return db.collection("users").document(str(user_id)).collection("chat_days")
+
+
+def _parts(db, user_id, day):
+    return {
+        snap.id: len(snap.get("messages"))
+        for snap in _days(db, user_id).stream()
+        if snap.id != day
+    }
+
+
+def _index(db, user_id, day):
+    return _days(db, user_id).document(day).get().to_dict()["parts"]
+
+
+def _write(db, entries):
+    async def run():
+        writer = firebase_db.ChatHistoryWriter(db, batch_size=len(entries))
+        await writer._flush(entries)
+        return writer
+
+    return asyncio.run(run())
+
+
+def test_day_rolls_over_to_parts_listed_in_the_index():
+    db = FakeFirestoreClient()
+    day = _today()
+    _write(db, [(1, "user", f"line {index}") for index in range(7)])
+
+    part_ids = [firebase_db._chat_day_doc_id(day, part) for part in range(3)]
+    assert _index(db, 1, day) == part_ids
+    assert _parts(db, 1, day) == dict(zip(part_ids, (3, 3, 1)))
+
+
+def test_history_reads_parts_by_id_until_the_limit():
+    db = FakeFirestoreClient()
+    _write(db, [(1, "user", f"line {index}") for index in range(7)])
+
+    history = asyncio.run(firebase_db.get_chat_history(db, 1, limit=5))
+
+    assert [line["text"] for line in history] == ["line 6", "line 5", "line 4", "line 3", "line 2"]
+
+
+def test_history_continues_into_yesterday():
+    db = FakeFirestoreClient()
+    now = datetime.now(timezone.utc)
+    days = _days(db, 1)
+    yesterday = firebase_db._chat_day_key(now - timedelta(days=1))
+    days.document(yesterday).set({"day": yesterday, "parts": ["old"]})
+    days.document("old").set({"day": yesterday, "messages": [{"role": "user", "text": "yesterday", "at": now}]})
+    _write(db, [(1, "user", "today")])
+
+    history = asyncio.run(firebase_db.get_chat_history(db, 1, limit=20))
+
+    assert [line["text"] for line in history] == ["today", "yesterday"]
+
+
+def test_restart_starts_new_parts_after_the_old_ones(monkeypatch):
+    db = FakeFirestoreClient()
+    day = _today()
+    _write(db, [(1, "user", "before restart")])
+    monkeypatch.setattr(firebase_db, "_chat_day_parts", {})
+    monkeypatch.setattr(firebase_db, "_CHAT_DAY_PART_TOKEN", "next01")
+    _write(db, [(1, "user", "after restart")])
+
+    assert len(_index(db, 1, day)) == 2
+    history = asyncio.run(firebase_db.get_chat_history(db, 1, limit=20))
+    assert [line["text"] for line in history] == ["after restart", "before restart"]
+
+
+def test_rejected_part_rolls_over_without_losing_other_users(monkeypatch):
+    db = FakeFirestoreClient()
+    day = _today()
+    full_part = f"users/1/chat_days/{firebase_db._chat_day_doc_id(day, 0)}"
+    commit = fake_firestore.FakeWriteBatch.commit
+
+    def reject_full_part(batch, **kwargs):
+        if any(write[1].path == full_part for write in batch._writes):
+            raise InvalidArgument("document too large")
+        return commit(batch, **kwargs)
+
+    monkeypatch.setattr(fake_firestore.FakeWriteBatch, "commit", reject_full_part)
+    writer = _write(db, [(1, "user", "hello"), (2, "user", "hi")])
+
+    assert writer.flushed == 2
+    assert writer.failed == 0
+    assert _index(db, 1, day) == [firebase_db._chat_day_doc_id(day, 1)]
+    assert _index(db, 2, day) == [firebase_db._chat_day_doc_id(day, 0)]
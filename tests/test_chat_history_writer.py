@@ -0,0 +1,40 @@
+import asyncio
+
+from fake_firestore import FakeFirestoreClient
+import firebase_db
+
+
+def _history(db, user_id):
+    return list(db.collection("users").document(str(user_id)).collection("chat_history").stream())
+
+
+def test_stop_flushes_every_queued_entry():
+    db = FakeFirestoreClient()
+
+    async def run():
+        writer = firebase_db.ChatHistoryWriter(db, flush_interval_ms=60_000, batch_size=5)
+        writer.start()
+        for index in range(7):
+            await writer.enqueue(1, "user", f"line {index}")
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(run())
+
+    assert writer.flushed == 7
+    assert writer.failed == 0
+    assert sorted(snap.get("text") for snap in _history(db, 1)) == [f"line {index}" for index in range(7)]
+
+
+def test_stop_flushes_entries_of_a_writer_that_never_ran():
+    db = FakeFirestoreClient()
+
+    async def run():
+        writer = firebase_db.ChatHistoryWriter(db, batch_size=2)
+        for index in range(3):
+            await writer.enqueue(2, "assistant", f"reply {index}")
+        await writer.stop()
+
+    asyncio.run(run())
+
+    assert len(_history(db, 2)) == 3
@@ -0,0 +1,45 @@
+import pytest
+
+import gemini_runtime
+from gemini_runtime import CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(gemini_runtime.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _half_open(breaker, clock):
+    breaker._open()
+    clock[0] += gemini_runtime._CIRCUIT_OPEN_SECONDS + 1
+
+
+def test_half_open_admits_a_single_probe(clock):
+    breaker = CircuitBreaker("model")
+    _half_open(breaker, clock)
+
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record(True, 0.1, probe=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_calls_admitted_while_closed_cannot_free_or_decide_the_probe(clock):
+    breaker = CircuitBreaker("model")
+    assert breaker.allow()
+    _half_open(breaker, clock)
+    assert breaker.allow()
+
+    # A hedge loser from before the outage ends: neither outcome touches the probe.
+    breaker.release(False)
+    assert not breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record(False, 0.1, probe=True)
+    assert breaker.state == CircuitBreaker.OPEN
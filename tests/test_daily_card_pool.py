@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+import daily_card_pool
+
+
+@pytest.fixture(autouse=True)
+def fresh_refill_state(monkeypatch):
+    monkeypatch.setattr(daily_card_pool, "_refill_tasks", {})
+    monkeypatch.setattr(daily_card_pool, "_refill_retry_at", {})
+
+
+def _schedule_twice(monkeypatch, refill):
+    calls = []
+
+    async def fake_refill(db, model, lang, target):
+        calls.append(lang)
+        return await refill()
+
+    monkeypatch.setattr(daily_card_pool, "_refill_language", fake_refill)
+
+    async def run():
+        for _ in range(2):
+            daily_card_pool._schedule_refill(None, None, "uk")
+            for _ in range(3):
+                await asyncio.sleep(0)
+
+    asyncio.run(run())
+    return calls
+
+
+def test_empty_refill_cools_down(monkeypatch):
+    async def nothing_added():
+        return 0
+
+    assert _schedule_twice(monkeypatch, nothing_added) == ["uk"]
+    assert "uk" in daily_card_pool._refill_retry_at
+
+
+def test_failed_refill_cools_down(monkeypatch):
+    async def broken():
+        raise RuntimeError("Gemini is down")
+
+    assert _schedule_twice(monkeypatch, broken) == ["uk"]
+
+
+def test_successful_refill_does_not_cool_down(monkeypatch):
+    async def some_added():
+        return 3
+
+    assert _schedule_twice(monkeypatch, some_added) == ["uk", "uk"]
+    assert not daily_card_pool._refill_retry_at
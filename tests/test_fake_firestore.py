@@ -0,0 +1,43 @@
+from firebase_admin import firestore
+
+from fake_firestore import FakeFirestoreClient
+
+
+def test_merge_set_applies_transforms():
+    db = FakeFirestoreClient()
+    ref = db.collection("users").document("1")
+    ref.set({"balance": 10, "tags": ["a"]})
+    ref.set({"balance": firestore.Increment(5), "tags": firestore.ArrayUnion(["a", "b"])}, merge=True)
+
+    assert ref.get().to_dict() == {"balance": 15, "tags": ["a", "b"]}
+
+
+def test_query_orders_limits_and_projects():
+    db = FakeFirestoreClient()
+    for user_id, balance in ((1, 30), (2, 10), (3, 20)):
+        db.collection("users").document(str(user_id)).set({"balance": balance, "name": f"u{user_id}"})
+
+    query = db.collection("users").order_by("balance", direction=firestore.Query.DESCENDING).limit(2).select(["balance"])
+    docs = list(query.stream())
+
+    assert [doc.id for doc in docs] == ["1", "3"]
+    assert docs[0].to_dict() == {"balance": 30}
+
+
+def test_transaction_reruns_body_after_concurrent_write():
+    db = FakeFirestoreClient()
+    ref = db.collection("users").document("1")
+    ref.set({"balance": 1})
+    runs = []
+
+    def body(transaction):
+        snap = yield ref
+        runs.append(snap.get("balance"))
+        if len(runs) == 1:
+            ref.set({"balance": 5})
+        transaction.set(ref, {"balance": snap.get("balance") + 1}, merge=True)
+        return len(runs)
+
+    assert db.run_transaction(body) == 2
+    assert runs == [1, 5]
+    assert ref.get().get("balance") == 6
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import gemini_runtime
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    calls = []
+
+    async def fake_generate(model, content, **_):
+        calls.append(content)
+        number = len(calls)
+        await asyncio.sleep(0.05)
+        return f"answer {number}"
+
+    monkeypatch.setattr(gemini_runtime, "_generate_content", fake_generate)
+    return calls
+
+
+def test_identical_requests_share_one_call(backend):
+    model = object()
+
+    async def run():
+        return await asyncio.gather(
+            gemini_runtime.generate_content(model, "prompt"),
+            gemini_runtime.generate_content(model, "prompt"),
+            gemini_runtime.generate_content(model, "other prompt"),
+        )
+
+    assert asyncio.run(run()) == ["answer 1", "answer 1", "answer 2"]
+    assert backend == ["prompt", "other prompt"]
+    assert not gemini_runtime._inflight
+
+
+def test_request_after_cancelled_leader_starts_a_fresh_call(backend):
+    model = object()
+
+    async def run():
+        leader = asyncio.create_task(gemini_runtime.generate_content(model, "prompt"))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        # The leader has cancelled the shared call, whose done callback has not run yet.
+        follower = await gemini_runtime.generate_content(model, "prompt")
+        await asyncio.gather(leader, return_exceptions=True)
+        return follower
+
+    assert asyncio.run(run()) == "answer 2"
+    assert backend == ["prompt", "prompt"]
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+import gemini_runtime
+from gemini_runtime import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_PAID, GeminiScheduler, GeminiShedError
+
+
+@pytest.fixture(autouse=True)
+def fixed_rss(monkeypatch):
+    monkeypatch.setattr(gemini_runtime, "current_rss_mb", lambda: 100.0)
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_weights_wait_for_memory_budget():
+    async def run():
+        scheduler = GeminiScheduler(max_concurrency=4, memory_limit_mb=300, max_pending=10)
+        await scheduler.acquire(150)
+        second = asyncio.create_task(scheduler.acquire(150))
+        await _settle()
+        assert not second.done()
+
+        scheduler.release(150, PRIORITY_INTERACTIVE)
+        await _settle()
+        assert second.done()
+        assert scheduler.inflight == 1
+        assert scheduler.reserved_mb == 150
+
+    asyncio.run(run())
+
+
+def test_cancelled_evicted_waiter_does_not_release_a_slot():
+    async def run():
+        scheduler = GeminiScheduler(max_concurrency=1, memory_limit_mb=1000, max_pending=2)
+        await scheduler.acquire(10)
+        victim = asyncio.create_task(scheduler.acquire(10))
+        await _settle()
+
+        paid = asyncio.create_task(scheduler.acquire(10, PRIORITY_PAID))
+        await asyncio.sleep(0)
+        # Cancelled right after the eviction, before the victim saw its GeminiShedError.
+        victim.cancel()
+        await asyncio.gather(victim, return_exceptions=True)
+
+        assert scheduler.inflight == 1
+        assert not paid.done()
+        scheduler.release(10, PRIORITY_INTERACTIVE)
+        await _settle()
+        assert paid.done()
+        assert scheduler.inflight == 1
+
+    asyncio.run(run())
+
+
+def test_overload_sheds_instead_of_queueing():
+    async def run():
+        scheduler = GeminiScheduler(max_concurrency=1, memory_limit_mb=1000, max_pending=2)
+        await scheduler.acquire(10)
+        waiter = asyncio.create_task(scheduler.acquire(10))
+        await _settle()
+
+        with pytest.raises(GeminiShedError):
+            await scheduler.acquire(10)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_waiters_are_admitted_by_priority_class():
+    async def run():
+        scheduler = GeminiScheduler(max_concurrency=1, memory_limit_mb=1000, max_pending=100)
+        await scheduler.acquire(10)
+        admitted = []
+
+        async def wait(priority):
+            await scheduler.acquire(10, priority)
+            admitted.append(priority)
+
+        tasks = [asyncio.create_task(wait(priority)) for priority in (PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_PAID)]
+        await _settle()
+        previous = PRIORITY_INTERACTIVE
+        for _ in tasks:
+            scheduler.release(10, previous)
+            await _settle()
+            previous = admitted[-1]
+        assert admitted == [PRIORITY_PAID, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND]
+
+    asyncio.run(run())
+
+
+def test_background_is_shed_by_its_own_backlog():
+    async def run():
+        scheduler = GeminiScheduler(max_concurrency=1, memory_limit_mb=1000, max_pending=8)
+        await scheduler.acquire(10)
+        waiters = [asyncio.create_task(scheduler.acquire(10)) for _ in range(4)]
+        waiters += [asyncio.create_task(scheduler.acquire(10, PRIORITY_BACKGROUND)) for _ in range(2)]
+        await _settle()
+        # Five interactive requests pending do not count against the background share (2).
+        assert not any(task.done() for task in waiters)
+
+        with pytest.raises(GeminiShedError):
+            await scheduler.acquire(10, PRIORITY_BACKGROUND)
+        assert scheduler.shed[PRIORITY_BACKGROUND] == 1
+        for task in waiters:
+            task.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_newcomer_that_fits_is_admitted_past_a_blocked_head():
+    async def run():
+        scheduler = GeminiScheduler(max_concurrency=3, memory_limit_mb=300, max_pending=10)
+        await scheduler.acquire(50)
+        large = asyncio.create_task(scheduler.acquire(200))
+        await _settle()
+        assert not large.done()
+
+        await asyncio.wait_for(scheduler.acquire(100), timeout=1)
+        assert scheduler.inflight == 2
+        assert not large.done()
+        large.cancel()
+        await asyncio.gather(large, return_exceptions=True)
+
+    asyncio.run(run())
@@ -0,0 +1,19 @@
+import gemini_runtime
+from gemini_runtime import HedgeBudget
+
+
+def test_hedges_are_limited_to_the_recent_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(gemini_runtime.time, "monotonic", lambda: now[0])
+    budget = HedgeBudget(0.1, 60)
+
+    for _ in range(100):
+        budget.record_request()
+    assert sum(budget.take() for _ in range(20)) == 10
+
+    # Healthy traffic from before the window does not pay for hedges now.
+    now[0] += 120
+    for _ in range(10):
+        budget.record_request()
+    assert budget.take()
+    assert not budget.take()
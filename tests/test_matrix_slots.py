@@ -0,0 +1,32 @@
+import asyncio
+
+from fake_firestore import FakeFirestoreClient
+import firebase_db
+
+
+def _slots(db, user_id):
+    return db.collection("users").document(str(user_id)).get().to_dict().get("matrix_free_slots")
+
+
+def test_slots_start_from_the_default_and_stop_at_zero():
+    db = FakeFirestoreClient()
+    db.collection("users").document("1").set({"balance": 0})
+
+    async def run():
+        return [await firebase_db.consume_matrix_free_slot(db, 1) for _ in range(3)]
+
+    assert asyncio.run(run()) == [True, True, False]
+    assert _slots(db, 1) == 0
+
+
+def test_purchase_and_consume_use_the_stored_count():
+    db = FakeFirestoreClient()
+    db.collection("users").document("1").set({"matrix_free_slots": 0})
+
+    async def run():
+        assert await firebase_db.add_matrix_free_slots(db, 1) == 1
+        assert await firebase_db.consume_matrix_free_slot(db, 1)
+        assert not await firebase_db.consume_matrix_free_slot(db, 1)
+
+    asyncio.run(run())
+    assert _slots(db, 1) == 0
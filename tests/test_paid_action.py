@@ -0,0 +1,78 @@
+import asyncio
+
+from fake_firestore import FakeFirestoreClient
+import firebase_db
+
+
+def _user(db, user_id):
+    return db.collection("users").document(str(user_id)).get().to_dict() or {}
+
+
+def _seed(db, user_id, balance):
+    db.collection("users").document(str(user_id)).set({"balance": balance})
+
+
+def test_reserve_debits_and_locks_then_commit_releases():
+    db = FakeFirestoreClient()
+    _seed(db, 1, 100)
+
+    async def run():
+        reservation = await firebase_db.reserve_paid_action(db, 1, "advice", 75)
+        assert reservation.reserved
+        assert reservation.balance == 25
+        user = _user(db, 1)
+        assert user["balance"] == 25
+        assert user["active_ai_lock"] == "advice"
+        assert reservation.token in user["ai_reservations"]
+
+        await firebase_db.commit_paid_action(db, 1, reservation.token)
+
+    asyncio.run(run())
+    user = _user(db, 1)
+    assert user["balance"] == 25
+    assert "active_ai_lock" not in user
+    assert user.get("ai_reservations", {}) == {}
+
+
+def test_second_reservation_is_locked_until_settled():
+    db = FakeFirestoreClient()
+    _seed(db, 1, 200)
+
+    async def run():
+        first = await firebase_db.reserve_paid_action(db, 1, "advice", 75)
+        second = await firebase_db.reserve_paid_action(db, 1, "advice", 75)
+        assert second.status == "locked"
+        assert second.balance == 125
+        await firebase_db.commit_paid_action(db, 1, first.token)
+        third = await firebase_db.reserve_paid_action(db, 1, "advice", 75)
+        assert third.reserved
+
+    asyncio.run(run())
+    assert _user(db, 1)["balance"] == 50
+
+
+def test_insufficient_balance_leaves_user_untouched():
+    db = FakeFirestoreClient()
+    _seed(db, 1, 10)
+
+    reservation = asyncio.run(firebase_db.reserve_paid_action(db, 1, "advice", 75))
+
+    assert reservation.status == "insufficient"
+    assert reservation.token is None
+    assert _user(db, 1) == {"balance": 10}
+
+
+def test_refund_returns_the_debit_only_once():
+    db = FakeFirestoreClient()
+    _seed(db, 1, 100)
+
+    async def run():
+        reservation = await firebase_db.reserve_paid_action(db, 1, "reading:career", 100)
+        first = await firebase_db.refund_paid_action(db, 1, reservation.token)
+        second = await firebase_db.refund_paid_action(db, 1, reservation.token)
+        return first, second
+
+    assert asyncio.run(run()) == (100, 0)
+    user = _user(db, 1)
+    assert user["balance"] == 100
+    assert "active_ai_lock" not in user
@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Chat, Message
+
+from utils import telegram_stream
+from utils.telegram_stream import TelegramStreamWriter
+
+
+class FakeMessage:
+    def __init__(self, chat, text):
+        self.chat = chat
+        self.text = text
+        self.deleted = False
+
+    async def edit_text(self, text, **_):
+        await self.chat.maybe_flood()
+        self.text = text
+
+    async def delete(self, **_):
+        self.deleted = True
+
+
+class FakeChat:
+    """Anchor whose edits hit flood control ``floods`` times before going through."""
+
+    def __init__(self, floods=0):
+        self.floods = floods
+        self.sent = []
+
+    async def maybe_flood(self):
+        if self.floods:
+            self.floods -= 1
+            raise TelegramRetryAfter(method=None, message="Too Many Requests", retry_after=0)
+
+    async def answer(self, text, **_):
+        message = FakeMessage(self, text)
+        self.sent.append(message)
+        return message
+
+
+class Cover(Message):
+    async def delete(self, **_):
+        deleted_covers.append(self.message_id)
+
+
+deleted_covers = []
+
+
+def _cover():
+    return Cover.model_construct(message_id=7, date=datetime.now(), chat=Chat(id=1, type="private"))
+
+
+def _stream(chat, parts, on_start=None):
+    async def run():
+        writer = TelegramStreamWriter(chat, on_start=on_start, edit_interval=0)
+        for part in parts:
+            await writer.push(part)
+        try:
+            return await writer.finish()
+        except TelegramRetryAfter:
+            await writer.discard()
+            raise
+
+    return asyncio.run(run())
+
+
+def test_final_edit_is_retried_through_flood_waits():
+    chat = FakeChat()
+    first = "<b>Heading:</b> " + "a" * 60
+    rest = " and the rest of the answer"
+
+    async def flood_after_start():
+        chat.floods = 2
+
+    text = _stream(chat, [first, rest], on_start=flood_after_start)
+
+    assert text == first + rest
+    assert chat.sent[0].text == first + rest
+
+
+def test_final_edit_that_keeps_flooding_raises_and_discards_the_cover(monkeypatch):
+    monkeypatch.setattr(telegram_stream, "_FINAL_SHOW_ATTEMPTS", 3)
+    deleted_covers.clear()
+    chat = FakeChat()
+    cover = _cover()
+
+    async def send_cover():
+        chat.floods = 100
+        return cover
+
+    with pytest.raises(TelegramRetryAfter):
+        _stream(chat, ["a" * 60, "b" * 10], on_start=send_cover)
+
+    assert chat.floods == 100 - 3
+    assert deleted_covers == [7]
+    assert all(message.deleted for message in chat.sent)
@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import html
+import logging
+import os
+import re
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+MESSAGE_LIMIT = 4000
+_EDIT_INTERVAL_SECONDS = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", "1.5"))
+_MIN_EDIT_GROWTH_CHARS = 40
+# Room left under MESSAGE_LIMIT for the closing tags appended when a chunk is cut.
+_SPLIT_TAG_RESERVE = 100
+# Tries for an edit that must land (a finished message); flood waits in between are honoured.
+_FINAL_SHOW_ATTEMPTS = 4
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^<>]*>")
+_VOID_TAGS = {"br"}
+
+
+def _open_tags(text: str) -> list[tuple[str, str]]:
+    """Tags still open at the end of ``text`` as (name, opening tag), outermost first."""
+    stack: list[tuple[str, str]] = []
+    for match in _TAG_RE.finditer(text):
+        closing, name = match.group(1), match.group(2).lower()
+        if name in _VOID_TAGS:
+            continue
+        if not closing:
+            stack.append((name, match.group(0)))
+            continue
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index][0] == name:
+                del stack[index:]
+                break
+    return stack
+
+
+def _drop_partial_markup(text: str) -> str:
+    """Cut a trailing tag or entity that the model has not finished writing yet."""
+    tag_start = text.rfind("<")
+    if tag_start > text.rfind(">"):
+        text = text[:tag_start]
+    entity_start = text.rfind("&")
+    if entity_start != -1 and ";" not in text[entity_start:] and re.fullmatch(r"&#?\w{0,10}", text[entity_start:]):
+        text = text[:entity_start]
+    return text
+
+
+def balance_html(text: str) -> str:
+    """Make a prefix of Telegram HTML safe to send: drop unfinished markup, close open tags."""
+    text = _drop_partial_markup(text)
+    closers = "".join(f"</{name}>" for name, _ in reversed(_open_tags(text)))
+    return (text + closers).strip()
+
+
+def _strip_html(text: str) -> str:
+    return html.unescape(_TAG_RE.sub("", text))
+
+
+def _split_point(text: str, limit: int) -> int:
+    window = text[:limit]
+    for separator in ("\n\n", "\n", " "):
+        cut = window.rfind(separator)
+        if cut > limit // 2:
+            break
+    else:
+        cut = limit
+    tag_start = window.rfind("<", 0, cut)
+    if tag_start > window.rfind(">", 0, cut):
+        cut = tag_start
+    return cut
+
+
+class TelegramStreamWriter:
+    """Render a growing Gemini response into Telegram messages with throttled edits.
+
+    The first content replaces ``placeholder`` (after ``on_start`` runs, e.g. to send a
+    cover photo; a Message it returns is deleted with the rest on ``discard``); text past
+    MESSAGE_LIMIT continues in a new message, with open HTML tags closed at the cut and
+    reopened in the next message. A finished message that cannot be shown in full raises,
+    so callers never treat a truncated answer as delivered.
+    """
+
+    def __init__(
+        self,
+        anchor: Message,
+        *,
+        placeholder: Message | None = None,
+        on_start: Callable[[], Awaitable[Any]] | None = None,
+        limit: int = MESSAGE_LIMIT,
+        edit_interval: float = _EDIT_INTERVAL_SECONDS,
+    ) -> None:
+        self.anchor = anchor
+        self.placeholder = placeholder
+        self.on_start = on_start
+        self.limit = limit
+        self.edit_interval = edit_interval
+        self.text = ""
+        self.messages: list[Message] = []
+        self._segment = ""
+        self._current: Message | None = None
+        self._shown = ""
+        self._started = False
+        self._next_edit_at = 0.0
+
+    async def push(self, delta: str) -> None:
+        self.text += delta
+        self._segment += delta
+
+        while len(self._segment) > self.limit:
+            cut = _split_point(self._segment, self.limit - _SPLIT_TAG_RESERVE)
+            head, tail = self._segment[:cut], self._segment[cut:]
+            await self._show(balance_html(head), final=True)
+            reopen = "".join(tag for _, tag in _open_tags(head))
+            self._segment = reopen + tail.lstrip()
+            self._current = None
+            self._shown = ""
+
+        if time.monotonic() < self._next_edit_at:
+            return
+        rendered = balance_html(self._segment)
+        if self._current is not None and len(rendered) - len(self._shown) < _MIN_EDIT_GROWTH_CHARS:
+            return
+        await self._show(rendered, final=False)
+
+    async def finish(self) -> str:
+        await self._show(balance_html(self._segment), final=True)
+        await self.close_placeholder()
+        return self.text.strip()
+
+    async def discard(self) -> None:
+        """Delete every message sent so far, cover included, for a response that failed midway."""
+        for message in self.messages:
+            with contextlib.suppress(Exception):
+                await message.delete()
+        self.messages.clear()
+        self._current = None
+
+    async def close_placeholder(self) -> None:
+        if self.placeholder is not None:
+            placeholder, self.placeholder = self.placeholder, None
+            with contextlib.suppress(Exception):
+                await placeholder.delete()
+
+    async def _show(self, rendered: str, *, final: bool) -> None:
+        if not rendered or rendered == self._shown:
+            return
+        if not self._started:
+            self._started = True
+            await self.close_placeholder()
+            if self.on_start is not None:
+                cover = await self.on_start()
+                if isinstance(cover, Message):
+                    self.messages.append(cover)
+
+        attempts = _FINAL_SHOW_ATTEMPTS if final else 1
+        for attempt in range(1, attempts + 1):
+            try:
+                if self._current is None:
+                    self._current = await self.anchor.answer(rendered, parse_mode="HTML")
+                    self.messages.append(self._current)
+                else:
+                    await self._current.edit_text(rendered, parse_mode="HTML")
+                self._shown = rendered
+                break
+            except TelegramRetryAfter as exc:
+                if not final:
+                    self._next_edit_at = time.monotonic() + exc.retry_after
+                    return
+                if attempt == attempts:
+                    raise
+                await asyncio.sleep(exc.retry_after)
+            except TelegramBadRequest as exc:
+                if "not modified" in str(exc):
+                    self._shown = rendered
+                    break
+                if not final:
+                    # Usually markup the model closes a few tokens later; the next edit will catch up.
+                    logging.debug("STREAM_EDIT_SKIPPED error=%s", exc)
+                    return
+                logging.warning("STREAM_HTML_REJECTED error=%s; sending plain text", exc)
+                plain = _strip_html(rendered)
+                if self._current is None:
+                    self._current = await self.anchor.answer(plain, parse_mode=None)
+                    self.messages.append(self._current)
+                else:
+                    await self._current.edit_text(plain, parse_mode=None)
+                self._shown = rendered
+                break
+        self._next_edit_at = time.monotonic() + self.edit_interval
+
+
+async def stream_to_chat(
+    anchor: Message,
+    chunks: AsyncIterator[str],
+    *,
+    placeholder: Message | None = None,
+    on_start: Callable[[], Awaitable[Any]] | None = None,
+) -> str:
+    """Stream ``chunks`` into the chat of ``anchor`` and return the full text.
+
+    The placeholder is always removed. If the stream fails midway the partial messages
+    are deleted and the error is re-raised, so callers keep their all-or-nothing handling.
+    """
+    writer = TelegramStreamWriter(anchor, placeholder=placeholder, on_start=on_start)
+    try:
+        async with contextlib.aclosing(chunks):
+            async for delta in chunks:
+                await writer.push(delta)
+        return await writer.finish()
+    except BaseException:
+        await writer.discard()
+        raise
+    finally:
+        await writer.close_placeholder()